@@ -1 +1 @@
-from .acip import refresh_acip_analysis, load_submissions, CGPT_RESPONSE_FILE
+from .acip import refresh_acip_analysis, load_submissions, get_dataset, filter_df_for_analysis, CGPT_RESPONSE_FILE, SUBMISSIONS_FILE
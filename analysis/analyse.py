@@ -1,17 +1,30 @@
 import matplotlib.pyplot as plt
 import os
+import json
+import heapq
+from collections import Counter
 import logging
 import pandas as pd
 from datetime import datetime, timedelta
-
-
-def examine_results(results_file):
-    logging.info(f"Loading and plotting data from: {results_file}")
-    df = pd.read_json(results_file, lines=True)
-    print(f"{len(df)} results for {results_file}")
-    df['created_utc'] = pd.to_datetime(df['created_utc'], unit='s')
-    df.set_index('created_utc', inplace=True)
-    daily_counts = df.resample('1D').size()
+from segment_store import SegmentStore
+from utils import iter_submissions
+
+
+def examine_results(results_path):
+    """plots posts per day for a scrape_to_file results directory (SegmentStore) or jsonl file
+    records are streamed, only the daily counts are kept in memory"""
+    logging.info(f"Loading and plotting data from: {results_path}")
+    if os.path.isdir(results_path):
+        records = SegmentStore(results_path).iter_records(columns=["created_utc"])
+    else:
+        records = iter_submissions(results_path, columns=["created_utc"])
+    counts = Counter(int(r["created_utc"] // 86400) for r in records if r["created_utc"] is not None)
+    print(f"{sum(counts.values())} results for {results_path}")
+    daily_counts = pd.Series(counts).sort_index()
+    if not daily_counts.empty:
+        days = range(daily_counts.index.min(), daily_counts.index.max() + 1)
+        daily_counts = daily_counts.reindex(days, fill_value=0)
+    daily_counts.index = pd.to_datetime(daily_counts.index, unit="D")
 
     plt.figure(figsize=(12, 6))
     daily_counts.plot(kind='bar')
@@ -19,10 +32,40 @@ def examine_results(results_file):
     plt.xlabel("Date")
     plt.ylabel("Number of Posts")
     plt.tight_layout()
-    filename = "plot_" + os.path.basename(results_file).split(".")[0] + ".png"
+    filename = "plot_" + os.path.basename(results_path.rstrip("/")).split(".")[0] + ".png"
     outfile = os.path.join("results", filename)
     plt.savefig(outfile)
-    logging.info("Saved plot to measles_results.png")
+    logging.info(f"Saved plot to {outfile}")
+
+
+def load_submissions_frame(dataset, columns, start_date=None, end_date=None, where=None, params=()):
+    """loads only the given columns and utc date range ("YYYY-MM-DD", end exclusive) from a
+    DatasetStore, and adds the created_date column the chart functions group by"""
+    if "created_utc" not in columns:
+        columns = columns + ["created_utc"]
+    df = dataset.read(columns, start_date=start_date, end_date=end_date, where=where, params=params)
+    df["created_date"] = pd.to_datetime(df["created_utc"], unit="s", utc=True).dt.date
+    return df
+
+
+def load_rollup_frame(dataset, start_date=None, end_date=None, labels=None, search_term="*"):
+    """loads the daily rollup rows (day x subreddit x label) of a DatasetStore and adds created_date
+    the chart and top subreddit functions below take this frame instead of raw submissions"""
+    rollup = dataset.read_rollup(search_term, start_date=start_date, end_date=end_date, labels=labels)
+    rollup["created_date"] = pd.to_datetime(rollup["day"]).dt.date
+    return rollup
+
+
+def load_top_submission_candidates(dataset, rollup, columns, limit=25):
+    """loads only the submissions in the top `limit` by score or comments for the rollup rows.
+    each row keeps its own top [id, value] pairs, so the overall top ones are among them
+    pass the result to save_top_submissions"""
+    ids = set()
+    for column in ["top_by_score", "top_by_comments"]:
+        pairs = (pair for top in rollup[column].dropna() for pair in json.loads(top))
+        ids.update(submission_id for submission_id, _ in heapq.nlargest(limit, pairs, key=lambda p: p[1]))
+    return load_submissions_frame(dataset, columns, where="id IN (SELECT value FROM json_each(?))",
+                                  params=(json.dumps(sorted(ids)),))
 
 
 def save_daily_bart_chart(df, xlabel, ylabel, title, output_path):
@@ -37,17 +80,17 @@ def save_daily_bart_chart(df, xlabel, ylabel, title, output_path):
 
 
 def save_submissions_per_day(df, xlabel, ylabel, title, output_path="submissions_per_day.png"):
-    daily_counts = df.groupby("created_date").size()
+    daily_counts = df.groupby("created_date")["submissions"].sum()
     save_daily_bart_chart(daily_counts, xlabel, ylabel, title, output_path)
 
 
 def save_num_comments_per_day(df, xlabel, ylabel, title, output_path="num_comments_per_day.png"):
-    daily_comments = df.groupby("created_date")["num_comments"].sum()
+    daily_comments = df.groupby("created_date")["comments_sum"].sum()
     save_daily_bart_chart(daily_comments, xlabel, ylabel, title, output_path)
 
 
 def save_score_per_day(df, xlabel, ylabel, title, output_path="upvotes_per_day.png"):
-    daily_score = df.groupby("created_date")["score"].sum()
+    daily_score = df.groupby("created_date")["score_sum"].sum()
     save_daily_bart_chart(daily_score, xlabel, ylabel, title, output_path)
 
 
@@ -96,17 +139,17 @@ def top_submissions_for_day(df, day, limit=5):
 
 def get_top_subreddits_by_submission_count(df, limit=10):
     """
-    Returns top subreddits by number of submissions (row count).
+    Returns top subreddits by number of submissions, from a rollup frame.
     """
-    top_subs = df["subreddit"].value_counts().head(limit)
+    agg = df.groupby("subreddit")["submissions"].sum()
+    top_subs = agg.sort_values(ascending=False).head(limit)
     return top_subs
 
 
 def get_top_subreddits_by_total_comments(df, limit=10):
     """
-    Returns top subreddits by cumulative number of comments across submissions.
-    Assumes 'subreddit' and 'num_comments' columns exist.
+    Returns top subreddits by cumulative number of comments across submissions, from a rollup frame.
     """
-    agg = df.groupby("subreddit")["num_comments"].sum()
+    agg = df.groupby("subreddit")["comments_sum"].sum()
     top_subs = agg.sort_values(ascending=False).head(limit)
     return top_subs
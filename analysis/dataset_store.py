@@ -0,0 +1,372 @@
+import os
+import json
+import decimal
+import sqlite3
+import datetime
+from contextlib import contextmanager
+import pandas as pd
+
+
+"""
+typed on-disk store for a labeled submission dataset, backed by sqlite
+ - append() adds new submissions and never touches existing rows
+ - upsert() updates only the given columns of the given rows (scores, labels, ...)
+ - read() pushes the column list, date range and any extra predicate down into sql,
+   so callers only load what they need
+ - add_matches() records which search terms matched each submission
+ - add_buckets() records the near-duplicate lsh buckets of each submission (analysis/dedupe.py), so new
+   submissions are clustered against only the rows sharing a bucket with them
+ - a daily rollup table (day x search term x subreddit x label: submission count, score sum,
+   comment sum, top ROLLUP_TOP_K [id, value] pairs by score and by comments) is kept up to date by every write,
+   applying the written rows' old and new contributions as deltas. a top list is only re-read (from the
+   rows of its day) when a row dropped out of it and the next one can't be known otherwise. term "*" counts each
+   submission once regardless of how many terms matched it, so totals over it don't double count
+   charts and top-n reports read the rollup instead of grouping raw rows
+replaces the csv that used to be re-parsed and fully rewritten whenever one column changed
+"""
+
+
+COLUMN_TYPES = {
+    "id": "TEXT PRIMARY KEY",
+    "url": "TEXT",
+    "domain": "TEXT",
+    "title": "TEXT",
+    "permalink": "TEXT",
+    "created_utc": "REAL",
+    "url_overridden_by_dest": "TEXT",
+    "subreddit_id": "TEXT",
+    "subreddit": "TEXT",
+    "upvote_ratio": "REAL",
+    "score": "INTEGER",
+    "gilded": "INTEGER",
+    "num_comments": "INTEGER",
+    "num_crossposts": "INTEGER",
+    "pinned": "INTEGER",
+    "stickied": "INTEGER",
+    "over_18": "INTEGER",
+    "is_created_from_ads_ui": "INTEGER",
+    "is_self": "INTEGER",
+    "is_video": "INTEGER",
+    "media": "TEXT",
+    "gildings": "TEXT",
+    "all_awardings": "TEXT",
+    "is_en": "INTEGER",
+    "cluster_id": "TEXT",
+    "cgpt_response": "TEXT",
+    "label_source": "TEXT",
+}
+INDEXED_COLUMNS = ["created_utc", "cluster_id", "cgpt_response"]
+# columns that feed the rollup. writes that don't touch these don't refresh it
+ROLLUP_SOURCE_COLUMNS = {"created_utc", "subreddit", "score", "num_comments", "cgpt_response"}
+ROLLUP_TOP_K = 25
+ALL_TERMS = "*"
+DAY_SQL = "date(created_utc, 'unixepoch')"
+
+
+class DatasetStore:
+    def __init__(self, path, table="submissions", rollups=True):
+        """rollups=False skips the daily rollups, for stores nothing charts from"""
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.table = table
+        self.rollups = rollups
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        columns = ", ".join(f"{name} {kind}" for name, kind in COLUMN_TYPES.items())
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+        for column in INDEXED_COLUMNS:
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_{column} ON {table} ({column})")
+        # the day the rollups group by, so recomputing a few days doesn't scan the table
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_day ON {table} ({DAY_SQL})")
+        self.match_table = f"{table}_terms"
+        self.rollup_table = f"{table}_daily_rollup"
+        self.conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.match_table} (
+                search_term TEXT, id TEXT, PRIMARY KEY (search_term, id))""")
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {self.match_table}_id ON {self.match_table} (id)")
+        self.bucket_table = f"{table}_buckets"
+        self.conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.bucket_table} (
+                bucket INTEGER, id TEXT, PRIMARY KEY (bucket, id)) WITHOUT ROWID""")
+        self.conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.rollup_table} (
+                day TEXT, search_term TEXT, subreddit TEXT, label TEXT,
+                submissions INTEGER, score_sum INTEGER, comments_sum INTEGER,
+                top_by_score TEXT, top_by_comments TEXT,
+                PRIMARY KEY (day, search_term, subreddit, label))""")
+        self.conn.commit()
+        if rollups and self.count() and not self.conn.execute(f"SELECT 1 FROM {self.rollup_table} LIMIT 1").fetchone():
+            self.refresh_rollups()  # store from before rollups existed
+
+    def count(self, where=None, params=()):
+        sql = f"SELECT COUNT(*) FROM {self.table}" + (f" WHERE {where}" if where else "")
+        return self.conn.execute(sql, params).fetchone()[0]
+
+    def append(self, df):
+        """inserts rows whose id isn't in the store yet. returns the number of rows inserted"""
+        columns = [c for c in df.columns if c in COLUMN_TYPES]
+        placeholders = ", ".join("?" for _ in columns)
+        with self.rollup_delta(df["id"]):
+            before = self.conn.total_changes  # inside the block, so the rollup writes aren't counted
+            self.conn.executemany(
+                f"INSERT OR IGNORE INTO {self.table} ({', '.join(columns)}) VALUES ({placeholders})",
+                to_records(df[columns]))
+            inserted = self.conn.total_changes - before
+        self.conn.commit()
+        return inserted
+
+    def upsert(self, df, columns):
+        """sets columns for each row of df (matched on id), inserting rows that don't exist yet"""
+        columns = [c for c in columns if c != "id"]
+        all_columns = ["id"] + columns
+        placeholders = ", ".join("?" for _ in all_columns)
+        updates = ", ".join(f"{c} = excluded.{c}" for c in columns)
+        with self.rollup_delta(df["id"] if ROLLUP_SOURCE_COLUMNS.intersection(columns) else []):
+            self.conn.executemany(
+                f"INSERT INTO {self.table} ({', '.join(all_columns)}) VALUES ({placeholders}) "
+                f"ON CONFLICT(id) DO UPDATE SET {updates}",
+                to_records(df[all_columns]))
+        self.conn.commit()
+
+    def add_matches(self, df):
+        """records (id, search_term_name) matches. returns the number of new matches"""
+        with self.rollup_delta(df["id"]):
+            before = self.conn.total_changes
+            self.conn.executemany(
+                f"INSERT OR IGNORE INTO {self.match_table} (search_term, id) VALUES (?, ?)",
+                to_records(df[["search_term_name", "id"]]))
+            added = self.conn.total_changes - before
+        self.conn.commit()
+        return added
+
+    def read_matches(self, terms=None, ids=None):
+        """returns a (search_term, id) dataframe, optionally only for the given terms and/or ids"""
+        conditions = []
+        params = []
+        if terms is not None:
+            terms = list(terms)
+            conditions.append(f"search_term IN ({', '.join('?' for _ in terms)})")
+            params += terms
+        if ids is not None:
+            conditions.append("id IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps([str(i) for i in ids]))
+        sql = f"SELECT search_term, id FROM {self.match_table}"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def add_buckets(self, pairs):
+        """records (bucket id, submission id) pairs"""
+        self.conn.executemany(f"INSERT OR IGNORE INTO {self.bucket_table} (bucket, id) VALUES (?, ?)", pairs)
+        self.conn.commit()
+
+    def has_buckets(self):
+        return self.conn.execute(f"SELECT 1 FROM {self.bucket_table} LIMIT 1").fetchone() is not None
+
+    def read_bucket_members(self, buckets, columns=None):
+        """returns the rows recorded in any of the buckets"""
+        return self.read(columns, where=f"id IN (SELECT id FROM {self.bucket_table} "
+                                        "WHERE bucket IN (SELECT value FROM json_each(?)))",
+                         params=(json.dumps(sorted(buckets)),))
+
+    @contextmanager
+    def rollup_delta(self, ids):
+        """applies the rollup change made by the write in the block: the contributions the rows in ids had
+        before it are taken out and the ones they have after it are added"""
+        ids = [str(i) for i in ids]
+        if not self.rollups or not ids:
+            yield
+            return
+        old = self.rollup_contributions(ids)
+        yield
+        self.apply_rollup_delta(old, self.rollup_contributions(ids))
+
+    def rollup_contributions(self, ids):
+        """{(day, search_term, subreddit, label): [(id, score, num_comments)]} of the rows in ids"""
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS rollup_ids (id TEXT PRIMARY KEY)")
+        self.conn.execute("DELETE FROM rollup_ids")
+        self.conn.executemany("INSERT OR IGNORE INTO rollup_ids VALUES (?)", [(i,) for i in ids])
+        rows = self.conn.execute(f"""
+            WITH touched AS (
+                SELECT id, {DAY_SQL} AS day, COALESCE(subreddit, '') AS subreddit,
+                       COALESCE(cgpt_response, '') AS label, COALESCE(score, 0) AS score,
+                       COALESCE(num_comments, 0) AS num_comments
+                FROM {self.table}
+                WHERE id IN (SELECT id FROM rollup_ids) AND created_utc IS NOT NULL
+            )
+            SELECT day, '{ALL_TERMS}', subreddit, label, id, score, num_comments FROM touched
+            UNION ALL
+            SELECT t.day, m.search_term, t.subreddit, t.label, t.id, t.score, t.num_comments
+            FROM touched t JOIN {self.match_table} m ON m.id = t.id""")
+        contributions = {}
+        for day, search_term, subreddit, label, submission_id, score, num_comments in rows:
+            contributions.setdefault((day, search_term, subreddit, label), []).append(
+                (submission_id, score, num_comments))
+        return contributions
+
+    def apply_rollup_delta(self, old, new):
+        """updates the rollup rows of every key in old or new. counts and sums take the difference, top
+        lists drop the old pairs and merge in the new ones. when a pair drops out of a full top list and
+        what's left can't fill it, the pair that moves up is unknown and that list is re-read instead"""
+        for key in set(old) | set(new):
+            removed, added = old.get(key, []), new.get(key, [])
+            if sorted(removed) == sorted(added):
+                continue
+            row = self.conn.execute(
+                f"SELECT submissions, score_sum, comments_sum, top_by_score, top_by_comments FROM {self.rollup_table} "
+                "WHERE day = ? AND search_term = ? AND subreddit = ? AND label = ?", key).fetchone()
+            submissions, score_sum, comments_sum, top_by_score, top_by_comments = row or (0, 0, 0, None, None)
+            submissions += len(added) - len(removed)
+            score_sum += sum(r[1] for r in added) - sum(r[1] for r in removed)
+            comments_sum += sum(r[2] for r in added) - sum(r[2] for r in removed)
+            if submissions <= 0:
+                self.conn.execute(f"DELETE FROM {self.rollup_table} "
+                                  "WHERE day = ? AND search_term = ? AND subreddit = ? AND label = ?", key)
+                continue
+            removed_ids = {r[0] for r in removed}
+            tops = []
+            for top, value, column in [(top_by_score, 1, "score"), (top_by_comments, 2, "num_comments")]:
+                merged = merge_top(json.loads(top) if top else [], removed_ids, [[r[0], r[value]] for r in added])
+                if merged is None:
+                    merged = self.read_top(key, column)
+                tops.append(json.dumps(merged))
+            self.conn.execute(f"INSERT OR REPLACE INTO {self.rollup_table} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                              (*key, submissions, score_sum, comments_sum, *tops))
+
+    def read_top(self, key, column):
+        """the top ROLLUP_TOP_K [id, value] pairs of one rollup row, read from the rows of its day"""
+        day, search_term, subreddit, label = key
+        sql = (f"SELECT id, COALESCE({column}, 0) AS value FROM {self.table} WHERE {DAY_SQL} = ? "
+               "AND COALESCE(subreddit, '') = ? AND COALESCE(cgpt_response, '') = ?")
+        params = [day, subreddit, label]
+        if search_term != ALL_TERMS:
+            sql += f" AND id IN (SELECT id FROM {self.match_table} WHERE search_term = ?)"
+            params.append(search_term)
+        return [list(row) for row in self.conn.execute(f"{sql} ORDER BY value DESC LIMIT {ROLLUP_TOP_K}", params)]
+
+    def refresh_rollups(self, days=None):
+        """recomputes the rollup rows of the given "YYYY-MM-DD" days from the table (every day if None)
+        doesn't commit, callers commit together with the write that made the rollup stale"""
+        if not self.rollups:
+            return
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS rollup_days (day TEXT PRIMARY KEY)")
+        self.conn.execute("DELETE FROM rollup_days")
+        if days is None:
+            self.conn.execute(f"""
+                INSERT INTO rollup_days SELECT DISTINCT {DAY_SQL} FROM {self.table}
+                WHERE created_utc IS NOT NULL""")
+        else:
+            self.conn.executemany("INSERT OR IGNORE INTO rollup_days VALUES (?)", [(day,) for day in days])
+
+        self.conn.execute(f"DELETE FROM {self.rollup_table} WHERE day IN (SELECT day FROM rollup_days)")
+        self.conn.execute(f"""
+            INSERT INTO {self.rollup_table}
+            WITH days AS (
+                SELECT id, {DAY_SQL} AS day, COALESCE(subreddit, '') AS subreddit,
+                       COALESCE(cgpt_response, '') AS label, COALESCE(score, 0) AS score,
+                       COALESCE(num_comments, 0) AS num_comments
+                FROM {self.table}
+                WHERE {DAY_SQL} IN (SELECT day FROM rollup_days)
+            ), matched AS (
+                SELECT d.*, '{ALL_TERMS}' AS search_term FROM days d
+                UNION ALL
+                SELECT d.*, m.search_term FROM days d JOIN {self.match_table} m ON m.id = d.id
+            ), ranked AS (
+                SELECT *,
+                    ROW_NUMBER() OVER (PARTITION BY day, search_term, subreddit, label ORDER BY score DESC) AS score_rank,
+                    ROW_NUMBER() OVER (PARTITION BY day, search_term, subreddit, label ORDER BY num_comments DESC) AS comments_rank
+                FROM matched
+            )
+            SELECT day, search_term, subreddit, label, COUNT(*), SUM(score), SUM(num_comments),
+                   json_group_array(json_array(id, score)) FILTER (WHERE score_rank <= {ROLLUP_TOP_K}),
+                   json_group_array(json_array(id, num_comments)) FILTER (WHERE comments_rank <= {ROLLUP_TOP_K})
+            FROM ranked
+            GROUP BY day, search_term, subreddit, label""")
+
+    def read_rollup(self, search_term=ALL_TERMS, start_date=None, end_date=None, labels=None):
+        """returns the rollup rows for one search term ("*" = all submissions once each)
+        start_date/end_date are "YYYY-MM-DD" (end exclusive), labels limits it to those label values"""
+        conditions = ["search_term = ?"]
+        params = [search_term]
+        if start_date:
+            conditions.append("day >= ?")
+            params.append(start_date)
+        if end_date:
+            conditions.append("day < ?")
+            params.append(end_date)
+        if labels is not None:
+            labels = list(labels)
+            conditions.append(f"label IN ({', '.join('?' for _ in labels)})")
+            params += labels
+        return pd.read_sql_query(
+            f"SELECT * FROM {self.rollup_table} WHERE {' AND '.join(conditions)} ORDER BY day",
+            self.conn, params=params)
+
+    def read(self, columns=None, start_date=None, end_date=None, where=None, params=()):
+        """returns a dataframe with only the requested columns and rows
+        start_date/end_date are utc "YYYY-MM-DD" strings (end is exclusive), where is extra sql"""
+        conditions = []
+        date_params = []
+        if start_date:
+            conditions.append("created_utc >= ?")
+            date_params.append(date_to_utc(start_date))
+        if end_date:
+            conditions.append("created_utc < ?")
+            date_params.append(date_to_utc(end_date))
+        if where:
+            conditions.append(f"({where})")
+        sql = f"SELECT {', '.join(columns) if columns else '*'} FROM {self.table}"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return pd.read_sql_query(sql, self.conn, params=date_params + list(params))
+
+    def import_csv(self, csv_path, transform=None, chunksize=50_000):
+        """one-off migration of an existing csv into the store
+        transform is applied to each chunk before it's appended"""
+        total = 0
+        for chunk in pd.read_csv(csv_path, dtype={"id": str, "cluster_id": str}, chunksize=chunksize):
+            if transform is not None:
+                chunk = transform(chunk)
+            total += self.append(chunk)
+        return total
+
+    def export_csv(self, csv_path, columns=None):
+        self.read(columns).to_csv(csv_path, index=False)
+
+
+def merge_top(top, removed_ids, added):
+    """the top ROLLUP_TOP_K [id, value] pairs after taking removed_ids out of top and adding added
+    returns None when a pair left a full list and the merged pairs can't show what replaces it: rows
+    outside the list are only known to be <= its lowest value"""
+    kept = [pair for pair in top if pair[0] not in removed_ids]
+    merged = sorted(kept + added, key=lambda pair: pair[1], reverse=True)[:ROLLUP_TOP_K]
+    if len(top) >= ROLLUP_TOP_K and len(kept) < len(top):
+        floor = min(pair[1] for pair in top)
+        if sum(pair[1] >= floor for pair in merged) < ROLLUP_TOP_K:
+            return None
+    return merged
+
+
+def date_to_utc(date_str):
+    date = datetime.datetime.strptime(date_str, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
+
+
+def to_records(df):
+    """rows as tuples of values sqlite can store, with NaN/NA as None"""
+    values = df.astype(object).where(df.notna(), None)
+    return [tuple(to_sqlite_value(v) for v in row) for row in values.itertuples(index=False, name=None)]
+
+
+def to_sqlite_value(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if hasattr(value, "item"):  # numpy scalars
+        return value.item()
+    return value
@@ -0,0 +1,194 @@
+import re
+import zlib
+import hashlib
+from collections import Counter
+from urllib.parse import urlsplit, parse_qsl, urlencode
+import numpy as np
+import pandas as pd
+
+
+"""
+near-duplicate clustering for submissions
+crossposts and reposts of the same story get the same cluster id when either
+ - their normalized urls match, or
+ - their titles have an estimated jaccard similarity >= SIMILARITY_THRESHOLD
+   (minhash over character shingles, with lsh banding to find candidates)
+the cluster id is the id of the first submission seen in the cluster (its representative)
+blank / missing titles aren't banded (they'd all hash the same), so they only cluster on their url
+assign_clusters_in_store() keeps the lsh buckets of a DatasetStore's rows in the store, so new rows are only
+compared with the stored rows that share a bucket or url with them instead of re-clustering the whole dataset
+"""
+
+
+NUM_PERM = 128
+NUM_BANDS = 16  # 16 bands x 8 rows -> candidates start showing up around 0.7 similarity
+ROWS_PER_BAND = NUM_PERM // NUM_BANDS
+SHINGLE_SIZE = 5
+SIMILARITY_THRESHOLD = 0.7
+MERSENNE_PRIME = (1 << 61) - 1
+TRACKING_PARAMS = ("utm_", "fbclid", "gclid", "ref", "cmpid", "smid")
+
+_rng = np.random.RandomState(42)
+PERM_A = _rng.randint(1, 1 << 31, size=NUM_PERM, dtype=np.uint64)
+PERM_B = _rng.randint(0, 1 << 31, size=NUM_PERM, dtype=np.uint64)
+
+
+def normalize_title(title):
+    title = str(title).lower()
+    title = re.sub(r"[^\w\s]", " ", title)
+    return " ".join(title.split())
+
+
+def is_blank_title(title):
+    return not isinstance(title, str) or not normalize_title(title)
+
+
+def normalize_url(url):
+    """strips scheme, www, tracking params, fragments and trailing slashes
+    returns None for reddit self posts / reddit links, which say nothing about the story"""
+    if not isinstance(url, str) or not url:
+        return None
+    parts = urlsplit(url.strip().lower())
+    host = parts.netloc
+    if host.startswith("www."):
+        host = host[4:]
+    if not host or host.endswith("reddit.com") or host == "redd.it":
+        return None
+    query = [(k, v) for k, v in parse_qsl(parts.query) if not k.startswith(TRACKING_PARAMS)]
+    path = parts.path.rstrip("/")
+    return host + path + ("?" + urlencode(query) if query else "")
+
+
+def shingle_hashes(title):
+    text = normalize_title(title)
+    if len(text) <= SHINGLE_SIZE:
+        shingles = {text}
+    else:
+        shingles = {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+    return np.array([zlib.crc32(s.encode("utf-8")) for s in shingles], dtype=np.uint64)
+
+
+def minhash_signature(title):
+    hashes = shingle_hashes(title)
+    # (a * x + b) mod p for every permutation/shingle pair, then min over shingles
+    permuted = (np.outer(PERM_A, hashes) + PERM_B[:, None]) % MERSENNE_PRIME
+    return permuted.min(axis=1)
+
+
+class NearDuplicateIndex:
+    def __init__(self):
+        self.buckets = {}  # (band, band signature bytes) -> [submission ids]
+        self.urls = {}  # normalized url -> cluster id
+        self.signatures = {}  # submission id -> minhash signature
+        self.clusters = {}  # submission id -> cluster id
+
+    def find_cluster(self, signature, url):
+        if url and url in self.urls:
+            return self.urls[url]
+        if signature is None:
+            return None
+        for band, key in self.band_keys(signature):
+            for other_id in self.buckets.get((band, key), []):
+                similarity = np.mean(self.signatures[other_id] == signature)
+                if similarity >= SIMILARITY_THRESHOLD:
+                    return self.clusters[other_id]
+        return None
+
+    def add(self, submission_id, title, url=None, cluster_id=None, signature=None):
+        """indexes a submission and returns its cluster id
+        pass cluster_id to re-index a submission whose cluster is already known
+        and signature when the title's minhash was already computed"""
+        if signature is None and not is_blank_title(title):
+            signature = minhash_signature(title)
+        url = normalize_url(url)
+        if cluster_id is None:
+            cluster_id = self.find_cluster(signature, url) or submission_id
+        self.clusters[submission_id] = cluster_id
+        if signature is not None:
+            self.signatures[submission_id] = signature
+            for band_key in self.band_keys(signature):
+                self.buckets.setdefault(band_key, []).append(submission_id)
+        if url:
+            self.urls.setdefault(url, cluster_id)
+        return cluster_id
+
+    @staticmethod
+    def band_keys(signature):
+        for band in range(NUM_BANDS):
+            rows = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+            yield band, rows.tobytes()
+
+
+def assign_clusters(df):
+    """fills the cluster_id column of a submission dataframe (id, title, url)
+    rows that already have a cluster_id keep it and are indexed first, so new rows join existing clusters"""
+    if "cluster_id" not in df.columns:
+        df["cluster_id"] = pd.NA
+    index = NearDuplicateIndex()
+    known = df["cluster_id"].notna()
+    for row in df[known].itertuples():
+        index.add(row.id, row.title, getattr(row, "url", None), cluster_id=row.cluster_id)
+    new_ids = []
+    for row in df[~known].itertuples():
+        new_ids.append(index.add(row.id, row.title, getattr(row, "url", None)))
+    df.loc[~known, "cluster_id"] = new_ids
+    return df
+
+
+def bucket_ids(signature, url):
+    """64 bit ids of the lsh buckets of a signature (None for a blank title) and of its normalized url,
+    as stored in a DatasetStore. two rows that could cluster share at least one"""
+    keys = [] if signature is None else [bytes([band]) + key for band, key in NearDuplicateIndex.band_keys(signature)]
+    if url:
+        keys.append(bytes([NUM_BANDS]) + url.encode("utf-8"))
+    return [int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big", signed=True) for key in keys]
+
+
+def assign_clusters_in_store(store, df):
+    """fills the cluster_id column of new submissions (id, title, url) against the clusters of a DatasetStore
+    and records their buckets in it, append them to the store afterwards
+    only the stored rows sharing a bucket with a new row are read (and re-hashed)"""
+    if store.count() and not store.has_buckets():
+        # store from before buckets were kept, index it once
+        existing = store.read(["id", "title", "url"])
+        store.add_buckets(row_buckets(existing, minhash_signatures(existing)))
+    signatures = minhash_signatures(df)
+    buckets = row_buckets(df, signatures)
+    index = NearDuplicateIndex()
+    candidates = store.read_bucket_members({bucket for bucket, _ in buckets}, ["id", "title", "url", "cluster_id"])
+    for row in candidates.itertuples():
+        index.add(row.id, row.title, row.url, cluster_id=row.cluster_id if isinstance(row.cluster_id, str) else row.id)
+    df["cluster_id"] = [index.add(row.id, row.title, getattr(row, "url", None), signature=signature)
+                        for row, signature in zip(df.itertuples(), signatures)]
+    store.add_buckets(buckets)
+    return df
+
+
+def minhash_signatures(df):
+    return [None if is_blank_title(title) else minhash_signature(title) for title in df["title"]]
+
+
+def row_buckets(df, signatures):
+    """(bucket id, submission id) pairs of a dataframe's rows"""
+    urls = df["url"] if "url" in df.columns else [None] * len(df)
+    return [(bucket, submission_id) for submission_id, signature, url in zip(df["id"], signatures, urls)
+            for bucket in bucket_ids(signature, normalize_url(url))]
+
+
+def report_clusters(df):
+    """prints the cluster size distribution"""
+    sizes = df.groupby("cluster_id").size()
+    distribution = Counter(sizes.tolist())
+    print(f"{len(df)} submissions in {len(sizes)} clusters")
+    for size in sorted(distribution):
+        print(f"  clusters of size {size}: {distribution[size]}")
+
+
+def copy_labels_to_clusters(df, column):
+    """fills missing values of column from the first labeled member of the same cluster
+    returns the number of rows that were filled"""
+    labeled = df[df[column].notna()].drop_duplicates("cluster_id")
+    cluster_labels = dict(zip(labeled["cluster_id"], labeled[column]))
+    missing = df[column].isna()
+    df.loc[missing, column] = df.loc[missing, "cluster_id"].map(cluster_labels)
+    return int(missing.sum() - df[column].isna().sum())
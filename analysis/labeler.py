@@ -0,0 +1,317 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import openai
+from cgpt import async_prompt_response, cache_stats, make_messages, MODEL
+
+
+"""
+concurrent labeling engine for cgpt classification
+ - up to MAX_CONCURRENCY requests in flight at once
+ - rate limit / transient errors are retried with backoff (honouring retry-after when given). a rate limit
+   pauses every in-flight task until the backoff has passed
+ - every response is appended to a jsonl store and fsynced, so a crash loses at most the
+   requests that were in flight. re-running skips ids that are already in the store
+ - the caller merges the store back into its dataset in one pass at the end
+
+batch mode packs BATCH_SIZE titles into one request so the system prompt is paid once per batch
+instead of once per title. batches can also be written to / read from offline batch job files
+
+the openai client reads OPENAI_BASE_URL, so this can be run against a local fake
+of the chat completions endpoint
+"""
+
+
+MAX_CONCURRENCY = 8
+BATCH_SIZE = 20  # titles per request in batch mode
+MAX_RETRIES = 6
+MAX_BACKOFF = 60  # seconds
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+
+class LabelStore:
+    """append-only jsonl file of {"id", "response", "tokens"} records"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "a", encoding="utf-8")
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+    def append(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+
+def load_labels(path):
+    """returns {id: response} from a label store. a partially written last line
+    (from a crash mid-write) is ignored"""
+    labels = {}
+    if not os.path.isfile(path):
+        return labels
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(f"Skipping malformed line in {path}")
+                continue
+            labels[record["id"]] = record["response"]
+    return labels
+
+
+def retry_delay(error, attempt):
+    """seconds to wait before retrying. uses the retry-after header on rate limit errors"""
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return min(MAX_BACKOFF, 2 ** attempt) + random.random()
+
+
+async def wait_for_backoff(stats):
+    """waits until the rate limit backoff any task of this run set has passed"""
+    while (delay := stats["backoff_until"] - time.time()) > 0:
+        await asyncio.sleep(delay)
+
+
+async def request_with_retries(label, prompt, stats, prompt_func, **kwargs):
+    """returns (response, tokens), or None if the request failed for good"""
+    for attempt in range(MAX_RETRIES):
+        await wait_for_backoff(stats)
+        try:
+            return await prompt_func(prompt, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RETRIES - 1:
+                break
+            delay = retry_delay(e, attempt)
+            stats["retries"] += 1
+            logging.warning(
+                f"{type(e).__name__} for {label}, retrying in {delay:.1f}s")
+            if isinstance(e, openai.RateLimitError):
+                # the rate limit is shared, so every task holds off, not just the one that hit it
+                stats["backoff_until"] = max(stats["backoff_until"], time.time() + delay)
+            else:
+                await asyncio.sleep(delay)
+        except Exception as e:
+            print(f"Error for {label}: {e}")
+            return None
+    print(f"Giving up on {label} after {MAX_RETRIES} attempts")
+    return None
+
+
+async def label_one(item_id, prompt, semaphore, store, stats, prompt_func):
+    async with semaphore:
+        result = await request_with_retries(f"ID {item_id}", prompt, stats, prompt_func)
+    if result is None:
+        stats["failed"] += 1
+        return
+    response, tokens = result
+    stats["requests"] += 1
+    store.append({"id": item_id, "response": response, "tokens": tokens})
+    stats["labeled"] += 1
+    stats["tokens"] += tokens
+    print(f"{response}: {item_id}")
+
+
+async def label_items(items, store_path, concurrency=MAX_CONCURRENCY, prompt_func=async_prompt_response):
+    """items is a list of (id, prompt). ids already in the store are skipped"""
+    done = load_labels(store_path)
+    todo = [(item_id, prompt) for item_id, prompt in items if item_id not in done]
+    print(f"{len(items) - len(todo)} already labeled, {len(todo)} to label...")
+
+    stats = new_stats("single")
+    semaphore = asyncio.Semaphore(concurrency)
+    with LabelStore(store_path) as store:
+        await asyncio.gather(*(
+            label_one(item_id, prompt, semaphore, store, stats, prompt_func)
+            for item_id, prompt in todo
+        ))
+    stats["seconds"] = time.time() - stats["start"]
+    report_stats(stats)
+    return stats
+
+
+def run_labeling(items, store_path, concurrency=MAX_CONCURRENCY, prompt_func=async_prompt_response):
+    return asyncio.run(label_items(items, store_path, concurrency, prompt_func))
+
+
+def build_batch_prompt(batch_template, titles):
+    lines = [f"{i}. {' '.join(str(title).split())}" for i, title in enumerate(titles, start=1)]
+    return batch_template.format(submission_titles="\n".join(lines)).strip()
+
+
+def parse_batch_response(response, num_items, valid_labels=None):
+    """parses a batch reply of the form {"1": label, "2": label, ...}
+    returns {item index (0-based): label} for every entry that lines up with an input
+    and is a valid label. anything else is left out so it can be retried on its own"""
+    try:
+        parsed = json.loads(response)
+    except (json.JSONDecodeError, TypeError):
+        return {}
+    if not isinstance(parsed, dict):
+        return {}
+    labels = {}
+    for key, value in parsed.items():
+        try:
+            index = int(key) - 1
+        except ValueError:
+            continue
+        label = str(value).strip()
+        if not 0 <= index < num_items:
+            continue
+        if valid_labels is not None and label not in valid_labels:
+            continue
+        labels[index] = label
+    return labels
+
+
+def store_batch_labels(store, stats, batch, labels, tokens):
+    """appends parsed batch labels to the store and returns the items that are missing"""
+    per_label_tokens = round(tokens / len(labels), 1) if labels else 0
+    missing = []
+    for i, (item_id, title) in enumerate(batch):
+        if i not in labels:
+            missing.append((item_id, title))
+            continue
+        store.append({"id": item_id, "response": labels[i], "tokens": per_label_tokens})
+        stats["labeled"] += 1
+        print(f"{labels[i]}: {item_id}")
+    stats["tokens"] += tokens
+    return missing
+
+
+async def label_batch(batch, semaphore, store, stats, prompt_func, batch_template, valid_labels):
+    """labels a list of (id, title) with one request. returns the items that weren't labeled"""
+    prompt = build_batch_prompt(batch_template, [title for _, title in batch])
+    async with semaphore:
+        result = await request_with_retries(
+            f"batch starting with ID {batch[0][0]}", prompt, stats, prompt_func, json_mode=True)
+    if result is None:
+        return batch
+    response, tokens = result
+    stats["requests"] += 1
+    labels = parse_batch_response(response, len(batch), valid_labels)
+    return store_batch_labels(store, stats, batch, labels, tokens)
+
+
+async def label_items_batched(items, store_path, batch_template, single_template, batch_size=BATCH_SIZE,
+                              concurrency=MAX_CONCURRENCY, valid_labels=None, prompt_func=async_prompt_response):
+    """items is a list of (id, title). titles are packed batch_size at a time into batch_template,
+    anything missing or invalid in a batch reply is retried one by one with single_template
+    ({submission_title} placeholder)"""
+    done = load_labels(store_path)
+    todo = [(item_id, title) for item_id, title in items if item_id not in done]
+    print(f"{len(items) - len(todo)} already labeled, {len(todo)} to label in batches of {batch_size}...")
+
+    stats = new_stats("batch")
+    semaphore = asyncio.Semaphore(concurrency)
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+    with LabelStore(store_path) as store:
+        results = await asyncio.gather(*(
+            label_batch(batch, semaphore, store, stats, prompt_func, batch_template, valid_labels)
+            for batch in batches
+        ))
+    stats["seconds"] = time.time() - stats["start"]
+    report_stats(stats)
+
+    missing = [item for batch_missing in results for item in batch_missing]
+    if missing:
+        print(f"{len(missing)} items missing from batch replies, retrying one by one...")
+        single_items = [
+            (item_id, single_template.format(submission_title=title).strip())
+            for item_id, title in missing
+        ]
+        await label_items(single_items, store_path, concurrency, prompt_func)
+    return stats
+
+
+def run_batched_labeling(items, store_path, batch_template, single_template, batch_size=BATCH_SIZE,
+                         concurrency=MAX_CONCURRENCY, valid_labels=None, prompt_func=async_prompt_response):
+    return asyncio.run(label_items_batched(
+        items, store_path, batch_template, single_template, batch_size, concurrency, valid_labels, prompt_func))
+
+
+def write_batch_file(items, path, batch_template, batch_size=BATCH_SIZE):
+    """writes (id, title) items as an offline batch job jsonl file (openai batch api format)
+    the ids in each request are stored in its custom_id"""
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(0, len(items), batch_size):
+            batch = items[i:i + batch_size]
+            prompt = build_batch_prompt(batch_template, [title for _, title in batch])
+            request = {
+                "custom_id": ",".join(item_id for item_id, _ in batch),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": MODEL,
+                    "messages": make_messages(prompt),
+                    "response_format": {"type": "json_object"},
+                },
+            }
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+    print(f"Wrote {len(items)} items in {-(-len(items) // batch_size)} requests to {path}")
+
+
+def ingest_batch_results(results_path, store_path, valid_labels=None):
+    """reads an offline batch job output file into the label store
+    returns the ids that didn't get a valid label so they can be labeled normally"""
+    stats = new_stats("offline batch")
+    missing = []
+    with open(results_path, encoding="utf-8") as f, LabelStore(store_path) as store:
+        for line in f:
+            result = json.loads(line)
+            ids = result["custom_id"].split(",")
+            batch = [(item_id, None) for item_id in ids]
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200:
+                missing.extend(ids)
+                continue
+            body = response["body"]
+            reply = body["choices"][0]["message"]["content"]
+            tokens = body.get("usage", {}).get("total_tokens", 0)
+            stats["requests"] += 1
+            labels = parse_batch_response(reply, len(ids), valid_labels)
+            missing.extend(item_id for item_id, _ in store_batch_labels(store, stats, batch, labels, tokens))
+    stats["failed"] = len(missing)
+    stats["seconds"] = time.time() - stats["start"]
+    report_stats(stats)
+    return missing
+
+
+def new_stats(mode):
+    """per run counters, plus backoff_until, which every task of the run waits on before sending"""
+    return {"mode": mode, "labeled": 0, "failed": 0, "retries": 0,
+            "requests": 0, "tokens": 0, "start": time.time(), "backoff_until": 0}
+
+
+def report_stats(stats):
+    minutes = stats["seconds"] / 60
+    per_minute = stats["labeled"] / minutes if minutes else 0
+    tokens_per_label = stats["tokens"] / stats["labeled"] if stats["labeled"] else 0
+    print(
+        f"[{stats['mode']}] Labeled {stats['labeled']} with {stats['requests']} requests "
+        f"({stats['failed']} failed, {stats['retries']} retries) in {stats['seconds']:.1f}s: "
+        f"{per_minute:.1f} labels/min, {stats['tokens']} tokens, {tokens_per_label:.1f} tokens/label")
+    cache = cache_stats()
+    print(
+        f"Response cache: {cache['hits']} hits, {cache['misses']} misses "
+        f"({cache['hit_rate']:.0%}), {cache['entries']} entries, {cache['bytes']} bytes")
@@ -0,0 +1,62 @@
+import os
+import json
+import time
+
+
+"""
+small stage runner for incremental analysis refreshes
+each stage is a function that takes its own persisted state dict (e.g. a "watermark" of the last
+created_utc or id it processed) and returns an output value that downstream stages depend on
+ - a stage is skipped when the outputs of the stages it depends on haven't changed since it last ran
+ - a stage with min_interval is skipped until that many seconds have passed since it last ran
+ - a stage can set state["retry"] = True to be re-run next time even if its inputs are unchanged
+ - runtimes are recorded for every stage and printed by report()
+state is saved to a json file after every stage, so a failed run resumes from the failed stage
+"""
+
+
+class Pipeline:
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.state = {}
+        if os.path.isfile(state_file):
+            with open(state_file, encoding="utf-8") as f:
+                self.state = json.load(f)
+        self.timings = []
+
+    def run_stage(self, name, func, inputs=(), min_interval=None):
+        stage = self.state.setdefault(name, {})
+        fingerprint = [self.state.get(i, {}).get("output") for i in inputs]
+        now = time.time()
+
+        if min_interval is not None and now - stage.get("last_run", 0) < min_interval:
+            self.timings.append((name, "skipped (ran recently)", 0))
+            return stage.get("output")
+        if inputs and stage.get("fingerprint") == fingerprint and not stage.get("retry"):
+            self.timings.append((name, "skipped (inputs unchanged)", 0))
+            return stage.get("output")
+
+        stage["retry"] = False
+        start = time.time()
+        output = func(stage)
+        runtime = time.time() - start
+
+        stage["output"] = output
+        stage["fingerprint"] = fingerprint
+        stage["last_run"] = now
+        stage["runtime"] = runtime
+        self.save()
+        self.timings.append((name, "ran", runtime))
+        return output
+
+    def save(self):
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_file, self.state_file)
+
+    def report(self):
+        total = sum(runtime for _, _, runtime in self.timings)
+        for name, status, runtime in self.timings:
+            print(f"{name}: {status} {runtime:.2f}s")
+        print(f"pipeline finished in {total:.2f}s")
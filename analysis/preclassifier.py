@@ -0,0 +1,245 @@
+import os
+import re
+import zlib
+import numpy as np
+
+
+"""
+local title classifier that screens submissions before they go to the llm
+ - features are hashed word 1-2 grams and character 4-grams
+ - the model is a softmax regression trained with minibatch sgd in numpy
+ - every id whose hash lands in HOLDOUT_FRACTION is held out, half of it for calibration and half
+   for evaluation. the temperature and the confidence threshold are fit on the calibration half:
+   the threshold is the lowest one whose accuracy has a wilson lower bound of at least
+   TARGET_ACCURACY, so a handful of lucky titles can't set it. the reported accuracy comes from
+   the evaluation half, which played no part in choosing them
+ - only titles above the threshold are auto-labeled, everything else still goes to the llm
+ - update_preclassifier() trains on newly labeled rows only, so the model improves as labels arrive.
+   a label added to the project gets a new output column, a removed one means training from scratch
+"""
+
+
+NUM_FEATURES = 1 << 18
+HOLDOUT_FRACTION = 0.2
+TARGET_ACCURACY = 0.97  # held-out accuracy required on auto-labeled titles
+WILSON_Z = 1.96  # 95% confidence for the lower bound on that accuracy
+MIN_TRAINING_LABELS = 500  # don't auto-label anything until we have this many labels
+EPOCHS = 5
+UPDATE_EPOCHS = 2
+BATCH_SIZE = 64
+LEARNING_RATE = 0.5
+L2 = 1e-6
+
+
+def title_features(title):
+    """returns hashed feature indices for a title (values are 1 / sqrt(n))"""
+    text = " ".join(re.sub(r"[^\w\s]", " ", str(title).lower()).split())
+    words = text.split()
+    grams = [f"w:{w}" for w in words]
+    grams += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+    grams += [f"c:{text[i:i + 4]}" for i in range(max(len(text) - 3, 0))]
+    return np.array([zlib.crc32(g.encode("utf-8")) % NUM_FEATURES for g in grams] or [0], dtype=np.int64)
+
+
+def is_holdout(submission_id):
+    return zlib.crc32(str(submission_id).encode("utf-8")) % 100 < HOLDOUT_FRACTION * 100
+
+
+def is_calibration(submission_id):
+    """the half of the held-out ids the temperature and threshold are fit on"""
+    return zlib.crc32(str(submission_id).encode("utf-8")) % 100 < HOLDOUT_FRACTION * 50
+
+
+def wilson_lower_bound(correct, total, z=WILSON_Z):
+    if not total:
+        return 0.0
+    p = correct / total
+    center = p + z * z / (2 * total)
+    margin = z * np.sqrt(p * (1 - p) / total + z * z / (4 * total * total))
+    return float((center - margin) / (1 + z * z / total))
+
+
+def flatten(feature_lists):
+    """turns a list of feature index arrays into (row index, feature index, value) arrays"""
+    rows = np.concatenate([np.full(len(f), i) for i, f in enumerate(feature_lists)])
+    cols = np.concatenate(feature_lists)
+    vals = np.concatenate([np.full(len(f), 1 / np.sqrt(len(f))) for f in feature_lists])
+    return rows, cols, vals
+
+
+def softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class PreClassifier:
+    def __init__(self, classes):
+        self.classes = list(classes)
+        self.weights = np.zeros((NUM_FEATURES, len(self.classes)))
+        self.bias = np.zeros(len(self.classes))
+        self.temperature = 1.0
+        self.threshold = None  # None -> not confident enough to auto-label anything
+        self.num_trained = 0
+
+    def add_classes(self, classes):
+        """adds a zero weight column for every class the model doesn't have yet"""
+        new = [c for c in classes if c not in self.classes]
+        if new:
+            self.classes += new
+            self.weights = np.hstack([self.weights, np.zeros((NUM_FEATURES, len(new)))])
+            self.bias = np.concatenate([self.bias, np.zeros(len(new))])
+
+    def logits(self, feature_lists):
+        rows, cols, vals = flatten(feature_lists)
+        logits = np.tile(self.bias, (len(feature_lists), 1))
+        np.add.at(logits, rows, self.weights[cols] * vals[:, None])
+        return logits
+
+    def predict_proba(self, titles):
+        if not len(titles):
+            return np.zeros((0, len(self.classes)))
+        return softmax(self.logits([title_features(t) for t in titles]) / self.temperature)
+
+    def fit(self, titles, labels, epochs=EPOCHS, seed=0):
+        """minibatch sgd on (title, label) pairs. calling it again continues from the current weights"""
+        features = [title_features(t) for t in titles]
+        targets = np.array([self.classes.index(str(label)) for label in labels])
+        rng = np.random.RandomState(seed)
+        for _ in range(epochs):
+            order = rng.permutation(len(features))
+            for start in range(0, len(order), BATCH_SIZE):
+                batch = order[start:start + BATCH_SIZE]
+                batch_features = [features[i] for i in batch]
+                probs = softmax(self.logits(batch_features))
+                probs[np.arange(len(batch)), targets[batch]] -= 1  # gradient of cross entropy
+                rows, cols, vals = flatten(batch_features)
+                grad = probs[rows] * vals[:, None] / len(batch)
+                self.weights *= 1 - LEARNING_RATE * L2
+                np.add.at(self.weights, cols, -LEARNING_RATE * grad)
+                self.bias -= LEARNING_RATE * probs.mean(axis=0)
+        self.num_trained += len(features)
+
+    def calibrate(self, titles, labels, eval_titles, eval_labels):
+        """fits the temperature and confidence threshold on one held-out split and returns a report
+        measured on the other"""
+        if not len(titles):
+            return {}
+        targets = np.array([self.classes.index(str(label)) for label in labels])
+        logits = self.logits([title_features(t) for t in titles])
+        best_nll = None
+        for temperature in np.linspace(0.1, 5, 50):
+            probs = softmax(logits / temperature)
+            nll = -np.log(probs[np.arange(len(targets)), targets] + 1e-12).mean()
+            if best_nll is None or nll < best_nll:
+                best_nll, self.temperature = nll, temperature
+
+        probs = softmax(logits / self.temperature)
+        confidence = probs.max(axis=1)
+        correct = probs.argmax(axis=1) == targets
+        self.threshold = None
+        if self.num_trained >= MIN_TRAINING_LABELS:
+            for threshold in np.arange(0.5, 1.0, 0.01):
+                confident = confidence >= threshold
+                if wilson_lower_bound(correct[confident].sum(), confident.sum()) >= TARGET_ACCURACY:
+                    self.threshold = float(threshold)
+                    break
+
+        if not len(eval_titles):
+            return {}
+        targets = np.array([self.classes.index(str(label)) for label in eval_labels])
+        probs = self.predict_proba(eval_titles)
+        confidence = probs.max(axis=1)
+        correct = probs.argmax(axis=1) == targets
+        confident = confidence >= self.threshold if self.threshold else np.zeros(len(targets), bool)
+        return {
+            "calibration_size": len(titles),
+            "evaluation_size": len(targets),
+            "accuracy": float(correct.mean()),
+            "ece": expected_calibration_error(confidence, correct),
+            "temperature": float(self.temperature),
+            "threshold": self.threshold,
+            "coverage": float(confident.mean()),
+            "confident_accuracy": float(correct[confident].mean()) if confident.any() else None,
+        }
+
+    def predict_confident(self, titles):
+        """returns a list of labels, with None wherever the model isn't confident"""
+        if self.threshold is None:
+            return [None] * len(titles)
+        probs = self.predict_proba(titles)
+        labels = []
+        for p in probs:
+            labels.append(self.classes[p.argmax()] if p.max() >= self.threshold else None)
+        return labels
+
+    def save(self, path):
+        np.savez_compressed(path, weights=self.weights, bias=self.bias, classes=np.array(self.classes),
+                            temperature=self.temperature, num_trained=self.num_trained,
+                            threshold=np.nan if self.threshold is None else self.threshold)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        model = cls([str(c) for c in data["classes"]])
+        model.weights = data["weights"]
+        model.bias = data["bias"]
+        model.temperature = float(data["temperature"])
+        model.num_trained = int(data["num_trained"])
+        threshold = float(data["threshold"])
+        model.threshold = None if np.isnan(threshold) else threshold
+        return model
+
+
+def expected_calibration_error(confidence, correct, bins=10):
+    edges = np.linspace(0, 1, bins + 1)
+    ece = 0.0
+    for low, high in zip(edges[:-1], edges[1:]):
+        in_bin = (confidence > low) & (confidence <= high)
+        if in_bin.any():
+            ece += in_bin.mean() * abs(confidence[in_bin].mean() - correct[in_bin].mean())
+    return float(ece)
+
+
+def update_preclassifier(model_path, trained_ids_path, ids, titles, labels, classes):
+    """trains on any labeled (id, title, label) rows the model hasn't seen yet, recalibrates on the
+    held-out split, saves the model and prints a report. returns the model"""
+    classes = [str(c) for c in classes]
+    model = PreClassifier.load(model_path) if os.path.isfile(model_path) else None
+    epochs = UPDATE_EPOCHS
+    if model is not None and not set(model.classes) <= set(classes):
+        # a removed label's column would keep being predicted, start over
+        print(f"Pre-classifier classes changed from {model.classes} to {classes}, retraining from scratch...")
+        model = None
+        if os.path.isfile(trained_ids_path):
+            os.remove(trained_ids_path)
+    if model is None:
+        model = PreClassifier(classes)
+        epochs = EPOCHS
+    model.add_classes(classes)
+    trained_ids = set()
+    if os.path.isfile(trained_ids_path):
+        with open(trained_ids_path, encoding="utf-8") as f:
+            trained_ids = set(f.read().split())
+
+    holdout = np.array([is_holdout(i) for i in ids], dtype=bool)
+    new = np.array([i not in trained_ids for i in ids], dtype=bool) & ~holdout
+    titles, labels, ids = np.asarray(titles, dtype=object), np.asarray(labels, dtype=object), np.asarray(ids)
+    if new.any():
+        print(f"Training pre-classifier on {int(new.sum())} new labels...")
+        model.fit(titles[new], labels[new], epochs=epochs)
+        with open(trained_ids_path, "a", encoding="utf-8") as f:
+            f.write("\n".join(ids[new]) + "\n")
+
+    calibration = holdout & np.array([is_calibration(i) for i in ids], dtype=bool)
+    evaluation = holdout & ~calibration
+    report = model.calibrate(titles[calibration], labels[calibration], titles[evaluation], labels[evaluation])
+    model.save(model_path)
+    if report:
+        confident_accuracy = report["confident_accuracy"]
+        print(
+            f"Pre-classifier ({model.num_trained} trained labels, calibrated on {report['calibration_size']}): "
+            f"held-out accuracy {report['accuracy']:.3f} on {report['evaluation_size']}, ECE {report['ece']:.3f}, temperature {report['temperature']:.2f}, "
+            f"threshold {report['threshold']}, coverage {report['coverage']:.1%}, "
+            f"accuracy when confident {'n/a' if confident_accuracy is None else f'{confident_accuracy:.3f}'}")
+    return model
@@ -0,0 +1,510 @@
+import os
+import glob
+import json
+import itertools
+import time
+import datetime
+import pandas as pd
+from analysis.dedupe import assign_clusters, assign_clusters_in_store, report_clusters, copy_labels_to_clusters
+from analysis.preclassifier import update_preclassifier
+from analysis.pipeline import Pipeline
+from analysis.dataset_store import DatasetStore, COLUMN_TYPES
+from analysis.labeler import run_labeling, run_batched_labeling, load_labels, write_batch_file, ingest_batch_results
+from analysis.analyse import load_rollup_frame, load_top_submission_candidates, save_submissions_per_day, save_num_comments_per_day, save_score_per_day, save_top_submissions, get_top_subreddits_by_total_comments, get_top_subreddits_by_submission_count
+from vsm import getcursor
+from json_columns import select_columns_sql
+from tracing import span
+from async_ingest import update_selected_submission_stats
+
+
+"""
+analysis projects over one shared submission cache
+a project is a directory analysis/<name>/ with a project.json config (see Project) and its prompt files.
+everything a project derives (clusters, labels, label store, pre-classifier, charts) lives in its own
+DatasetStore and files in that directory, labels are per project since each project has its own prompt
+the db and reddit api work is shared instead:
+ - sync_shared() pulls the matches of the union of every project's terms into one cache
+   (SHARED_DATASET_FILE) with one db query per term watermark, usually just one
+ - refresh_shared_stats() refreshes votes / comments for the union of the submissions the projects want
+   refreshed (recent and relevant to them) in one api pass, and reads them back from the db once
+ - each project then ingests its terms and date window from the local cache and copies stats from it
+so N projects over overlapping terms cost one set of db reads and api refreshes instead of N.
+refresh_projects() runs it all as one incremental Pipeline (python cli.py digest)
+"""
+
+
+PROJECTS_DIR = "analysis"
+PROJECT_CONFIG = "project.json"
+SHARED_DIR = "analysis/shared"
+SHARED_DATASET_FILE = f"{SHARED_DIR}/submissions.sqlite3"  # every submission any project's terms match
+SHARED_STATE_FILE = f"{SHARED_DIR}/pipeline_state.json"
+# the cache holds submissions, labels are per project
+SHARED_COLUMNS = [c for c in COLUMN_TYPES if c not in {"cluster_id", "cgpt_response", "label_source"}]
+LABEL_COLUMNS = ["id", "title", "created_utc", "cluster_id", "cgpt_response", "label_source"]
+ANALYSIS_COLUMNS = ["id", "title", "created_utc", "score", "num_comments", "subreddit", "permalink"]
+# terms are scraped at least once a day, so a submission can show up in the db up to a day after
+# it was created. re-check this far behind the watermark and drop ids we already have
+INGEST_OVERLAP = 2 * 86400
+SYNC_CHUNK_ROWS = 20_000  # matches appended to the shared cache at a time
+STATS_REFRESH_DAYS = 7  # only refresh votes/comments for submissions newer than this
+STATS_REFRESH_INTERVAL = 6 * 3600
+
+
+class Project:
+    """one analysis project. project.json:
+    {"terms": [...],                      search terms, matched case-insensitively
+     "start_date": "YYYY-MM-DD",          first day of the window (inclusive), optional
+     "end_date": "YYYY-MM-DD",            end of the window (exclusive), optional
+     "prompt": "prompt.txt",              {submission_title} prompt, relative to the project directory
+     "batch_prompt": "batch_prompt.txt",  {submission_titles} prompt for batch labeling, optional
+     "valid_labels": ["1", "2", "3"],
+     "relevant_labels": ["1", "2"],       labels the charts and stats refreshes are about
+     "legacy_csv": "..."}                 optional csv imported into the dataset on first use"""
+
+    def __init__(self, name, config, directory=None):
+        self.name = name
+        self.directory = directory or os.path.join(PROJECTS_DIR, name)
+        self.terms = sorted({term.lower() for term in config["terms"]})
+        self.start_date = config.get("start_date")
+        self.end_date = config.get("end_date")
+        self.prompt_file = self.path(config["prompt"])
+        self.batch_prompt_file = self.path(config["batch_prompt"]) if config.get("batch_prompt") else None
+        self.valid_labels = set(config.get("valid_labels", ["1", "2", "3"]))
+        self.relevant_labels = list(config.get("relevant_labels", ["1", "2"]))
+        self.legacy_csv = config.get("legacy_csv")
+        self.dataset_file = self.path("submissions.sqlite3")
+        self.label_store = self.path("cgpt_responses.jsonl")
+        self.preclassifier_model = self.path("preclassifier.npz")
+        self.preclassifier_trained_ids = self.path("preclassifier_trained_ids.txt")
+        self.results_dir = self.path("results")
+        self._dataset = None
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def prompt_template(self):
+        with open(self.prompt_file, encoding="utf-8") as f:
+            return f.read()
+
+    def batch_prompt_template(self):
+        if self.batch_prompt_file is None:
+            raise ValueError(f"project {self.name} has no batch_prompt")
+        with open(self.batch_prompt_file, encoding="utf-8") as f:
+            return f.read()
+
+    def relevant_sql(self):
+        """(where clause, params) matching the relevant labels, for DatasetStore.read"""
+        return f"cgpt_response IN ({', '.join('?' for _ in self.relevant_labels)})", list(self.relevant_labels)
+
+    def dataset(self):
+        """opens the project's dataset store, importing legacy_csv into it the first time"""
+        if self._dataset is None:
+            self._dataset = DatasetStore(self.dataset_file)
+            if self.legacy_csv and self._dataset.count() == 0 and os.path.isfile(self.legacy_csv):
+                imported = self._dataset.import_csv(self.legacy_csv, transform=self.normalize_csv_chunk)
+                print(f"Imported {imported} rows from {self.legacy_csv} into {self.dataset_file}")
+                if self._dataset.count("cluster_id IS NULL"):
+                    # csv from before clustering
+                    clustered = assign_clusters(self._dataset.read(["id", "title", "url", "cluster_id"]))
+                    self._dataset.upsert(clustered, ["cluster_id"])
+        return self._dataset
+
+    def normalize_csv_chunk(self, chunk):
+        """csv labels were parsed as numbers (1.0), the dataset stores them as text ("1")"""
+        if "cgpt_response" in chunk.columns:
+            chunk["cgpt_response"] = chunk["cgpt_response"].map(
+                lambda v: self.normalize_label(v) or (None if pd.isna(v) else str(v)))
+        return chunk
+
+    def normalize_label(self, value):
+        """labels can show up as 1, 1.0 or "1". returns "1" or None if invalid"""
+        if pd.isna(value):
+            return None
+        label = str(value).strip()
+        if label.endswith(".0"):
+            label = label[:-2]
+        return label if label in self.valid_labels else None
+
+
+def load_project(name):
+    with open(os.path.join(PROJECTS_DIR, name, PROJECT_CONFIG), encoding="utf-8") as f:
+        return Project(name, json.load(f))
+
+
+def list_projects():
+    return sorted(os.path.basename(os.path.dirname(path))
+                  for path in glob.glob(os.path.join(PROJECTS_DIR, "*", PROJECT_CONFIG)))
+
+
+def refresh_projects(names=None):
+    """refreshes every project (or the named ones) over one shared sync and stats refresh
+    runs each stage only on new or changed rows, skipping stages whose inputs haven't changed"""
+    projects = [load_project(name) for name in (names or list_projects())]
+    pipeline = Pipeline(SHARED_STATE_FILE)
+    pipeline.run_stage("sync", lambda state: sync_shared(projects, state))
+    for project in projects:
+        # ingest reads the local cache only, it runs every time so config changes are picked up
+        pipeline.run_stage(f"{project.name}.ingest", lambda state, p=project: ingest_project(p, state))
+        pipeline.run_stage(f"{project.name}.label", lambda state, p=project: label_project(p, state),
+                           inputs=[f"{project.name}.ingest"])
+    pipeline.run_stage("refresh_stats", lambda state: refresh_shared_stats(projects, state),
+                       min_interval=STATS_REFRESH_INTERVAL)
+    for project in projects:
+        pipeline.run_stage(f"{project.name}.stats", lambda state, p=project: copy_shared_stats(p, state),
+                           inputs=["refresh_stats"])
+        pipeline.run_stage(f"{project.name}.charts", lambda state, p=project: draw_charts(p, state),
+                           inputs=[f"{project.name}.stats", f"{project.name}.ingest", f"{project.name}.label"])
+    pipeline.report()
+
+
+# ---- the shared cache ----
+
+_shared_dataset = None
+
+
+def get_shared_dataset():
+    global _shared_dataset
+    if _shared_dataset is None:
+        _shared_dataset = DatasetStore(SHARED_DATASET_FILE, rollups=False)
+    return _shared_dataset
+
+
+def sync_shared(projects, state):
+    """pulls the matches of every project term newer than the term's watermark (minus INGEST_OVERLAP)
+    into the shared cache. terms with the same watermark share one query, so it's one query unless a
+    project added terms. returns [rows, matches] in the cache"""
+    shared = get_shared_dataset()
+    watermarks = state.setdefault("watermarks", {})
+    by_since = {}
+    for term in sorted({term for project in projects for term in project.terms}):
+        by_since.setdefault(watermarks.get(term, 0), []).append(term)
+    for watermark, terms in sorted(by_since.items()):
+        since = max(0, watermark - INGEST_OVERLAP)
+        newest, inserted = watermark, 0
+        with span("projects.sync", terms=len(terms)) as s, getcursor(name="shared_sync") as cur:
+            rows = iter_submissions_for_terms(cur, terms, since_utc=since)
+            s["rows"] = 0
+            while chunk := list(itertools.islice(rows, SYNC_CHUNK_ROWS)):
+                new_df = pd.DataFrame(chunk)
+                s["rows"] += len(new_df)
+                # the newest match of any of the terms is their new watermark, like a single term's would be
+                newest = max(newest, float(new_df["created_utc"].max()))
+                matches = new_df[["search_term_name", "id"]]
+                new_df = new_df.drop(columns="search_term_name").drop_duplicates(subset="id")
+                inserted += shared.append(new_df[[c for c in new_df.columns if c in SHARED_COLUMNS]])
+                shared.add_matches(matches)
+        if not s["rows"]:
+            continue
+        watermarks.update({term: newest for term in terms})
+        print(f"Synced {len(terms)} terms since {since:.0f}: {inserted} new submissions in the shared cache")
+    return [shared.count(), len(shared.read_matches())]
+
+
+def ids_to_refresh(project):
+    """the project's recent relevant submissions"""
+    cutoff = time.time() - STATS_REFRESH_DAYS * 86400
+    relevant, params = project.relevant_sql()
+    recent = project.dataset().read(["id"], where=f"created_utc >= ? AND {relevant}", params=[cutoff] + params)
+    return recent["id"].tolist()
+
+
+def refresh_shared_stats(projects, state):
+    """rescrapes votes/comment counts once for the union of every project's ids_to_refresh and copies
+    them into the shared cache"""
+    ids = sorted({submission_id for project in projects for submission_id in ids_to_refresh(project)})
+    if not ids:
+        print("No IDs to refresh.")
+        return time.time()
+    update_selected_submission_stats(ids)
+    with getcursor() as cur:
+        cur.execute("""
+            SELECT id, score, num_comments FROM reddit_submission
+            WHERE id = ANY(%s)
+        """, (ids,))
+        rows = cur.fetchall()
+    get_shared_dataset().upsert(pd.DataFrame(rows, columns=["id", "score", "num_comments"]), ["score", "num_comments"])
+    print(f"Refreshed scores and comment counts of {len(rows)} submissions for {len(projects)} projects.")
+    return time.time()
+
+
+def iter_submissions_for_terms(cur, terms, since_utc=0, include_archive=False):
+    """yields one dict per (search term, submission) match, with the lowercased term in search_term_name
+    use a named cursor (getcursor(name=...)) to stream rows instead of loading them all
+    include_archive also yields the matches in partitions archived to parquet (partitions.archive)
+    the json columns come back as json text, not payload refs"""
+    if getattr(cur, "name", None):
+        # a named cursor only runs one statement, look the columns up on another one
+        with getcursor(commit=False) as columns_cur:
+            submission_columns = select_columns_sql(columns_cur, "r", "reddit_submission")
+    else:
+        submission_columns = select_columns_sql(cur, "r", "reddit_submission")
+    cur.execute(f"""
+        SELECT
+            s.name AS search_term_name,
+            {submission_columns}
+        FROM
+            search_term s
+        JOIN search_term_match_reddit_submission m ON m.search_term_id = s.id
+        JOIN reddit_submission r ON m.submission_id = r.id
+        WHERE m.created_utc > %s
+          AND r.created_utc > %s
+          AND s.name = ANY(%s)
+    """, (since_utc, since_utc, terms))
+
+    columns = None
+    seen = set()
+    for row in cur:
+        if columns is None:
+            # named cursors only have a description once the first rows are fetched
+            columns = [desc[0] for desc in cur.description]
+        row_dict = dict(zip(columns, row))
+        row_dict["search_term_name"] = row_dict["search_term_name"].lower()
+        if include_archive:
+            seen.add((row_dict["search_term_name"], row_dict["id"]))
+        yield row_dict
+
+    if include_archive:
+        from partitions import iter_archived_submissions
+        with getcursor(commit=False) as term_cur:
+            term_cur.execute("SELECT id, name FROM search_term WHERE name = ANY(%s)", (terms,))
+            term_names = dict(term_cur.fetchall())
+        for row_dict in iter_archived_submissions(term_names, since_utc):
+            # a submission re-scraped after its month was archived is in both
+            if (row_dict["search_term_name"], row_dict["id"]) not in seen:
+                yield row_dict
+
+
+# ---- per project stages ----
+
+def ingest_project(project, state):
+    """appends the cached submissions of the project's terms and window created after its watermark
+    (minus INGEST_OVERLAP) to its dataset. returns the number of rows in the dataset"""
+    shared = get_shared_dataset()
+    dataset = project.dataset()
+    since = max(0, state.get("watermark", 0) - INGEST_OVERLAP)
+    if state.get("terms") != project.terms:
+        since = 0  # new project or changed terms, backfill them
+    terms = json.dumps(project.terms)
+    new_df = shared.read(SHARED_COLUMNS, start_date=project.start_date, end_date=project.end_date,
+                         where=f"created_utc > ? AND id IN (SELECT id FROM {shared.match_table} "
+                               f"WHERE search_term IN (SELECT value FROM json_each(?)))",
+                         params=(since, terms))
+    state["terms"] = project.terms
+    if new_df.empty:
+        print(f"[{project.name}] No new submissions.")
+        return dataset.count()
+    matches = shared.read_matches(project.terms, ids=new_df["id"]).rename(columns={"search_term": "search_term_name"})
+    state["watermark"] = max(state.get("watermark", 0), float(new_df["created_utc"].max()))
+
+    existing = dataset.read(["id"], where="id IN (SELECT value FROM json_each(?))",
+                            params=(json.dumps(new_df["id"].tolist()),))
+    new_df = new_df[~new_df["id"].isin(set(existing["id"]))].copy()
+    print(f"[{project.name}] New unique submissions: {len(new_df)}")
+    if new_df.empty:
+        dataset.add_matches(matches)  # old submissions can still match new terms
+        return dataset.count()
+
+    # cluster against the existing rows sharing an lsh bucket with them, then append only the new ones
+    new_df = assign_clusters_in_store(dataset, new_df)
+    report_clusters(new_df)
+    inserted = dataset.append(new_df)
+    dataset.add_matches(matches)
+    total = dataset.count()
+    print(f"[{project.name}] Appended {inserted} submissions, dataset now has {total} rows.")
+    return total
+
+
+def label_project(project, state):
+    """returns the number of labeled rows in the dataset"""
+    remaining = label_data(project)
+    # anything that failed to label should be retried on the next run
+    state["retry"] = remaining > 0
+    return project.dataset().count("cgpt_response IS NOT NULL")
+
+
+def copy_shared_stats(project, state):
+    """copies the refreshed vote/comment values of the project's submissions from the shared cache"""
+    ids = ids_to_refresh(project)
+    if ids:
+        updates = get_shared_dataset().read(["id", "score", "num_comments"],
+                                            where="id IN (SELECT value FROM json_each(?))", params=(json.dumps(ids),))
+        project.dataset().upsert(updates, ["score", "num_comments"])
+        print(f"[{project.name}] Updated scores and comment counts for {len(updates)} submissions.")
+    return time.time()
+
+
+def draw_charts(project, state):
+    """reads the daily rollups, so this takes the same time no matter how much history there is"""
+    dataset = project.dataset()
+    rollup = load_rollup_frame(dataset, start_date=project.start_date, end_date=project.end_date,
+                               labels=project.relevant_labels)
+    top_candidates = load_top_submission_candidates(dataset, rollup, ANALYSIS_COLUMNS)
+    save_charts(project, rollup, top_candidates)
+
+
+def save_charts(project, df, top_candidates):
+    """df is a daily rollup frame (see load_rollup_frame), top_candidates the submissions
+    that can make the top 25 lists (see load_top_submission_candidates)"""
+    results = project.results_dir
+    os.makedirs(results, exist_ok=True)
+    save_submissions_per_day(df, xlabel="Date", ylabel="Number of Submissions",
+                             title="Total Submissions Per Day", output_path=f"{results}/num_submissions_per_day.png")
+    save_num_comments_per_day(df, xlabel="Date", ylabel="Number of Comments",
+                              title="Total Comments Per Day", output_path=f"{results}/num_comments_per_day.png")
+    save_score_per_day(df, xlabel="Date", ylabel="Total Score",
+                       title="Total Upvotes (Score) Per Day", output_path=f"{results}/num_upvotes_per_day.png")
+    save_top_submissions(top_candidates, score_csv=f"{results}/submissions_by_score.csv",
+                         comments_csv=f"{results}/submissions_by_comments.csv")
+    get_top_subreddits_by_total_comments(df, 10).to_csv(
+        f"{results}/top_subreddits_by_comments.csv", header=["total_comments"])
+    get_top_subreddits_by_submission_count(df, 10).to_csv(
+        f"{results}/top_subreddits_by_submissions.csv", header=["submission_count"])
+
+
+# ---- labeling ----
+
+def label_data(project, batch_size=None, ids=None):
+    """labels every unlabeled submission in the project's window
+    batch_size packs that many titles into each request instead of one title per request
+    ids limits the llm requests to those submissions, stored labels are still merged for all
+    only one submission per near-duplicate cluster is sent, the rest get its label
+    titles the local pre-classifier is confident about aren't sent at all
+    returns the number of submissions that are still unlabeled"""
+    dataset = project.dataset()
+    with span("label.read", project=project.name) as s:
+        df = dataset.read(LABEL_COLUMNS)
+        s["rows"] = len(df)
+    # labels get filled in from mixed sources below, keep these as plain object columns
+    df[["cgpt_response", "label_source"]] = df[["cgpt_response", "label_source"]].astype(object)
+    unlabeled = df["cgpt_response"].isna()
+    with span("label.representatives") as s:
+        rows_to_process = get_representatives_to_label(project, df)
+        if ids is not None:
+            rows_to_process = rows_to_process[rows_to_process["id"].isin(set(ids))]
+        s["rows"] = len(rows_to_process)
+    with span("label.preclassifier", rows=len(rows_to_process)) as s:
+        rows_to_process = prelabel_confident_rows(project, df, rows_to_process)
+        s["remaining"] = len(rows_to_process)
+
+    prompt_template = project.prompt_template()
+    with span("label.llm", rows=len(rows_to_process), batch_size=batch_size):
+        if batch_size:
+            items = list(zip(rows_to_process["id"], rows_to_process["title"]))
+            if items:
+                run_batched_labeling(items, project.label_store, project.batch_prompt_template(), prompt_template,
+                                     batch_size=batch_size, valid_labels=project.valid_labels)
+        else:
+            items = [
+                (row["id"], prompt_template.format(submission_title=row["title"]).strip())
+                for _, row in rows_to_process.iterrows()
+            ]
+            if items:
+                run_labeling(items, project.label_store)
+
+    with span("label.merge"):
+        merge_labels(project, df)
+    # write back only the rows that got a label this run
+    newly_labeled = unlabeled & df["cgpt_response"].notna()
+    with span("label.upsert", rows=int(newly_labeled.sum())):
+        dataset.upsert(df[newly_labeled], ["cgpt_response", "label_source"])
+    return len(get_rows_to_label(project, df))
+
+
+def prelabel_confident_rows(project, df, rows_to_process):
+    """retrains the project's pre-classifier on new cgpt labels, labels the rows it is confident about
+    in df (label_source = "preclassifier") and returns the rows that still need the llm"""
+    # only train on llm labels, never on the pre-classifier's own output
+    training = df[df["label_source"].isna() | (df["label_source"] == "cgpt")].copy()
+    training["label"] = training["cgpt_response"].map(project.normalize_label)
+    training = training[training["label"].notna()]
+    model = update_preclassifier(project.preclassifier_model, project.preclassifier_trained_ids,
+                                 training["id"].tolist(), training["title"].tolist(), training["label"].tolist(),
+                                 sorted(project.valid_labels))
+    if rows_to_process.empty:
+        return rows_to_process
+
+    predictions = pd.Series(model.predict_confident(rows_to_process["title"].tolist()),
+                            index=rows_to_process.index)
+    confident = predictions.notna()
+    df.loc[predictions[confident].index, "cgpt_response"] = predictions[confident]
+    df.loc[predictions[confident].index, "label_source"] = "preclassifier"
+    print(f"Pre-classifier labeled {int(confident.sum())} of {len(rows_to_process)} submissions "
+          f"({confident.mean():.1%} of llm calls avoided)")
+    return rows_to_process[~confident]
+
+
+def get_representatives_to_label(project, df):
+    """rows to label, minus any whose cluster is already labeled and all but one per cluster"""
+    rows_to_process = get_rows_to_label(project, df)
+    labeled_clusters = set(df.loc[df["cgpt_response"].notna(), "cluster_id"])
+    representatives = rows_to_process[~rows_to_process["cluster_id"].isin(labeled_clusters)]
+    representatives = representatives.drop_duplicates("cluster_id")
+    print(f"{len(rows_to_process)} submissions to process, {len(representatives)} after clustering "
+          f"({len(rows_to_process) - len(representatives)} API calls saved)")
+    return representatives
+
+
+def get_rows_to_label(project, df):
+    """unlabeled rows inside the project's window, older ones aren't worth the tokens"""
+    in_window = filter_df_by_utc_date(df, project.start_date, project.end_date, column="created_utc")
+    return in_window[in_window["cgpt_response"].isna()]
+
+
+def merge_labels(project, df):
+    """merge all stored responses into df in one pass"""
+    labels = load_labels(project.label_store)
+    missing = df["cgpt_response"].isna()
+    df.loc[missing, "cgpt_response"] = df.loc[missing, "id"].map(labels)
+    df.loc[missing & df["cgpt_response"].notna(), "label_source"] = "cgpt"
+    merged = int(missing.sum() - df["cgpt_response"].isna().sum())
+    missing = df["cgpt_response"].isna()
+    copied = copy_labels_to_clusters(df, "cgpt_response")
+    df.loc[missing & df["cgpt_response"].notna(), "label_source"] = "cluster"
+    print(f"Merged {merged} new responses, "
+          f"copied labels to {copied} near-duplicate submissions")
+
+
+def write_label_batch_file(project, path=None, batch_size=20):
+    """writes unlabeled submissions to an offline batch job file instead of labeling them live"""
+    df = project.dataset().read(LABEL_COLUMNS)
+    rows_to_process = get_representatives_to_label(project, df)
+    done = load_labels(project.label_store)
+    rows_to_process = rows_to_process[~rows_to_process["id"].isin(done)]
+    items = list(zip(rows_to_process["id"], rows_to_process["title"]))
+    write_batch_file(items, path or project.path("label_batch_requests.jsonl"), project.batch_prompt_template(),
+                     batch_size)
+
+
+def ingest_label_batch_results(project, results_path):
+    """reads an offline batch job output file, labels only the submissions it missed one by one,
+    and merges everything into the dataset. rows added since the batch file was written are left
+    for the next label_data run"""
+    missing = ingest_batch_results(results_path, project.label_store, project.valid_labels)
+    if missing:
+        print(f"{len(missing)} submissions missing from batch results, labeling individually...")
+    label_data(project, ids=missing)
+
+
+def filter_df_for_analysis(project, df):
+    """adds created_date, keeps the rows in the project's window with a relevant label"""
+    df["created_date"] = pd.to_datetime(
+        df["created_utc"], unit="s", utc=True).dt.date
+    df = filter_df_by_utc_date(df, project.start_date, project.end_date)
+    df = df[df["cgpt_response"].map(project.normalize_label).isin(project.relevant_labels)]
+    return df
+
+
+def filter_df_by_utc_date(df, start_date_str=None, end_date_str=None, column="created_date"):
+    """rows on or after start_date_str and before end_date_str (utc "yyyy-mm-dd", either optional)
+    column is a date column, or created_utc (unix timestamps)"""
+    dates = df[column] if column != "created_utc" else pd.to_datetime(df[column], unit="s", utc=True).dt.date
+    mask = pd.Series(True, index=df.index)
+    if start_date_str:
+        mask &= dates >= parse_date(start_date_str)
+    if end_date_str:
+        mask &= dates < parse_date(end_date_str)
+    return df[mask].copy()
+
+
+def parse_date(date_str):
+    return datetime.datetime.strptime(date_str, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc).date()
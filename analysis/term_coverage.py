@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+
+"""
+sparse term x submission incidence matrix for judging which search terms are worth scraping
+built once from (search_term, id) match rows plus the set of relevant submission ids, then
+ - term_stats(): per term matches, relevant matches, precision and unique relevant coverage
+   (relevant submissions no other term matched)
+ - marginal_loss(terms): what cutting a set of terms loses, i.e. the submissions none of the
+   remaining terms match
+ - recommend_cuts(): greedy weighted set cover. keeps the terms that cover the relevant submissions
+   most cheaply (new relevant submissions per match) until target_coverage is reached and
+   recommends cutting the rest
+everything is numpy bincounts over the coo arrays, no per-term python loops over submissions
+"""
+
+
+class TermIncidence:
+    def __init__(self, matches, relevant_ids):
+        """matches is a dataframe with search_term and id columns, relevant_ids an iterable of ids"""
+        matches = matches[["search_term", "id"]].drop_duplicates()
+        term_codes, self.terms = pd.factorize(matches["search_term"], sort=True)
+        id_codes, self.ids = pd.factorize(matches["id"])
+        self.rows = term_codes.astype(np.int64)  # term index of each match
+        self.cols = id_codes.astype(np.int64)  # submission index of each match
+        self.term_index = {term: i for i, term in enumerate(self.terms)}
+        self.relevant = np.asarray(pd.Index(self.ids).isin(list(relevant_ids)), dtype=bool)
+        # number of terms matching each submission
+        self.degree = np.bincount(self.cols, minlength=len(self.ids))
+
+    def term_mask(self, terms):
+        mask = np.zeros(len(self.terms), dtype=bool)
+        mask[[self.term_index[t] for t in terms if t in self.term_index]] = True
+        return mask
+
+    def per_term(self, weights):
+        """sums per-submission weights over each term's matches"""
+        return np.bincount(self.rows, weights=weights[self.cols], minlength=len(self.terms))
+
+    def term_stats(self):
+        matches = np.bincount(self.rows, minlength=len(self.terms))
+        relevant = self.per_term(self.relevant.astype(float))
+        unique = self.per_term((self.relevant & (self.degree == 1)).astype(float))
+        return pd.DataFrame({
+            "search_term": self.terms,
+            "matches": matches,
+            "relevant": relevant.astype(int),
+            "precision": relevant / np.maximum(matches, 1),
+            "unique_relevant": unique.astype(int),
+        }).sort_values("precision").reset_index(drop=True)
+
+    def remaining_degree(self, cut_mask):
+        """number of terms still matching each submission once the cut_mask terms are removed"""
+        removed = np.bincount(self.cols, weights=cut_mask[self.rows], minlength=len(self.ids))
+        return self.degree - removed.astype(np.int64)
+
+    def marginal_loss(self, terms):
+        """returns a dict with the submissions (all and relevant) that only the given terms match"""
+        remaining = self.remaining_degree(self.term_mask(terms))
+        lost = remaining == 0
+        return {
+            "matched_relevant": int((self.relevant & (remaining < self.degree)).sum()),
+            "lost": int(lost.sum()),
+            "lost_relevant": int((lost & self.relevant).sum()),
+            "lost_relevant_ids": list(self.ids[lost & self.relevant]),
+            "covered_relevant": int((self.relevant & ~lost).sum()),
+            "total_relevant": int(self.relevant.sum()),
+        }
+
+    def ids_kept(self, cut_terms):
+        """ids still matched by at least one term after cutting cut_terms"""
+        return list(self.ids[self.remaining_degree(self.term_mask(cut_terms)) > 0])
+
+    def recommend_cuts(self, target_coverage=0.99):
+        """greedy set cover over the relevant submissions, cheapest terms first
+        returns (terms to keep, terms to cut)"""
+        matches = np.bincount(self.rows, minlength=len(self.terms)).astype(float)
+        # only matches of relevant submissions matter for coverage
+        in_relevant = self.relevant[self.cols]
+        rows, cols = self.rows[in_relevant], self.cols[in_relevant]
+        covered = np.zeros(len(self.ids), dtype=bool)
+        keep = np.zeros(len(self.terms), dtype=bool)
+        target = target_coverage * self.relevant.sum()
+        num_covered = 0
+        while num_covered < target:
+            uncovered = ~covered[cols]
+            gain = np.bincount(rows[uncovered], minlength=len(self.terms)).astype(float)
+            gain[keep] = 0
+            if not gain.any():
+                break
+            best = int(np.argmax(gain / np.maximum(matches, 1)))
+            keep[best] = True
+            covered[cols[rows == best]] = True
+            num_covered += int(gain[best])
+        return list(self.terms[keep]), list(self.terms[~keep])
@@ -0,0 +1,362 @@
+import time
+import asyncio
+import logging
+import httpx
+
+from vsm import getcursor, hot_window_start, POOL_MAX_CONNECTIONS
+from scrape import insert_submissions, insert_comments, get_existing_submission_ids
+from scrape import SCRAPE_ROWS, SCRAPE_PAGES, BACKOFF_RETRIES, BACKOFF_SLEEP
+from reddit_pool import CredentialPool, API_LATENCY, API_ERRORS, RATE_LIMIT_REMAINING
+from tracing import span
+
+
+"""
+asyncio ingestion engine: term scrapes, comment fetches and stats refreshes as coroutines on one
+event loop, so hundreds of them can wait on reddit at once without a thread each
+ - AsyncRedditClient talks to the api with httpx (application-only oauth, same credentials and
+   REDDIT_OAUTH_URL / REDDIT_URL as praw, see reddit_pool.py) and works on the raw json, so rows never
+   trigger praw's lazy refetches. stats refreshes use /api/info, 100 submissions per request
+ - one AsyncRateLimiter per credential is shared by every coroutine using it: each request reserves
+   the next slot, spaced so the remaining requests in reddit's x-ratelimit window last until it resets
+ - db work stays on the existing sync code (scrape.insert_submissions, vsm.getcursor), bridged with
+   asyncio.to_thread and capped at the connection pool size
+monitor.AsyncScrapeScheduler runs the monitor's scheduling policy on top of it (MONITOR_ENGINE=async)
+"""
+
+
+DEFAULT_OAUTH_URL = "https://oauth.reddit.com"
+DEFAULT_REDDIT_URL = "https://www.reddit.com"
+MAX_CONNECTIONS = 100  # open http connections per credential
+MAX_CONCURRENCY = 200  # scrapes / comment fetches / stats batches in flight
+PAGE_SIZE = 100
+INFO_BATCH = 100  # ids per /api/info request, reddit's max
+MORECHILDREN_BATCH = 100
+MAX_RETRIES = 5
+MAX_BACKOFF = 300
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+TOKEN_REFRESH_MARGIN = 60  # seconds before expiry a token is renewed
+
+logging.getLogger("httpx").setLevel(logging.WARNING)  # it logs every request at info
+
+
+class AsyncRateLimiter:
+    """spreads requests over reddit's rate limit window, shared by every coroutine on a credential"""
+
+    def __init__(self):
+        self.remaining = None
+        self.used = None
+        self.reset_timestamp = None
+        self.next_request = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            now = time.time()
+            wait = max(self.next_request - now, 0)
+            self.next_request = max(self.next_request, now) + self.spacing(now)
+        if wait:
+            await asyncio.sleep(wait)
+
+    def spacing(self, now):
+        if self.remaining is None or self.reset_timestamp is None:
+            return 0.0
+        return max(self.reset_timestamp - now, 0) / max(self.remaining, 1)
+
+    def update(self, headers):
+        if "x-ratelimit-remaining" not in headers:
+            return
+        self.remaining = float(headers["x-ratelimit-remaining"])
+        self.used = int(float(headers["x-ratelimit-used"]))
+        self.reset_timestamp = time.time() + int(float(headers["x-ratelimit-reset"]))
+        if self.remaining <= 0:
+            self.next_request = max(self.next_request, self.reset_timestamp)
+
+    @property
+    def limits(self):
+        """same shape as praw's reddit.auth.limits, for CredentialPool.record_success"""
+        return {"remaining": self.remaining, "used": self.used, "reset_timestamp": self.reset_timestamp}
+
+
+class AsyncRedditClient:
+    def __init__(self, credential, max_connections=MAX_CONNECTIONS):
+        self.credential = credential
+        self.oauth_url = (credential.oauth_url or DEFAULT_OAUTH_URL).rstrip("/")
+        self.reddit_url = (credential.reddit_url or DEFAULT_REDDIT_URL).rstrip("/")
+        self.limiter = AsyncRateLimiter()
+        self.http = httpx.AsyncClient(
+            headers={"User-Agent": credential.user_agent},
+            timeout=httpx.Timeout(30, pool=None),  # waiting for a free connection is normal here
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        self.token = None
+        self.token_expires = 0
+        self.token_lock = asyncio.Lock()
+
+    async def close(self):
+        await self.http.aclose()
+
+    async def authenticate(self, force=False):
+        async with self.token_lock:
+            if force or self.token is None or time.time() > self.token_expires - TOKEN_REFRESH_MARGIN:
+                response = await self.http.post(
+                    f"{self.reddit_url}/api/v1/access_token", data={"grant_type": "client_credentials"},
+                    auth=(self.credential.client_id, self.credential.client_secret))
+                response.raise_for_status()
+                body = response.json()
+                self.token = body["access_token"]
+                self.token_expires = time.time() + body.get("expires_in", 3600)
+            return self.token
+
+    async def request(self, method, path, params=None):
+        """json body of an api request, retried with exponential back-off on 429 / 5xx / network errors"""
+        params = {**(params or {}), "raw_json": 1}
+        delay = 2
+        error = None
+        expired = False
+        for attempt in range(MAX_RETRIES):
+            token = await self.authenticate(force=expired)
+            await self.limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = await self.http.request(method, self.oauth_url + path, params=params,
+                                                   headers={"Authorization": f"bearer {token}"})
+                API_LATENCY.observe(time.perf_counter() - start, status=response.status_code)
+                self.limiter.update(response.headers)
+                if self.limiter.remaining is not None:
+                    RATE_LIMIT_REMAINING.set(self.limiter.remaining, credential=self.credential.name)
+                response.raise_for_status()
+                return response.json()
+            except httpx.HTTPStatusError as e:
+                status = e.response.status_code
+                expired = status == 401 and attempt == 0  # token revoked early, get a new one once
+                if status not in RETRY_STATUSES and not expired:
+                    API_ERRORS.inc(exception=type(e).__name__)
+                    raise
+                error = e
+                reason = str(status)
+            except httpx.TransportError as e:
+                API_ERRORS.inc(exception=type(e).__name__)
+                error = e
+                reason = "request_exception"
+            logging.warning(f"{method} {path} failed ({error!r}), retrying in {delay}s")
+            BACKOFF_RETRIES.inc(reason=reason)
+            BACKOFF_SLEEP.inc(delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_BACKOFF)
+        raise error
+
+    async def search(self, query, after=None):
+        params = {"q": query, "sort": "new", "limit": PAGE_SIZE}
+        if after:
+            params["after"] = after
+        return (await self.request("GET", "/r/all/search", params))["data"]
+
+    async def comments(self, submission_id, comment_id=None):
+        """(submission listing, comment listing). comment_id gets that comment and its replies only,
+        the page behind a "continue this thread" link"""
+        path = f"/comments/{submission_id}" + (f"/_/{comment_id}" if comment_id else "")
+        return await self.request("GET", path)
+
+    async def morechildren(self, link_id, children):
+        body = await self.request("GET", "/api/morechildren",
+                                  {"link_id": link_id, "children": ",".join(children), "api_type": "json"})
+        return body["json"]["data"]["things"]
+
+    async def info(self, fullnames):
+        return (await self.request("GET", "/api/info", {"id": ",".join(fullnames)}))["data"]["children"]
+
+
+def flatten_comments(things):
+    """(comment dicts, ids still behind "more" objects, parent comment ids of "continue this thread"
+    stubs) from a comment listing's children"""
+    comments, more, threads = [], [], []
+    stack = list(reversed(things))
+    while stack:
+        thing = stack.pop()
+        if thing["kind"] == "more":
+            children = thing["data"].get("children", [])
+            more.extend(children)
+            parent_id = thing["data"].get("parent_id", "")
+            if not children and parent_id.startswith("t1_"):
+                # too deep for morechildren, reddit only serves these replies on the parent's own page
+                threads.append(parent_id[3:])
+        elif thing["kind"] == "t1":
+            comments.append(thing["data"])
+            replies = thing["data"].get("replies")
+            if isinstance(replies, dict):
+                stack.extend(reversed(replies["data"]["children"]))
+    return comments, more, threads
+
+
+def load_existing_ids(term):
+    """(ids already matched to the term, start of the hot window or None when the db isn't partitioned)"""
+    with getcursor(commit=False) as cur:
+        cur.execute("SELECT id FROM search_term WHERE name = %s", (term,))
+        result = cur.fetchone()
+        if not result:
+            raise ValueError(f"The query '{term}' does not exist in the DB as a search term and cannot be scraped.")
+        return set(get_existing_submission_ids(cur, result[0])), hot_window_start(cur)
+
+
+def store_submissions(term, records):
+    with getcursor() as cur:
+        insert_submissions(cur, term, records)
+
+
+def store_comments(comments):
+    with getcursor() as cur:
+        insert_comments(cur, comments)
+
+
+def store_stats(rows):
+    """rows of (score, num_comments, upvote_ratio, num_crossposts, id)"""
+    with getcursor() as cur:
+        cur.executemany("""
+            UPDATE reddit_submission
+            SET score = %s, num_comments = %s, upvote_ratio = %s, num_crossposts = %s
+            WHERE id = %s
+        """, rows)
+
+
+class AsyncIngest:
+    def __init__(self, credential_pool=None, max_concurrency=MAX_CONCURRENCY, db_connections=POOL_MAX_CONNECTIONS):
+        self.credential_pool = credential_pool or CredentialPool.from_env()
+        self.clients = {}
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.db_slots = asyncio.Semaphore(db_connections)
+        self.last_pages = {}  # term -> listing pages its last scrape_term requested, for the scrape budget
+
+    def client(self, credential=None, key=""):
+        """the shared client of a credential (or of the credential the pool picks for key)"""
+        credential = credential or self.credential_pool.credential_for(key)
+        if credential.name not in self.clients:
+            self.clients[credential.name] = AsyncRedditClient(credential)
+        return self.clients[credential.name]
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.close()
+        self.clients = {}
+
+    async def db(self, func, *args):
+        """runs blocking db code on a worker thread, at most db_connections at a time"""
+        async with self.db_slots:
+            return await asyncio.to_thread(func, *args)
+
+    async def scrape_term(self, term, client=None):
+        """async scrape_submissions_to_db for one term. returns the number of new submissions"""
+        client = client or self.client(key=term)
+        async with self.slots:
+            existing, stop_before_utc = await self.db(load_existing_ids, term)
+            if not existing:
+                stop_before_utc = None  # a new term is backfilled as far as the search goes
+            with span("scrape.paginate", term=term, engine="async") as s:
+                records, pages, after = [], 0, None
+                while True:
+                    listing = await client.search(term, after)
+                    pages += 1
+                    duplicate = False
+                    for child in listing["children"]:
+                        if child["data"]["id"] in existing:
+                            duplicate = True  # everything after this was scraped last time
+                            break
+                        if stop_before_utc is not None and child["data"]["created_utc"] < stop_before_utc:
+                            duplicate = True  # older than the hot window of a partitioned db
+                            break
+                        records.append(child["data"])
+                    after = listing.get("after")
+                    if duplicate or not after or not listing["children"]:
+                        break
+                s["pages"] = pages
+                s["rows"] = len(records)
+            self.last_pages[term] = pages
+            SCRAPE_PAGES.observe(pages)
+            SCRAPE_ROWS.observe(len(records))
+            await self.db(store_submissions, term, records)
+        logging.info(f"{len(records)} new submissions for '{term}' ({pages} pages)")
+        return len(records)
+
+    async def scrape_comments(self, submission_id):
+        """async scrape_comments_to_db. returns the number of comments
+        follows "more" objects and "continue this thread" stubs like praw's replace_more(limit=None)"""
+        client = self.client(key=submission_id)
+        async with self.slots:
+            with span("comments.fetch", submission_id=submission_id, engine="async") as s:
+                _, listing = await client.comments(submission_id)
+                comments, more, threads = flatten_comments(listing["data"]["children"])
+                seen = {comment["id"] for comment in comments}
+                pages = 1
+                while more or threads:
+                    if more:
+                        batch, more = more[:MORECHILDREN_BATCH], more[MORECHILDREN_BATCH:]
+                        things = await client.morechildren(f"t3_{submission_id}", batch)
+                    else:
+                        _, thread = await client.comments(submission_id, threads.pop())
+                        things = thread["data"]["children"]
+                    found, remaining, deeper = flatten_comments(things)
+                    # a thread page starts with the parent comment, which is already in comments
+                    found = [comment for comment in found if comment["id"] not in seen]
+                    seen.update(comment["id"] for comment in found)
+                    comments.extend(found)
+                    more.extend(remaining)
+                    threads.extend(deeper)
+                    pages += 1
+                s["pages"] = pages
+                s["rows"] = len(comments)
+            await self.db(store_comments, comments)
+        return len(comments)
+
+    async def refresh_stats_batch(self, submission_ids):
+        client = self.client(key=submission_ids[0])
+        async with self.slots:
+            with span("stats.refresh", rows=len(submission_ids), engine="async") as s:
+                things = await client.info([f"t3_{i}" for i in submission_ids])
+                rows = [(t["data"].get("score"), t["data"].get("num_comments"), t["data"].get("upvote_ratio"),
+                         t["data"].get("num_crossposts"), t["data"]["id"]) for t in things if t["kind"] == "t3"]
+                await self.db(store_stats, rows)
+                s["updated"] = len(rows)
+        return len(rows)
+
+    async def refresh_stats(self, submission_ids):
+        """async update_selected_submission_stats. returns (updated, failed)"""
+        submission_ids = list(submission_ids)
+        batches = [submission_ids[i:i + INFO_BATCH] for i in range(0, len(submission_ids), INFO_BATCH)]
+        results = await gather_logged(self.refresh_stats_batch(batch) for batch in batches)
+        updated = sum(r for r in results if isinstance(r, int))
+        return updated, len(submission_ids) - updated
+
+    async def scrape_terms(self, terms):
+        return await gather_logged(self.scrape_term(term) for term in terms)
+
+    async def scrape_comments_for(self, submission_ids):
+        return await gather_logged(self.scrape_comments(i) for i in submission_ids)
+
+
+async def gather_logged(coros):
+    """gathers the coroutines, logging (and returning) exceptions instead of cancelling the rest"""
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logging.error(f"ingest task failed: {result!r}")
+    return results
+
+
+def run(method, *args):
+    """runs an AsyncIngest method to completion from sync code, e.g. run(AsyncIngest.scrape_terms, terms)"""
+    async def main():
+        ingest = AsyncIngest()
+        try:
+            return await method(ingest, *args)
+        finally:
+            await ingest.close()
+
+    return asyncio.run(main())
+
+
+def update_selected_submission_stats(submission_ids):
+    """drop-in for update_submissions.update_selected_submission_stats, 100 submissions per request"""
+    if not submission_ids:
+        print("No submission IDs provided.")
+        return
+    updated, failed = run(AsyncIngest.refresh_stats, submission_ids)
+    print(f"Updated: {updated}, Failed: {failed}")
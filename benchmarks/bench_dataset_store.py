@@ -0,0 +1,97 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from analysis.dataset_store import DatasetStore  # noqa: E402
+
+
+"""
+compares the old csv working set with DatasetStore on a synthetic labeled dataset
+ - label update: set cgpt_response on --updates rows
+ - stats update: set score/num_comments on --updates rows
+ - chart read: 5 columns, relevant labels, last 30 days
+"""
+
+
+def synthetic_dataset(n):
+    rng = np.random.RandomState(0)
+    return pd.DataFrame({
+        "id": [f"s{i:07d}" for i in range(n)],
+        "title": [f"synthetic submission {i} about the new vaccine advisory panel" for i in range(n)],
+        "url": [f"https://example.com/{i}" for i in range(n)],
+        "subreddit": rng.choice(["news", "politics", "science", "health"], n),
+        "permalink": [f"/r/news/comments/s{i:07d}/" for i in range(n)],
+        "created_utc": 1750000000 + np.arange(n) * (86400 * 365 / n),
+        "score": rng.randint(0, 5000, n),
+        "num_comments": rng.randint(0, 500, n),
+        "cluster_id": [f"s{i:07d}" for i in range(n)],
+        "cgpt_response": rng.choice(["1", "2", "3", None], n),
+    })
+
+
+def timed(name, func):
+    start = time.perf_counter()
+    func()
+    print(f"  {name}: {(time.perf_counter() - start) * 1000:.1f}ms")
+
+
+def bench_csv(df, path, updates, cutoff):
+    df.to_csv(path, index=False)
+    ids = set(df["id"].sample(updates, random_state=1))
+
+    def update_labels():
+        full = pd.read_csv(path, dtype={"id": str, "cluster_id": str})
+        full.loc[full["id"].isin(ids), "cgpt_response"] = 1
+        full.to_csv(path, index=False)
+
+    def update_stats():
+        full = pd.read_csv(path, dtype={"id": str, "cluster_id": str})
+        full.loc[full["id"].isin(ids), "score"] += 1
+        full.to_csv(path, index=False)
+
+    def read_for_chart():
+        full = pd.read_csv(path, dtype={"id": str, "cluster_id": str})
+        full = full[(full["created_utc"] >= cutoff) & full["cgpt_response"].isin([1, 2])]
+        return full[["id", "created_utc", "score", "num_comments", "subreddit"]]
+
+    print("csv")
+    timed("label update", update_labels)
+    timed("stats update", update_stats)
+    timed("chart read", read_for_chart)
+
+
+def bench_store(df, path, updates, cutoff):
+    store = DatasetStore(path)
+    store.append(df)
+    changed = df.sample(updates, random_state=1)[["id", "score", "num_comments", "cgpt_response"]].copy()
+    changed["cgpt_response"] = "1"
+    changed["score"] += 1
+
+    print("dataset store")
+    timed("label update", lambda: store.upsert(changed, ["cgpt_response"]))
+    timed("stats update", lambda: store.upsert(changed, ["score", "num_comments"]))
+    timed("chart read", lambda: store.read(
+        ["id", "created_utc", "score", "num_comments", "subreddit"],
+        where="created_utc >= ? AND cgpt_response IN ('1', '2')", params=(cutoff,)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--updates", type=int, default=500)
+    args = parser.parse_args()
+
+    df = synthetic_dataset(args.rows)
+    cutoff = df["created_utc"].max() - 30 * 86400
+    with tempfile.TemporaryDirectory() as tmp:
+        bench_csv(df, os.path.join(tmp, "dataset.csv"), args.updates, cutoff)
+        bench_store(df, os.path.join(tmp, "dataset.sqlite3"), args.updates, cutoff)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import dump_submissions, load_submissions, dump_submissions_jsonl, iter_submissions  # noqa: E402
+
+
+"""
+compares peak memory and throughput of the old export path (fetchall -> dict of lists ->
+indented json -> full json.load) with the streaming path (server-side cursor -> jsonl -> iterate)
+
+by default rows come from a synthetic generator shaped like `search_term.name, r.*`
+with --db, rows come from a temp table of that size in the configured postgres db
+"""
+
+
+COLUMNS = [
+    "search_term_name", "id", "url", "domain", "title", "permalink", "created_utc", "subreddit",
+    "score", "num_comments", "upvote_ratio", "media", "gildings", "all_awardings",
+]
+
+
+def synthetic_rows(n):
+    terms = ["rfk", "acip", "cdc", "hhs"]
+    for i in range(n):
+        yield (
+            terms[i % 4], f"s{i:07d}", f"https://example.com/{i}", "example.com",
+            f"synthetic submission {i} about the new vaccine advisory panel and its first meeting",
+            f"/r/news/comments/s{i:07d}/", 1750000000 + i, "news", i % 5000, i % 500, 0.9, "{}", "{}", "[]",
+        )
+
+
+def old_export(rows, path):
+    rows = list(rows)  # fetchall
+    data = {}
+    for row in rows:
+        row_dict = dict(zip(COLUMNS, row))
+        data.setdefault(row_dict.pop("search_term_name"), []).append(row_dict)
+    dump_submissions(data, path)
+    loaded = load_submissions(path)
+    return sum(len(v) for v in loaded.values())
+
+
+def streaming_export(rows, path):
+    dump_submissions_jsonl((dict(zip(COLUMNS, row)) for row in rows), path)
+    count = 0
+    for _ in iter_submissions(path, columns=["id", "created_utc", "score"]):
+        count += 1
+    return count
+
+
+def db_rows(n):
+    """needs vsm.init_connection() to have run, main() connects once for both exports"""
+    import vsm
+    conn = vsm.pg_pool.getconn()
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TEMP TABLE bench_export AS
+            SELECT (ARRAY['rfk','acip','cdc','hhs'])[1 + i % 4] AS search_term_name,
+                   'b' || i AS id, 'https://example.com/' || i AS url, 'example.com' AS domain,
+                   md5(i::text) || md5((i + 1)::text) AS title, '/r/news/comments/b' || i AS permalink,
+                   1750000000 + i AS created_utc, 'news' AS subreddit, i % 5000 AS score,
+                   i % 500 AS num_comments, 0.9 AS upvote_ratio, '{}' AS media, '{}' AS gildings,
+                   '[]' AS all_awardings
+            FROM generate_series(1, %s) i
+        """, (n,))
+    with conn.cursor(name="bench_export") as cur:
+        cur.itersize = 2000
+        cur.execute("SELECT * FROM bench_export")
+        yield from cur
+    conn.rollback()
+    vsm.pg_pool.putconn(conn)
+
+
+def measure(name, func, rows, path):
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = func(rows, path)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>10}: {count} rows in {elapsed:.2f}s ({count / elapsed:,.0f} rows/s), "
+          f"peak memory {peak / 1024 / 1024:.1f} MiB, file {os.path.getsize(path) / 1024 / 1024:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--db", action="store_true", help="stream rows from a temp table in the db")
+    args = parser.parse_args()
+
+    source = db_rows if args.db else synthetic_rows
+    if args.db:
+        import vsm
+        vsm.init_connection()
+    with tempfile.TemporaryDirectory() as tmp:
+        measure("old", old_export, source(args.rows), os.path.join(tmp, "submissions.json"))
+        measure("streaming", streaming_export, source(args.rows), os.path.join(tmp, "submissions.jsonl"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+import tempfile
+import contextlib
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+from reddit_standin import SyntheticReddit, Fixtures, start_standin  # noqa: E402
+
+
+"""
+offline end-to-end ingest benchmark: the real scrape / comment / stats / scheduler code against the
+local reddit stand-in (reddit_standin.py) and a throwaway sqlite db (VSM_BACKEND=sqlite)
+
+scenarios, each reporting rows/sec, api requests per row and p50/p99 latency per operation:
+ - scrape:     scrape_submissions_to_db for every term on an empty db (op = one term)
+ - comments:   scrape_comments_to_db for --comment-submissions submissions (op = one submission)
+ - stats:      update_selected_submission_stats in batches of --stats-batch (op = one batch)
+ - dispatch:   ScrapeScheduler.scrape_and_reschedule for every term once the db is populated, the
+               monitor's steady state (op = one dispatch, row = one dispatch)
+--engine async runs the same scenarios through async_ingest.py / monitor.AsyncScrapeScheduler, with
+every op of a scenario in flight at once
+results are compared with the stored baseline for the engine (ingest_baseline[_async].json), exit
+code 1 on a regression larger than --tolerance. --save-baseline overwrites it
+"""
+
+
+BASELINES = {
+    "threads": os.path.join(BENCH_DIR, "ingest_baseline.json"),
+    "async": os.path.join(BENCH_DIR, "ingest_baseline_async.json"),
+}
+HIGHER_IS_BETTER = {"rows_per_sec"}
+COMPARED = ["rows_per_sec", "requests_per_row", "p50_ms", "p99_ms"]
+
+
+def configure_env(standin_url, db_path):
+    """must run before the db connection and reddit clients are created, they read their config then"""
+    os.environ.update({
+        "VSM_BACKEND": "sqlite",
+        "VSM_SQLITE_PATH": db_path,
+        "REDDIT_ID": "bench",
+        "REDDIT_SECRET": "bench",
+        "REDDIT_OAUTH_URL": standin_url,
+        "REDDIT_URL": standin_url,
+        "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", "bench"),
+        "METRICS_PORT": "0",
+        "praw_check_for_updates": "False",
+    })
+    for name in ["REDDIT_ID_2", "SCRAPE_DAILY_BUDGET", "TERM_YIELD_FILE", "TRACE_FILE"]:
+        os.environ.pop(name, None)
+
+
+class Scenario:
+    def __init__(self, name, server):
+        self.name = name
+        self.server = server
+        self.latencies = []
+        self.rows = 0
+
+    def __enter__(self):
+        self.requests_before = sum(self.server.snapshot().values())
+        self.start = time.perf_counter()
+        return self
+
+    @contextlib.contextmanager
+    def op(self):
+        start = time.perf_counter()
+        yield
+        self.latencies.append(time.perf_counter() - start)
+
+    async def timed(self, coro):
+        start = time.perf_counter()
+        result = await coro
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.requests = sum(self.server.snapshot().values()) - self.requests_before
+
+    def result(self):
+        latencies = np.array(self.latencies or [0.0]) * 1000
+        return {
+            "rows": self.rows,
+            "seconds": round(self.seconds, 3),
+            "rows_per_sec": round(self.rows / self.seconds, 1) if self.seconds else 0.0,
+            "requests": self.requests,
+            "requests_per_row": round(self.requests / self.rows, 3) if self.rows else 0.0,
+            "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+            "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+        }
+
+
+def count_rows(table):
+    from vsm import getcursor
+    with getcursor() as cur:
+        cur.execute(f"SELECT COUNT(*) FROM {table}")
+        return cur.fetchone()[0]
+
+
+def setup_db(args):
+    from vsm import getcursor, init_connection
+    logging.getLogger().setLevel(logging.WARNING)  # per-submission info logging would dominate the timings
+    init_connection()
+    terms = [f"bench term {i}" for i in range(args.terms)]
+    with getcursor() as cur:
+        for term in terms:
+            cur.execute("INSERT INTO search_term (name) VALUES (%s) ON CONFLICT DO NOTHING", (term,))
+    return terms
+
+
+def submission_ids():
+    from vsm import getcursor
+    with getcursor() as cur:
+        cur.execute("SELECT id FROM reddit_submission ORDER BY id")
+        return [row[0] for row in cur.fetchall()]
+
+
+def run(args, server):
+    from vsm import getcursor
+    from scrape import scrape_submissions_to_db, scrape_comments_to_db, make_reddit_api_interface
+    from update_submissions import update_selected_submission_stats
+    from monitor import ScrapeScheduler
+
+    terms = setup_db(args)
+    results = {}
+
+    with Scenario("scrape", server) as s:
+        reddit = make_reddit_api_interface()
+        for term in terms:
+            with s.op(), getcursor() as cur:
+                s.rows += scrape_submissions_to_db(cur, [term], reddit=reddit)
+    results["scrape"] = s.result()
+
+    ids = submission_ids()
+    with Scenario("comments", server) as s:
+        before = count_rows("reddit_comment")
+        for submission_id in ids[:args.comment_submissions]:
+            with s.op(), getcursor() as cur:
+                scrape_comments_to_db(cur, submission_id)
+        s.rows = count_rows("reddit_comment") - before
+    results["comments"] = s.result()
+
+    stats_ids = ids[:args.stats_submissions]
+    with Scenario("stats", server) as s, contextlib.redirect_stdout(open(os.devnull, "w")):
+        for i in range(0, len(stats_ids), args.stats_batch):
+            with s.op():
+                update_selected_submission_stats(stats_ids[i:i + args.stats_batch])
+        s.rows = len(stats_ids)
+    results["stats"] = s.result()
+
+    scheduler = ScrapeScheduler(max_workers=1)
+    scheduler.executor.shutdown()  # dispatches are run inline below
+    with Scenario("dispatch", server) as s:
+        for term in terms:
+            with s.op():
+                scheduler.scrape_and_reschedule(term)
+            s.rows += 1
+    results["dispatch"] = s.result()
+    return results
+
+
+async def run_async(args, server):
+    from async_ingest import AsyncIngest
+    from monitor import AsyncScrapeScheduler
+
+    terms = setup_db(args)
+    results = {}
+    ingest = AsyncIngest()
+    try:
+        with Scenario("scrape", server) as s:
+            counts = await asyncio.gather(*(s.timed(ingest.scrape_term(term)) for term in terms))
+            s.rows = sum(counts)
+        results["scrape"] = s.result()
+
+        ids = submission_ids()
+        with Scenario("comments", server) as s:
+            counts = await asyncio.gather(*(s.timed(ingest.scrape_comments(i))
+                                            for i in ids[:args.comment_submissions]))
+            s.rows = sum(counts)
+        results["comments"] = s.result()
+
+        stats_ids = ids[:args.stats_submissions]
+        batches = [stats_ids[i:i + args.stats_batch] for i in range(0, len(stats_ids), args.stats_batch)]
+        with Scenario("stats", server) as s:
+            await asyncio.gather(*(s.timed(ingest.refresh_stats(batch)) for batch in batches))
+            s.rows = len(stats_ids)
+        results["stats"] = s.result()
+    finally:
+        await ingest.close()
+
+    scheduler = AsyncScrapeScheduler()
+    try:
+        with Scenario("dispatch", server) as s:
+            await asyncio.gather(*(s.timed(scheduler.scrape_and_reschedule_async(term)) for term in terms))
+            s.rows = len(terms)
+        results["dispatch"] = s.result()
+    finally:
+        await scheduler.ingest.close()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """prints the change against the baseline per metric. returns the regressions"""
+    regressions = []
+    for scenario, metrics in results.items():
+        base = baseline.get(scenario)
+        if not base:
+            continue
+        for metric in COMPARED:
+            old, new = base.get(metric), metrics.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            flag = " REGRESSION" if worse > tolerance else ""
+            print(f"  {scenario:<9} {metric:<17} {old:>10} -> {new:>10} ({change:+.1%}){flag}")
+            if flag:
+                regressions.append((scenario, metric, old, new))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--terms", type=int, default=20)
+    parser.add_argument("--submissions-per-term", type=int, default=300)
+    parser.add_argument("--comments-per-submission", type=int, default=40)
+    parser.add_argument("--comment-submissions", type=int, default=50)
+    parser.add_argument("--stats-submissions", type=int, default=500)
+    parser.add_argument("--stats-batch", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds the stand-in adds to every response")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=int, default=None, help="stand-in requests per 600s window")
+    parser.add_argument("--fixtures", help="replay recorded responses instead of synthetic ones")
+    parser.add_argument("--engine", choices=list(BASELINES), default="threads")
+    parser.add_argument("--baseline", help="defaults to the stored baseline for --engine")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative change counted as a regression")
+    parser.add_argument("--output", help="also write the results json here")
+    args = parser.parse_args()
+    args.baseline = args.baseline or BASELINES[args.engine]
+
+    config = {k: v for k, v in vars(args).items()
+              if k not in ("baseline", "save_baseline", "tolerance", "output")}
+    backend = Fixtures(args.fixtures) if args.fixtures else SyntheticReddit(
+        args.submissions_per_term, args.comments_per_submission)
+    server_kwargs = {"latency": args.latency, "jitter": args.jitter}
+    if args.rate_limit:
+        server_kwargs["rate_limit"] = args.rate_limit
+    server = start_standin(backend, **server_kwargs)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        configure_env(server.url, os.path.join(tmp, "bench.sqlite3"))
+        os.chdir(tmp)  # anything the code under test writes relative to the cwd (logs/, cache/) stays in tmp
+        try:
+            results = asyncio.run(run_async(args, server)) if args.engine == "async" else run(args, server)
+        finally:
+            os.chdir(cwd)
+    server.shutdown()
+
+    print(json.dumps(results, indent=2))
+    output = {"config": config, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(output, f, indent=2)
+        print(f"saved baseline to {args.baseline}")
+        return
+    if not os.path.isfile(args.baseline):
+        print(f"no baseline at {args.baseline}, run with --save-baseline to create one")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("config") != config:
+        print("warning: baseline was recorded with a different config, the comparison is only indicative")
+    print(f"compared with {args.baseline}:")
+    regressions = compare(results, baseline["results"], args.tolerance)
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
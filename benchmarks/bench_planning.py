@@ -0,0 +1,254 @@
+import os
+import sys
+import time
+import math
+import argparse
+import tempfile
+from collections import defaultdict
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+
+"""
+scheduler planning benchmark: how long the monitor takes to turn every term's recent submissions into
+demand, a budget allocation and a first scrape time, for synthetic term sets of growing size
+ - legacy: the per-term python path the monitor used before (dict of row lists, pairwise super-term
+   check, per-term estimate, set_demand + reallocation per term), copied below. only run up to
+   --legacy-max-terms, it is quadratic in the number of terms
+ - vectorized: vsm.get_recent_submission_arrays -> monitor.estimate_demand ->
+   ScrapeBudget.set_demands -> monitor.plan_schedule
+rows come from an in-memory cursor, so this times planning only. --db also loads them from a
+throwaway sqlite db (VSM_BACKEND=sqlite) through the real queries
+when both paths run, their demand and intervals are checked to be identical
+"""
+
+
+SUBMISSIONS_PER_TERM = 50  # what the monitor pulls per term
+VOCABULARY = 50000
+
+
+def synthetic_terms(n_terms, seed=0):
+    """(term rows [(id, name)], submission rows [(term id, created_utc)]), with ~10% super-terms,
+    quiet terms (0-1 submissions) and terms whose submissions share a timestamp"""
+    rng = np.random.default_rng(seed)
+    names = set()
+    while len(names) < n_terms * 0.9:
+        n_words = int(rng.choice([1, 2, 2, 3, 3, 4]))
+        names.add(" ".join(f"w{i}" for i in rng.choice(VOCABULARY, n_words, replace=False)))
+    base = sorted(names)
+    while len(names) < n_terms:
+        names.add(f"{base[rng.integers(len(base))]} w{rng.integers(VOCABULARY)}")
+    term_rows = list(enumerate(sorted(names), start=1))
+
+    counts = rng.choice([0, 1, SUBMISSIONS_PER_TERM], size=n_terms, p=[0.05, 0.05, 0.9])
+    term_ids = np.repeat(np.arange(1, n_terms + 1), counts)
+    # posting rates from a few a month to thousands a day
+    mean_gap = np.repeat(10 ** rng.uniform(1, 6, size=n_terms), counts)
+    created = 1.75e9 - rng.exponential(mean_gap)
+    created[term_ids % 97 == 0] = 1.75e9  # all in the same second
+    created = np.round(created)
+    return term_rows, list(zip(term_ids.tolist(), created.tolist()))
+
+
+class ListCursor:
+    """answers get_recent_submission_arrays' two queries from memory"""
+    def __init__(self, term_rows, submission_rows):
+        self.results = [term_rows, submission_rows]
+
+    def execute(self, query, params=None):
+        if "pg_partitioned_table" in query:
+            self.results.insert(0, [])  # vsm.partitioned_tables(): not partitioned
+
+    def fetchall(self):
+        return self.results.pop(0)
+
+
+# ---- the per-term path, as the monitor had it ----
+
+def legacy_terms(term_rows, submission_rows):
+    names = dict(term_rows)
+    data = defaultdict(list)
+    for _, name in term_rows:
+        data.setdefault(name.lower(), [])
+    for i, (term_id, created_utc) in enumerate(submission_rows):
+        data[names[term_id].lower()].append((i, created_utc))
+    terms = sorted(data.keys())
+
+    def is_super_term(a, b):
+        a_words = a.split()
+        b_words = b.split()
+        if len(b_words) <= len(a_words):
+            return False
+        return all(word in b_words for word in a_words)
+    good_terms = set()
+    for term in terms:
+        if not any(is_super_term(comparison, term) for comparison in terms if comparison != term):
+            good_terms.add(term)
+    return {term: data[term] for term in good_terms}
+
+
+def legacy_estimate(recent_submissions):
+    from monitor import SECONDS_PER_DAY
+    if len(recent_submissions) < 2:
+        return 0.0
+    timestamps = sorted(float(s[1]) for s in recent_submissions)
+    time_span = max(timestamps[-1] - timestamps[0], 1)
+    return SECONDS_PER_DAY / (time_span / (len(timestamps) - 1))
+
+
+def legacy_scrapes(recent_submissions):
+    from monitor import MIN_SCRAPES_PER_DAY, MAX_SCRAPES_PER_DAY, MULTIPLIER
+    if len(recent_submissions) < 2:
+        return MIN_SCRAPES_PER_DAY
+    rate = legacy_estimate(recent_submissions)
+    return math.ceil(min(MAX_SCRAPES_PER_DAY, max(MIN_SCRAPES_PER_DAY, MULTIPLIER * (rate / 250))))
+
+
+class LegacyBudget:
+    def __init__(self, daily_requests, precision):
+        from scrape_budget import MIN_SCRAPES_PER_DAY, LOW_YIELD_PRECISION
+        self.min, self.low = MIN_SCRAPES_PER_DAY, LOW_YIELD_PRECISION
+        self.daily_requests = daily_requests
+        self.precision = precision
+        self.demand = {}
+        self.allocation = {}
+
+    def term_precision(self, term):
+        if term.lower() in self.precision:
+            return self.precision[term.lower()]
+        if self.precision:
+            return sum(self.precision.values()) / len(self.precision)
+        return 1.0
+
+    def expected_relevant_per_request(self, term):
+        submissions_per_day, scrapes_per_day = self.demand[term]
+        return self.term_precision(term) * submissions_per_day / scrapes_per_day
+
+    def set_demand(self, term, submissions_per_day, scrapes_per_day):
+        self.demand[term] = (submissions_per_day, scrapes_per_day)
+        self.allocate()
+
+    def allocate(self):
+        allocation = {term: self.min for term in self.demand}
+        candidates = [term for term in self.demand if self.term_precision(term) >= self.low]
+        if self.daily_requests is None:
+            for term in candidates:
+                allocation[term] = max(self.min, self.demand[term][1])
+        else:
+            remaining = self.daily_requests - sum(allocation.values())
+            candidates.sort(key=self.expected_relevant_per_request, reverse=True)
+            for term in candidates:
+                if remaining <= 0:
+                    break
+                extra = min(remaining, self.demand[term][1] - self.min)
+                if extra > 0:
+                    allocation[term] += extra
+                    remaining -= extra
+        self.allocation = allocation
+
+    def interval_for(self, term):
+        return 86400 / max(self.allocation.get(term, self.min), self.min)
+
+
+def legacy_plan(term_rows, submission_rows, daily_requests, precision, now):
+    terms = legacy_terms(term_rows, submission_rows)
+    # sorted: the monitor's order came from a set, budget ties would otherwise break differently
+    demand = [(term, legacy_estimate(s), legacy_scrapes(s)) for term, s in sorted(terms.items())]
+    budget = LegacyBudget(daily_requests, precision)
+    for term, submissions_per_day, scrapes_per_day in demand:
+        budget.set_demand(term, submissions_per_day, scrapes_per_day)
+    intervals = sorted(((term, budget.interval_for(term)) for term, _, _ in demand), key=lambda x: x[1])
+    tasks = [(now + interval / len(intervals) * i, term) for i, (term, interval) in enumerate(intervals)]
+    return demand, budget.allocation, tasks
+
+
+def vectorized_plan(cur, daily_requests, precision, now):
+    from monitor import get_all_terms_and_demand, plan_schedule
+    from scrape_budget import ScrapeBudget
+    demand = get_all_terms_and_demand(cur)
+    budget = ScrapeBudget(daily_requests)
+    budget.precision = precision
+    budget.default_precision = sum(precision.values()) / len(precision)
+    budget.set_demands(demand)
+    tasks = plan_schedule(budget, [term for term, _, _ in demand], now)
+    return demand, budget.allocation, tasks
+
+
+def synthetic_precision(term_rows, seed=0):
+    """label precision for half the terms, a few of them below the demotion cutoff"""
+    rng = np.random.default_rng(seed + 1)
+    return {name.lower(): float(p) for (_, name), p in zip(term_rows[::2], rng.beta(0.8, 4, len(term_rows[::2])))}
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def check_same(legacy, vectorized):
+    legacy_demand, legacy_allocation, _ = legacy
+    demand, allocation, _ = vectorized
+    assert dict((t, (a, b)) for t, a, b in legacy_demand) == dict((t, (a, b)) for t, a, b in demand), "demand differs"
+    assert legacy_allocation == allocation, "allocation differs"
+
+
+def load_db(path, term_rows, submission_rows):
+    os.environ.update({"VSM_BACKEND": "sqlite", "VSM_SQLITE_PATH": path})
+    from vsm import getcursor, init_connection
+    init_connection()
+    with getcursor() as cur:
+        cur.execute("DELETE FROM search_term_match_reddit_submission")
+        cur.execute("DELETE FROM reddit_submission")
+        cur.execute("DELETE FROM search_term")
+        cur.executemany("INSERT INTO search_term (id, name) VALUES (%s, %s)", term_rows)
+        cur.executemany("INSERT INTO reddit_submission (id, created_utc) VALUES (%s, %s)",
+                        [(f"s{i}", created) for i, (_, created) in enumerate(submission_rows)])
+        cur.executemany("INSERT INTO search_term_match_reddit_submission (submission_id, search_term_id, created_utc) "
+                        "VALUES (%s, %s, %s)",
+                        [(f"s{i}", term_id, created) for i, (term_id, created) in enumerate(submission_rows)])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--legacy-max-terms", type=int, default=1000)
+    parser.add_argument("--budget", type=int, default=None, help="daily listing request budget, default unlimited")
+    parser.add_argument("--repeat", type=int, default=3, help="vectorized runs per size, best is reported")
+    parser.add_argument("--db", action="store_true", help="also time loading the rows from sqlite")
+    args = parser.parse_args()
+    os.environ.update({"VSM_BACKEND": "sqlite", "REDDIT_ID": "bench", "REDDIT_SECRET": "bench",
+                       "praw_check_for_updates": "False"})
+    now = time.time()
+    tmp = tempfile.TemporaryDirectory()
+
+    print(f"{'terms':>7} {'rows':>9} {'legacy':>10} {'vectorized':>11} {'speedup':>8}"
+          + (f" {'from db':>9}" if args.db else ""))
+    for n_terms in args.sizes:
+        term_rows, submission_rows = synthetic_terms(n_terms)
+        precision = synthetic_precision(term_rows)
+        vectorized, seconds = min((timed(vectorized_plan, ListCursor(term_rows, submission_rows),
+                                         args.budget, precision, now) for _ in range(args.repeat)),
+                                  key=lambda r: r[1])
+        legacy_seconds = None
+        if n_terms <= args.legacy_max_terms:
+            legacy, legacy_seconds = timed(legacy_plan, term_rows, submission_rows, args.budget, precision, now)
+            check_same(legacy, vectorized)
+        line = (f"{n_terms:>7} {len(submission_rows):>9} "
+                + (f"{legacy_seconds * 1000:>8.0f}ms" if legacy_seconds else f"{'skipped':>10}")
+                + f" {seconds * 1000:>9.1f}ms"
+                + (f" {legacy_seconds / seconds:>7.0f}x" if legacy_seconds else f" {'':>8}"))
+        if args.db:
+            from vsm import getcursor
+            load_db(os.path.join(tmp.name, "plan.sqlite3"), term_rows, submission_rows)
+            with getcursor() as cur:
+                _, db_seconds = timed(vectorized_plan, cur, args.budget, precision, now)
+            line += f" {db_seconds * 1000:>7.0f}ms"
+        print(line)
+    tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
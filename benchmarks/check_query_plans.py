@@ -0,0 +1,240 @@
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+from sqlite_backend import SqliteCursor  # noqa: E402
+
+
+"""
+query plan regression check: runs the hot queries of vsm.py, scrape.py, term_lifecycle.py and
+analysis/projects.py through their real functions against a seeded db, EXPLAINs every statement they
+execute and exits 1 when a plan has a sequential scan or a sort that an index
+(migrations.HOT_QUERY_INDEXES) should avoid
+ - sqlite (default): a throwaway db created by the migrations, EXPLAIN QUERY PLAN. flags "SCAN <table>"
+   without an index, automatic (temporary) indexes and "USE TEMP B-TREE" sorts
+ - --postgres: the configured postgres db, everything happens in a scratch schema inside one transaction
+   that is rolled back. EXPLAIN (FORMAT JSON) with enable_seqscan / enable_sort off, so the planner
+   only falls back to a Seq Scan or Sort node when no index can serve the query, however small the seed
+the queries that read every active term are allowed to scan search_term, nothing else is
+"""
+
+
+EXPLAINABLE = re.compile(r"\s*(SELECT|WITH|UPDATE|DELETE)\b", re.IGNORECASE)
+CATALOG = re.compile(r"\b(information_schema|pg_catalog)\.", re.IGNORECASE)  # column lookups, not hot queries
+TABLE_ALIAS = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+PARTITION_SUFFIX = re.compile(r"_(y\d{4}m\d{2}|default)$")
+SORT_NODES = {"Sort", "Incremental Sort"}
+
+
+class PlanRecorder:
+    """[(sql, plan)] of every statement executed through an explaining cursor"""
+
+    def __init__(self):
+        self.plans = []
+
+    def cursor(self, cur):
+        if isinstance(cur, SqliteCursor):
+            return ExplainingSqliteCursor(cur.cursor, self)
+        return ExplainingCursor(cur, self)
+
+
+class ExplainingSqliteCursor(SqliteCursor):
+    """still a SqliteCursor, so the code under check takes its sqlite paths"""
+
+    def __init__(self, cursor, recorder):
+        super().__init__(cursor)
+        self.recorder = recorder
+
+    def execute(self, sql, params=()):
+        if EXPLAINABLE.match(sql):
+            super().execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            self.recorder.plans.append((sql, [row[3] for row in self.fetchall()]))
+        return super().execute(sql, params)
+
+
+class ExplainingCursor:
+    """wraps a psycopg2 cursor"""
+
+    def __init__(self, cur, recorder):
+        self.cur = cur
+        self.recorder = recorder
+
+    def execute(self, sql, params=None):
+        if EXPLAINABLE.match(sql) and not CATALOG.search(sql):
+            self.cur.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            self.recorder.plans.append((sql, self.cur.fetchone()[0][0]["Plan"]))
+        return self.cur.execute(sql, params)
+
+    def __iter__(self):
+        return iter(self.cur)
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+
+def table_aliases(sql):
+    aliases = {}
+    for table, alias in TABLE_ALIAS.findall(sql):
+        aliases[table] = table
+        if alias and alias.upper() not in {"ON", "WHERE", "JOIN", "LEFT", "INNER", "CROSS", "ORDER", "GROUP"}:
+            aliases[alias] = table
+    return aliases
+
+
+def sqlite_problems(sql, plan, tables, allowed):
+    aliases = table_aliases(sql)
+    problems = []
+    for detail in plan:
+        if "TEMP B-TREE" in detail:
+            problems.append(f"sort: {detail}")
+        elif "AUTOMATIC" in detail:
+            problems.append(f"no usable index: {detail}")
+        match = re.match(r"SCAN (\w+)(.*)", detail)
+        if match and "INDEX" not in match.group(2) and "VIRTUAL TABLE" not in match.group(2):
+            table = aliases.get(match.group(1), match.group(1))
+            if table in tables and table not in allowed:  # scans of subqueries and CTEs are fine
+                problems.append(f"sequential scan: {detail}")
+    return problems
+
+
+def postgres_problems(sql, plan, tables, allowed):
+    problems = []
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.get("Plans", []))
+        if node["Node Type"] in SORT_NODES:
+            problems.append(f"sort: {node['Node Type']} on {', '.join(node.get('Sort Key', []))}")
+        elif node["Node Type"] == "Seq Scan":
+            table = PARTITION_SUFFIX.sub("", node["Relation Name"])
+            if table not in allowed:
+                problems.append(f"sequential scan: {node['Relation Name']}")
+    return problems
+
+
+def seed(cur, n_terms, n_submissions, now, rng):
+    """terms with a skewed number of matches (a few with thousands, most with a handful), 10% retired,
+    submissions over the last year. returns the term names, ids by name"""
+    from vsm import execute_values
+    names = [f"term {i}" for i in range(n_terms)]
+    execute_values(cur, "INSERT INTO search_term (id, name) VALUES %s", [(i + 1, name) for i, name in enumerate(names)])
+    cur.execute("UPDATE search_term SET retired_at = CURRENT_TIMESTAMP WHERE id % 10 = 0")
+    submissions = []
+    matches = set()
+    weights = [1 / (i + 1) for i in range(n_terms)]
+    for i in range(n_submissions):
+        created = now - rng.random() * 365 * 86400
+        submissions.append((f"s{i}", created, f"title {i}", rng.randint(0, 500), rng.randint(0, 100)))
+        for term_id in rng.choices(range(1, n_terms + 1), weights, k=rng.randint(1, 3)):
+            matches.add((f"s{i}", term_id, created))
+    execute_values(cur, "INSERT INTO reddit_submission (id, created_utc, title, score, num_comments) VALUES %s",
+                   submissions)
+    execute_values(cur, "INSERT INTO search_term_match_reddit_submission (submission_id, search_term_id, created_utc) "
+                   "VALUES %s", sorted(matches))
+    execute_values(cur, "INSERT INTO search_term_match_reddit_comment (comment_id, search_term_id) VALUES %s",
+                   [(f"c{i}", rng.randint(1, n_terms)) for i in range(n_submissions // 10)])
+    cur.execute("ANALYZE")
+    return names, {name: i + 1 for i, name in enumerate(names)}
+
+
+def hot_queries(names, term_ids, now):
+    """(name, function(cur), tables it may scan in full)"""
+    import vsm
+    import scrape
+    import term_lifecycle
+    from analysis import projects
+    busiest = names[1]
+    return [
+        ("scheduler: newest submissions of every term (arrays)",
+         lambda cur: vsm.get_recent_submission_arrays(cur), {"search_term"}),
+        ("scheduler: newest submissions of every term",
+         lambda cur: vsm.get_recent_submissions_for_all_terms(cur), {"search_term"}),
+        ("scheduler: newest submissions of one term",
+         lambda cur: vsm.get_recent_submimssions_for_term(cur, busiest), set()),
+        ("scrape: existing submission ids of a term",
+         lambda cur: scrape.get_existing_submission_ids(cur, term_ids[busiest]), set()),
+        ("prune: term ids by name",
+         lambda cur: term_lifecycle.get_term_ids(cur, names[:50]), set()),
+        ("prune: matches of the terms",
+         lambda cur: term_lifecycle.count_matches(cur, [term_ids[name] for name in names[:50]]), set()),
+        ("projects: matches since the watermark",
+         lambda cur: list(projects.iter_submissions_for_terms(cur, names[:11], now - 7 * 86400)), set()),
+    ]
+
+
+def connect_sqlite(path):
+    os.environ.update({"VSM_BACKEND": "sqlite", "VSM_SQLITE_PATH": path, "REDDIT_ID": "check",
+                       "REDDIT_SECRET": "check", "praw_check_for_updates": "False"})
+    import vsm
+    vsm.init_connection()  # runs the migrations on the fresh db
+
+
+def run_checks(cur, recorder, names, term_ids, now, verbose):
+    sqlite = isinstance(cur, SqliteCursor)
+    if sqlite:
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    else:
+        cur.execute("SELECT tablename FROM pg_tables WHERE schemaname = current_schema()")
+    tables = {row[0] for row in cur.fetchall()}
+    failed = 0
+    for name, function, allowed in hot_queries(names, term_ids, now):
+        recorder.plans = []
+        function(recorder.cursor(cur))
+        problems = []
+        for sql, plan in recorder.plans:
+            found = (sqlite_problems if sqlite else postgres_problems)(sql, plan, tables, allowed)
+            problems += [(sql, problem) for problem in found]
+            if verbose:
+                print(" ".join(sql.split()))
+                print("  " + ("\n  ".join(plan) if sqlite else str(plan)))
+        print(f"{'FAIL' if problems else 'ok':<5} {name} ({len(recorder.plans)} statements)")
+        for sql, problem in problems:
+            print(f"      {problem}\n        in: {' '.join(sql.split())[:160]}")
+        failed += bool(problems)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--terms", type=int, default=300)
+    parser.add_argument("--submissions", type=int, default=30000)
+    parser.add_argument("--postgres", action="store_true",
+                        help="check against the configured postgres db, in a scratch schema that is rolled back")
+    parser.add_argument("--verbose", action="store_true", help="print every statement and its plan")
+    args = parser.parse_args()
+    now = time.time()
+    rng = random.Random(0)
+    recorder = PlanRecorder()
+
+    if args.postgres:
+        import vsm
+        import migrations
+        vsm.init_connection()
+        with vsm.getcursor(commit=False) as cur:
+            cur.execute("CREATE SCHEMA query_plan_check")
+            cur.execute("SET LOCAL search_path TO query_plan_check")
+            migrations.migrate(cur)
+            names, term_ids = seed(cur, args.terms, args.submissions, now, rng)
+            cur.execute("SET LOCAL enable_seqscan = off")
+            cur.execute("SET LOCAL enable_sort = off")
+            failed = run_checks(cur, recorder, names, term_ids, now, args.verbose)
+    else:
+        tmp = tempfile.TemporaryDirectory()
+        connect_sqlite(os.path.join(tmp.name, "plans.sqlite3"))
+        import vsm
+        with vsm.getcursor() as cur:
+            names, term_ids = seed(cur, args.terms, args.submissions, now, rng)
+        with vsm.getcursor(commit=False) as cur:
+            failed = run_checks(cur, recorder, names, term_ids, now, args.verbose)
+    print(f"{failed} of {len(hot_queries(names, term_ids, now))} hot queries have a sequential scan or sort")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+"""
+local http stand-in for the reddit api, for offline benchmarks
+point praw at it with REDDIT_OAUTH_URL=http://127.0.0.1:<port> REDDIT_URL=http://127.0.0.1:<port>
+(reddit_pool.py passes both to every praw instance)
+
+serves the endpoints the scraper uses:
+ - POST /api/v1/access_token
+ - GET  /r/all/search      pages of 100 submissions, newest first, with `after`
+ - GET  /comments/<id>     the submission plus its first comments and a "more" object for the rest
+ - POST /api/morechildren  up to 100 of the requested children per call, the rest in a new "more"
+ - GET  /api/info          submissions by fullname
+responses are either synthetic (SyntheticReddit, deterministic per term / id) or replayed from a
+directory of recorded responses (Fixtures, written by `python benchmarks/reddit_standin.py record`)
+
+every response waits latency (+ up to jitter) seconds and carries x-ratelimit-* headers for a
+rate_limit requests per window budget (429 once it's used up), so praw's own rate limiter
+behaves the way it does against reddit
+"""
+
+
+DEFAULT_RATE_LIMIT = 1_000_000  # requests per window, high enough that praw never paces by default
+DEFAULT_WINDOW = 600
+PAGE_SIZE = 100
+MORECHILDREN_BATCH = 100
+BASE_CREATED_UTC = 1_750_000_000
+IGNORED_PARAMS = {"raw_json", "count", "api_type"}  # don't change what reddit returns
+
+
+def to_base36(n):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = ""
+    while n:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+    return out or "0"
+
+
+def listing(children, after=None):
+    return {"kind": "Listing", "data": {"after": after, "before": None, "dist": len(children),
+                                        "children": children}}
+
+
+class SyntheticReddit:
+    """deterministic fake content. each term has submissions_per_term submissions spaced
+    seconds_between_submissions apart, each submission comments_per_submission comments of which
+    inline_comments come with the submission and the rest have to be fetched through morechildren"""
+
+    def __init__(self, submissions_per_term=300, comments_per_submission=40, inline_comments=10,
+                 seconds_between_submissions=600):
+        self.submissions_per_term = submissions_per_term
+        self.comments_per_submission = comments_per_submission
+        self.inline_comments = inline_comments
+        self.seconds_between_submissions = seconds_between_submissions
+
+    def term_ids(self, term):
+        """submission ids for a term, newest first"""
+        base = (zlib.crc32(term.encode("utf-8")) % 1_000_000 + 1) * 10_000_000
+        return [to_base36(base + i) for i in range(self.submissions_per_term)]
+
+    def submission(self, submission_id, term=None):
+        n = int(submission_id, 36)
+        rng = random.Random(n)
+        age = (n % 10_000_000) * self.seconds_between_submissions
+        subreddit = rng.choice(["news", "politics", "science", "health", "askreddit"])
+        return {"kind": "t3", "data": {
+            "id": submission_id, "name": f"t3_{submission_id}",
+            "title": f"synthetic submission {submission_id} about {term or 'the news'}",
+            "url": f"https://example.com/{submission_id}", "domain": "example.com",
+            "permalink": f"/r/{subreddit}/comments/{submission_id}/synthetic/",
+            "created_utc": float(BASE_CREATED_UTC - age), "url_overridden_by_dest": None,
+            "subreddit": subreddit, "subreddit_id": f"t5_{to_base36(zlib.crc32(subreddit.encode()))}",
+            "author": "[deleted]", "upvote_ratio": round(rng.uniform(0.5, 1), 2),
+            "score": rng.randint(0, 5000), "gilded": 0, "num_comments": self.comments_per_submission,
+            "num_crossposts": rng.randint(0, 3), "pinned": False, "stickied": False, "over_18": False,
+            "is_created_from_ads_ui": False, "is_self": False, "is_video": False, "media": None,
+            "gildings": {}, "all_awardings": [],
+        }}
+
+    def comment_ids(self, submission_id):
+        base = int(submission_id, 36) * 1000
+        return [to_base36(base + i) for i in range(self.comments_per_submission)]
+
+    def comment(self, comment_id, submission_id):
+        rng = random.Random(int(comment_id, 36))
+        return {"kind": "t1", "data": {
+            "id": comment_id, "name": f"t1_{comment_id}", "parent_id": f"t3_{submission_id}",
+            "link_id": f"t3_{submission_id}", "body": f"synthetic comment {comment_id} " * 4,
+            "permalink": f"/r/news/comments/{submission_id}/synthetic/{comment_id}/",
+            "created_utc": float(BASE_CREATED_UTC + rng.randint(0, 86400)), "subreddit_id": "t5_news",
+            "subreddit_type": "public", "total_awards_received": 0, "subreddit": "news",
+            "author": "[deleted]", "score": rng.randint(-5, 500), "gilded": 0, "stickied": False,
+            "is_submitter": False, "gildings": {}, "all_awardings": [], "replies": "", "depth": 0,
+        }}
+
+    def more(self, children, submission_id):
+        return {"kind": "more", "data": {
+            "id": children[0], "name": f"t1_{children[0]}", "parent_id": f"t3_{submission_id}",
+            "count": len(children), "children": children, "depth": 0,
+        }}
+
+    def search(self, params):
+        ids = self.term_ids(params.get("q", ""))
+        start = 0
+        if params.get("after"):
+            after = params["after"].split("_", 1)[-1]
+            start = ids.index(after) + 1 if after in ids else len(ids)
+        page = ids[start:start + min(int(params.get("limit", PAGE_SIZE)), PAGE_SIZE)]
+        after = f"t3_{page[-1]}" if page and start + len(page) < len(ids) else None
+        return listing([self.submission(i, params.get("q")) for i in page], after)
+
+    def comments(self, submission_id, params):
+        ids = self.comment_ids(submission_id)
+        inline = [self.comment(i, submission_id) for i in ids[:self.inline_comments]]
+        if len(ids) > self.inline_comments:
+            inline.append(self.more(ids[self.inline_comments:], submission_id))
+        return [listing([self.submission(submission_id)]), listing(inline)]
+
+    def morechildren(self, params):
+        submission_id = params["link_id"].split("_", 1)[-1]
+        children = [c for c in params.get("children", "").split(",") if c]
+        things = [self.comment(c, submission_id) for c in children[:MORECHILDREN_BATCH]]
+        if len(children) > MORECHILDREN_BATCH:
+            things.append(self.more(children[MORECHILDREN_BATCH:], submission_id))
+        return {"json": {"errors": [], "data": {"things": things}}}
+
+    def info(self, params):
+        fullnames = [f for f in params.get("id", "").split(",") if f.startswith("t3_")]
+        return listing([self.submission(f[3:]) for f in fullnames])
+
+    def respond(self, method, path, params):
+        """(status, json body) for a request"""
+        parts = path.strip("/").split("/")
+        if path.endswith("/search"):
+            return 200, self.search(params)
+        if parts[0] == "comments" and len(parts) > 1:
+            return 200, self.comments(parts[1], params)
+        if parts[-1] == "morechildren":
+            return 200, self.morechildren(params)
+        if parts[-1] == "info":
+            return 200, self.info(params)
+        return 404, {"message": "Not Found", "error": 404}
+
+
+def request_key(method, path, params):
+    """file name a request's response is recorded under"""
+    params = sorted((k, v) for k, v in params.items() if k not in IGNORED_PARAMS)
+    raw = json.dumps([method.upper(), "/" + path.strip("/"), params])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class Fixtures:
+    """replays responses recorded by RecordingRequestor, 404 for anything that wasn't recorded"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def respond(self, method, path, params):
+        path = os.path.join(self.directory, request_key(method, path, params) + ".json")
+        if not os.path.isfile(path):
+            return 404, {"message": "Not Found", "error": 404}
+        with open(path, encoding="utf-8") as f:
+            return 200, json.load(f)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body go out in separate writes, don't wait on delayed acks
+
+    def do_GET(self):
+        self.handle_request(dict(parse_qsl(urlsplit(self.path).query)))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8")
+        params = dict(parse_qsl(urlsplit(self.path).query))
+        params.update(parse_qsl(body))
+        self.handle_request(params)
+
+    def handle_request(self, params):
+        server = self.server
+        path = urlsplit(self.path).path.rstrip("/") or "/"
+        endpoint = server.count(self.command, path)
+        if server.latency or server.jitter:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+        if endpoint == "access_token":
+            status, body = 200, {"access_token": "standin-token", "token_type": "bearer",
+                                 "expires_in": 86400, "scope": "*"}
+        else:
+            remaining, used, reset = server.take_request()
+            if remaining < 0:
+                status, body = 429, {"message": "Too Many Requests", "error": 429}
+            else:
+                status, body = server.backend.respond(self.command, path, params)
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        if endpoint != "access_token":
+            self.send_header("x-ratelimit-remaining", str(max(remaining, 0)))
+            self.send_header("x-ratelimit-used", str(used))
+            self.send_header("x-ratelimit-reset", str(reset))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, backend, latency=0.0, jitter=0.0, rate_limit=DEFAULT_RATE_LIMIT,
+                 window=DEFAULT_WINDOW):
+        super().__init__(address, StandinHandler)
+        self.backend = backend
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.window = window
+        self.lock = threading.Lock()
+        self.requests = Counter()  # endpoint -> requests served
+        self.window_start = time.time()
+        self.window_used = 0
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def count(self, method, path):
+        endpoint = path.strip("/").split("/")[-1] or "/"
+        if path.strip("/").startswith("comments/"):
+            endpoint = "comments"
+        with self.lock:
+            self.requests[endpoint] += 1
+        return endpoint
+
+    def take_request(self):
+        """(remaining, used, seconds to reset) after counting one request against the window"""
+        with self.lock:
+            now = time.time()
+            if now - self.window_start >= self.window:
+                self.window_start = now
+                self.window_used = 0
+            self.window_used += 1
+            reset = max(int(self.window_start + self.window - now), 1)
+            return self.rate_limit - self.window_used, self.window_used, reset
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.requests)
+
+
+def start_standin(backend=None, port=0, **kwargs):
+    """serves the stand-in from a daemon thread. returns the server (server.url, server.requests)"""
+    server = StandinServer(("127.0.0.1", port), backend or SyntheticReddit(), **kwargs)
+    threading.Thread(target=server.serve_forever, name="reddit-standin", daemon=True).start()
+    return server
+
+
+def make_recording_requestor(directory):
+    """a prawcore requestor class that saves every api response under directory"""
+    from reddit_pool import TimingRequestor
+
+    class RecordingRequestor(TimingRequestor):
+        def request(self, *args, **kwargs):
+            response = super().request(*args, **kwargs)
+            method, url = args[0], args[1]
+            split = urlsplit(url)
+            if response.status_code == 200 and "access_token" not in split.path:
+                params = dict(parse_qsl(split.query))
+                params.update({k: str(v) for k, v in (kwargs.get("params") or {}).items()})
+                if isinstance(kwargs.get("data"), (dict, list)):
+                    params.update({k: str(v) for k, v in dict(kwargs["data"]).items()})
+                path = os.path.join(directory, request_key(method, split.path, params) + ".json")
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(response.text)
+            return response
+
+    return RecordingRequestor
+
+
+def record(directory, terms, comment_submissions=5):
+    """records the search pages for terms plus the comment trees of a few of their submissions,
+    against the real api (REDDIT_ID / REDDIT_SECRET from .env)"""
+    import praw
+    from dotenv import load_dotenv
+    from reddit_pool import load_credentials_from_env
+    load_dotenv()
+    os.makedirs(directory, exist_ok=True)
+    credential = load_credentials_from_env()[0]
+    reddit = praw.Reddit(client_id=credential.client_id, client_secret=credential.client_secret,
+                         user_agent=credential.user_agent, requestor_class=make_recording_requestor(directory))
+    for term in terms:
+        submissions = list(reddit.subreddit("all").search(term, sort="new", limit=None))
+        print(f"{term}: recorded {len(submissions)} submissions")
+        for submission in submissions[:comment_submissions]:
+            submission.comments.replace_more(limit=None)
+    print(f"{len(os.listdir(directory))} responses in {directory}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve = sub.add_parser("serve")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--fixtures", help="replay recorded responses from this directory instead of synthetic ones")
+    serve.add_argument("--submissions-per-term", type=int, default=300)
+    serve.add_argument("--comments-per-submission", type=int, default=40)
+    serve.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    serve.add_argument("--jitter", type=float, default=0.0)
+    serve.add_argument("--rate-limit", type=int, default=DEFAULT_RATE_LIMIT)
+    serve.add_argument("--window", type=int, default=DEFAULT_WINDOW)
+    rec = sub.add_parser("record")
+    rec.add_argument("directory")
+    rec.add_argument("terms", nargs="+")
+    rec.add_argument("--comment-submissions", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.directory, args.terms, args.comment_submissions)
+        return
+    backend = Fixtures(args.fixtures) if args.fixtures else SyntheticReddit(
+        args.submissions_per_term, args.comments_per_submission)
+    server = StandinServer(("127.0.0.1", args.port), backend, latency=args.latency, jitter=args.jitter,
+                           rate_limit=args.rate_limit, window=args.window)
+    print(f"reddit stand-in on {server.url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,46 @@
-from openai import OpenAI
 from dotenv import load_dotenv
 import os
+import atexit
+from functools import lru_cache
+from response_cache import ResponseCache, make_cache_key
 
 
 load_dotenv()
-OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
-OPENAI_CLIENT = OpenAI(api_key=OPENAI_API_KEY)
-JOB_DESCRIPTION = open("analysis/acip/job_description.txt",
-                       "r", encoding="utf-8").read()
+MODEL = "gpt-3.5-turbo"
+JOB_DESCRIPTION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    "analysis", "acip", "job_description.txt")
+
+"""
+the openai clients, job description and response cache are created on first use, so importing
+cgpt doesn't import openai, need OPENAI_API_KEY or depend on the working directory
+"""
+
+
+@lru_cache(maxsize=None)
+def get_client():
+    from openai import OpenAI
+    return OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+
+
+@lru_cache(maxsize=None)
+def get_async_client():
+    # base url can be pointed at a local fake with OPENAI_BASE_URL
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=os.environ["OPENAI_API_KEY"])
+
+
+@lru_cache(maxsize=None)
+def job_description():
+    with open(JOB_DESCRIPTION_FILE, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+@lru_cache(maxsize=None)
+def response_cache():
+    cache = ResponseCache(os.getenv("CGPT_CACHE_PATH", "cache/cgpt_responses.sqlite3"))
+    atexit.register(cache.close)
+    return cache
+
 
 """
 optional later:
@@ -24,12 +57,45 @@ def single_prompt_response(prompt):
     # top_p = get_top_p()
     # presence_penalty = get_presence_penalty()
     # frequency_penalty = get_frequency_penalty()
-    completion = OPENAI_CLIENT.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": JOB_DESCRIPTION},
-            {"role": "user", "content": prompt}
-        ]
+    key = make_cache_key(MODEL, job_description(), prompt)
+    cached = response_cache().get(key)
+    if cached is not None:
+        return cached
+    completion = get_client().chat.completions.create(
+        model=MODEL,
+        messages=make_messages(prompt)
     )
     response = completion.choices[0].message.content
+    response_cache().put(key, response)
     return response
+
+
+async def async_prompt_response(prompt, json_mode=False):
+    """async version of single_prompt_response
+    returns (reply, total tokens used). cache hits use 0 tokens
+    json_mode forces the reply to be a json object (used for batch prompts)"""
+    key = make_cache_key(MODEL, job_description(), prompt)
+    cached = response_cache().get(key)
+    if cached is not None:
+        return cached, 0
+    kwargs = {"response_format": {"type": "json_object"}} if json_mode else {}
+    completion = await get_async_client().chat.completions.create(
+        model=MODEL,
+        messages=make_messages(prompt),
+        **kwargs
+    )
+    response = completion.choices[0].message.content
+    tokens = completion.usage.total_tokens if completion.usage else 0
+    response_cache().put(key, response)
+    return response, tokens
+
+
+def make_messages(prompt):
+    return [
+        {"role": "system", "content": job_description()},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def cache_stats():
+    return response_cache().stats()
@@ -0,0 +1,215 @@
+import sys
+import time
+import argparse
+import importlib
+
+PROCESS_START = time.perf_counter()
+
+
+"""
+single entry point for the scraper and analysis jobs, run from the repo root:
+  python cli.py monitor        run the scrape scheduler (--engine threads|async)
+  python cli.py scrape TERM..  scrape terms into the db now (--to-file writes results/ instead)
+  python cli.py refresh-stats  refresh score / comment counts of submission ids (or --all)
+  python cli.py digest         refresh every analysis project (analysis/projects.py), --project NAME for some
+  python cli.py prune          retire (or --delete) the terms in low_pos_terms.txt, --dry-run to only count
+  python cli.py migrate        apply the pending schema migrations (migrations.py), --status to list them
+  python cli.py compact-json   migrate the json-ish reddit columns to compact payload refs (json_columns.py)
+  python cli.py partitions X   convert / maintain / archive the monthly partitions (partitions.py, postgres)
+  python cli.py health         check the db, reddit api and openai api
+each command imports what it needs when it runs, so --help or a short job doesn't load praw, pandas,
+openai or psycopg2 for nothing, and doesn't need the env vars of subsystems it doesn't touch.
+--import-times prints the modules a command loaded and what they cost
+(python -X importtime cli.py ... for the full import tree)
+"""
+
+
+IMPORT_TIMES = []  # (module, seconds) for every module load() imported
+HEALTH_CHECKS = ["db", "reddit", "openai"]
+
+
+def load(name):
+    """imports a module on first use, recording how long it took"""
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    IMPORT_TIMES.append((name, time.perf_counter() - start))
+    return module
+
+
+def connect(log_prefix="scrape"):
+    load("utils").setup_logging(log_prefix)
+    load("vsm").init_connection()
+
+
+def cmd_monitor(args):
+    connect()
+    load("monitor").main(engine=args.engine, metrics_port=args.metrics_port)
+
+
+def cmd_scrape(args):
+    connect()
+    if args.to_file:
+        load("scrape").scrape_to_file(args.terms)
+        return
+    with load("vsm").getcursor() as cur:
+        load("migrations").require_current(cur)
+    if args.engine == "async":
+        async_ingest = load("async_ingest")
+        results = async_ingest.run(async_ingest.AsyncIngest.scrape_terms, args.terms)
+        print(f"{sum(r for r in results if isinstance(r, int))} new submissions")
+    else:
+        scrape = load("scrape")
+        with load("vsm").getcursor() as cur:
+            print(f"{scrape.scrape_submissions_to_db(cur, args.terms)} new submissions")
+
+
+def cmd_refresh_stats(args):
+    connect()
+    if args.all:
+        load("update_submissions").update_submission_stats()
+        return
+    ids = list(args.ids)
+    if args.file:
+        with open(args.file) as f:
+            ids += [line.strip() for line in f if line.strip()]
+    module = "async_ingest" if args.engine == "async" else "update_submissions"
+    load(module).update_selected_submission_stats(ids)
+
+
+def cmd_digest(args):
+    connect("digest")
+    with load("vsm").getcursor() as cur:
+        load("migrations").require_current(cur)
+    load("analysis.projects").refresh_projects(args.project)
+
+
+def cmd_prune(args):
+    connect("prune")
+    load("analysis.acip.prune_bad_terms").remove_low_pos_terms_from_db(retire=not args.delete,
+                                                                       dry_run=args.dry_run)
+
+
+def cmd_migrate(args):
+    connect("migrate")
+    migrations = load("migrations")
+    if args.status:
+        with load("vsm").getcursor(commit=False) as cur:
+            todo = {version for version, _, _ in migrations.pending(cur)}
+        for version, name, _ in migrations.MIGRATIONS:
+            print(f"{version:>3} {'pending' if version in todo else 'applied':<8} {name}")
+        return
+    applied = migrations.migrate()
+    print(f"applied {len(applied)} migrations" + (f": {', '.join(applied)}" if applied else ""))
+
+
+def cmd_compact_json(args):
+    connect("compact_json")
+    json_columns = load("json_columns")
+    report = json_columns.migrate(batch_size=args.batch_size, drop=not args.keep_text, vacuum=args.vacuum)
+    json_columns.print_report(report)
+
+
+def cmd_partitions(args):
+    connect("partitions")
+    partitions = load("partitions")
+    if args.action == "convert":
+        for table, (copied, left) in partitions.convert(months_ahead=args.months_ahead).items():
+            print(f"{table}: {copied} rows copied, {left} left in {table}_unpartitioned")
+    elif args.action == "maintain":
+        print(f"created {partitions.maintain(months_ahead=args.months_ahead) or 'no'} partitions")
+    else:
+        entries = partitions.archive(after_months=args.after_months, path=args.dir,
+                                     keep_detached=args.keep_detached, dry_run=args.dry_run)
+        for entry in entries:
+            print(f"{entry['table']} {entry['month']}: {entry['rows']} rows -> {entry['path']}")
+
+
+def cmd_health(args):
+    load("utils").setup_logging("health")
+    checks = load("test_connections")  # test_db connects itself, so a broken db is reported, not raised
+    tests = {"db": checks.test_db, "reddit": checks.test_reddit, "openai": checks.test_openAI}
+    for check in args.only or HEALTH_CHECKS:
+        tests[check]()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="reddit monitor jobs")
+    parser.add_argument("--import-times", action="store_true",
+                        help="print startup time and the modules the command imported")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("monitor", help="run the scrape scheduler")
+    p.add_argument("--engine", choices=["threads", "async"], default=None,
+                   help="defaults to MONITOR_ENGINE, then threads")
+    p.add_argument("--metrics-port", type=int, default=None, help="defaults to METRICS_PORT, 0 turns it off")
+    p.set_defaults(func=cmd_monitor)
+
+    p = sub.add_parser("scrape", help="scrape search terms now")
+    p.add_argument("terms", nargs="+")
+    p.add_argument("--to-file", action="store_true", help="write to results/ instead of the db")
+    p.add_argument("--engine", choices=["threads", "async"], default="threads")
+    p.set_defaults(func=cmd_scrape)
+
+    p = sub.add_parser("refresh-stats", help="refresh score / comment counts")
+    p.add_argument("ids", nargs="*")
+    p.add_argument("--file", help="file with one submission id per line")
+    p.add_argument("--all", action="store_true", help="every submission in the db, one request each")
+    p.add_argument("--engine", choices=["threads", "async"], default="async")
+    p.set_defaults(func=cmd_refresh_stats)
+
+    p = sub.add_parser("digest", help="refresh the analysis projects")
+    p.add_argument("--project", action="append",
+                   help="only refresh this project (analysis/NAME/project.json), repeatable")
+    p.set_defaults(func=cmd_digest)
+
+    p = sub.add_parser("prune", help="retire or delete the terms in low_pos_terms.txt")
+    p.add_argument("--delete", action="store_true", help="delete the terms and their matches instead of retiring")
+    p.add_argument("--dry-run", action="store_true")
+    p.set_defaults(func=cmd_prune)
+
+    p = sub.add_parser("migrate", help="apply the pending schema migrations")
+    p.add_argument("--status", action="store_true", help="only list applied and pending migrations")
+    p.set_defaults(func=cmd_migrate)
+
+    p = sub.add_parser("compact-json", help="move media / gildings / all_awardings text to compact payload refs")
+    p.add_argument("--batch-size", type=int, default=5000, help="rows rewritten per transaction")
+    p.add_argument("--keep-text", action="store_true", help="don't drop the old text columns")
+    p.add_argument("--vacuum", action="store_true",
+                   help="reclaim the space afterwards (VACUUM FULL on postgres, locks the tables while it runs)")
+    p.set_defaults(func=cmd_compact_json)
+
+    p = sub.add_parser("partitions", help="monthly partitioning of the reddit tables (postgres)")
+    p.add_argument("action", choices=["convert", "maintain", "archive"])
+    p.add_argument("--months-ahead", type=int, default=3, help="future months to create partitions for")
+    p.add_argument("--after-months", type=int, default=18, help="archive partitions older than this")
+    p.add_argument("--dir", default=None, help="archive directory, defaults to ARCHIVE_DIR, then archive/")
+    p.add_argument("--keep-detached", action="store_true", help="detach archived partitions without dropping them")
+    p.add_argument("--dry-run", action="store_true", help="only list the partitions archive would move")
+    p.set_defaults(func=cmd_partitions)
+
+    p = sub.add_parser("health", help="check db, reddit and openai connectivity")
+    p.add_argument("--only", action="append", choices=HEALTH_CHECKS, help="run only this check (repeatable)")
+    p.set_defaults(func=cmd_health)
+    return parser
+
+
+def print_import_times(command_start):
+    print(f"startup: {(command_start - PROCESS_START) * 1000:.1f}ms to dispatch", file=sys.stderr)
+    for name, seconds in sorted(IMPORT_TIMES, key=lambda x: -x[1]):
+        print(f"  import {name}: {seconds * 1000:.1f}ms", file=sys.stderr)
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    command_start = time.perf_counter()
+    try:
+        args.func(args)
+    finally:
+        if args.import_times:
+            print_import_times(command_start)
+
+
+if __name__ == "__main__":
+    main()
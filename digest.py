@@ -1,6 +1,11 @@
-from analysis.acip import refresh_acip_analysis
-from vsm import init_connection
+from analysis.projects import refresh_projects
+from vsm import init_connection, getcursor
+from migrations import require_current
+from utils import setup_logging
 
 if __name__ == "__main__":
+    setup_logging("digest")
     init_connection()  # sets up ssh_tunnel and pg_pool
-    refresh_acip_analysis()
+    with getcursor() as cur:
+        require_current(cur)
+    refresh_projects()
@@ -0,0 +1,262 @@
+import json
+import time
+import hashlib
+import logging
+import vsm
+from vsm import getcursor, execute_values
+from sqlite_backend import SqliteCursor
+
+
+"""
+compact storage for the json-ish reddit columns (media, gildings, all_awardings)
+they used to be json.dumps text in every row, almost always "{}" / "[]" / "null" or the same award
+boilerplate, which bloated every row and every r.* export
+ - empty payloads ({}, [], null, "") are stored as NULL
+ - any other payload is stored once in reddit_json_payload (JSONB on postgres, TEXT on sqlite) and
+   rows keep its key in <column>_ref. the key is a 64 bit hash of the canonical json, so writers
+   don't need a lookup round trip, only one INSERT ... ON CONFLICT DO NOTHING of the batch's
+   distinct payloads, in the writer's transaction
+ - select_columns_sql() is the select list readers use instead of r.*: every real column, with the refs
+   expanded back into json text columns named like the old ones (payload_columns_sql()).
+   expand_payload_refs() does the same for rows read from elsewhere, e.g. archived partitions
+ - migrate() rewrites the text columns of existing rows to refs in batches, drops them and reports
+   table / index size and full-scan time before and after (python cli.py compact-json)
+"""
+
+
+JSON_COLUMNS = {
+    "reddit_submission": ["media", "gildings", "all_awardings"],
+    "reddit_comment": ["gildings", "all_awardings"],
+}
+JSON_FIELDS = {field for fields in JSON_COLUMNS.values() for field in fields}
+EMPTY_PAYLOADS = [None, {}, [], ""]
+PAYLOAD_TABLE = "reddit_json_payload"
+MIGRATION_BATCH_SIZE = 5000
+
+
+def ref_column(field):
+    return f"{field}_ref"
+
+
+def insert_columns(fields):
+    """the db columns a row of reddit fields is inserted into, json fields go to their ref column"""
+    return [ref_column(field) if field in JSON_FIELDS else field for field in fields]
+
+
+def canonical_json(payload):
+    """compact, key-sorted json of a payload, None for empty ones
+    payload is the api's dict / list, or the json text the old columns stored"""
+    if isinstance(payload, str) and payload:
+        try:
+            payload = json.loads(payload)
+        except json.JSONDecodeError:
+            pass  # plain string value
+    if payload in EMPTY_PAYLOADS:
+        return None
+    return json.dumps(payload, sort_keys=True, separators=(",", ":"))
+
+
+def payload_ref(text):
+    """signed 64 bit key of a canonical payload, fits a postgres BIGINT"""
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "big", signed=True)
+
+
+def compact_rows(cur, rows, fields):
+    """replaces the json fields of rows (tuples in `fields` order) with payload refs and stores the
+    payloads on cur, so they're committed with the rows"""
+    positions = [i for i, field in enumerate(fields) if field in JSON_FIELDS]
+    if not positions:
+        return rows
+    payloads = {}
+    compacted = []
+    for row in rows:
+        row = list(row)
+        for i in positions:
+            text = canonical_json(row[i])
+            row[i] = None if text is None else payload_ref(text)
+            if text is not None:
+                payloads[row[i]] = text
+        compacted.append(tuple(row))
+    store_payloads(cur, payloads)
+    return compacted
+
+
+def store_payloads(cur, payloads):
+    """payloads: {ref: canonical json}. sorted so concurrent writers lock keys in the same order"""
+    if payloads:
+        execute_values(cur, f"INSERT INTO {PAYLOAD_TABLE} (id, payload) VALUES %s ON CONFLICT DO NOTHING",
+                       sorted(payloads.items()))
+
+
+def payload_columns_sql(alias, table, legacy=()):
+    """select list expanding the refs of `table` (aliased `alias`) back to json text columns named
+    like the old ones. fields in legacy still have their text column (compact-json hasn't run yet),
+    rows without a ref fall back to it"""
+    columns = []
+    for field in JSON_COLUMNS[table]:
+        payload = f"(SELECT CAST(p.payload AS TEXT) FROM {PAYLOAD_TABLE} p WHERE p.id = {alias}.{ref_column(field)})"
+        if field in legacy:
+            payload = f"COALESCE({payload}, {alias}.{field})"
+        columns.append(f"{payload} AS {field}")
+    return ", ".join(columns)
+
+
+def select_columns_sql(cur, alias, table):
+    """select list of every column of `table` (aliased `alias`), json fields as json text instead of refs
+    use it instead of r.*, e.g. f"SELECT s.name, {select_columns_sql(cur, 'r', 'reddit_submission')} FROM ..." """
+    fields = JSON_COLUMNS[table]
+    existing = table_columns(cur, table)
+    refs = {ref_column(field) for field in fields}
+    plain = [f"{alias}.{column}" for column in existing if column not in refs and column not in fields]
+    return ", ".join(plain + [payload_columns_sql(alias, table, legacy=[f for f in fields if f in existing])])
+
+
+def expand_payload_refs(cur, rows, table):
+    """replaces the <field>_ref keys of row dicts read without select_columns_sql (e.g. from parquet
+    archives) with the json text of their payload, in place. one payload lookup for all the rows"""
+    fields = JSON_COLUMNS[table]
+    refs = {row.get(ref_column(field)) for row in rows for field in fields} - {None}
+    payloads = {}
+    if refs:
+        cur.execute(f"SELECT id, CAST(payload AS TEXT) FROM {PAYLOAD_TABLE} WHERE id = ANY(%s)", (sorted(refs),))
+        payloads = dict(cur.fetchall())
+    for row in rows:
+        for field in fields:
+            ref = row.pop(ref_column(field), None)
+            if ref is not None or field not in row:
+                row[field] = payloads.get(ref)
+    return rows
+
+
+def table_columns(cur, table):
+    """column names in table order"""
+    if isinstance(cur, SqliteCursor):
+        cur.execute(f"PRAGMA table_info({table})")
+        return [row[1] for row in cur.fetchall()]
+    cur.execute("SELECT column_name FROM information_schema.columns "
+                "WHERE table_schema = current_schema() AND table_name = %s ORDER BY ordinal_position", (table,))
+    return [row[0] for row in cur.fetchall()]
+
+
+def ensure_json_columns(cur):
+    """creates the payload table and the ref columns if they're missing. the old text columns are left
+    in place until migrate() has rewritten them"""
+    sqlite = isinstance(cur, SqliteCursor)
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {PAYLOAD_TABLE} "
+                f"(id BIGINT PRIMARY KEY, payload {'TEXT' if sqlite else 'JSONB'} NOT NULL)")
+    for table, fields in JSON_COLUMNS.items():
+        existing = table_columns(cur, table)
+        for field in fields:
+            if ref_column(field) not in existing:
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN {ref_column(field)} BIGINT")
+
+
+def update_refs(cur, table, fields, rows):
+    """rows of (*refs in `fields` order, id)"""
+    if isinstance(cur, SqliteCursor):
+        cur.executemany(f"UPDATE {table} SET {', '.join(f'{ref_column(f)} = %s' for f in fields)} WHERE id = %s",
+                        rows)
+        return
+    from psycopg2 import extras
+    extras.execute_values(cur, f"""
+        UPDATE {table} AS t
+        SET {', '.join(f'{ref_column(f)} = v.{ref_column(f)}::bigint' for f in fields)}
+        FROM (VALUES %s) AS v ({', '.join(ref_column(f) for f in fields)}, id)
+        WHERE t.id = v.id
+    """, rows)
+
+
+def table_sizes(cur, table):
+    """{table, indexes, total} bytes of the table, total including toast"""
+    if isinstance(cur, SqliteCursor):
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s", (table,))
+        indexes = [row[0] for row in cur.fetchall()]
+        cur.execute("SELECT name, SUM(pgsize) FROM dbstat WHERE name = ANY(%s) GROUP BY name", ([table] + indexes,))
+        sizes = dict(cur.fetchall())
+        heap = sizes.pop(table, 0)
+        return {"table": heap, "indexes": sum(sizes.values()), "total": heap + sum(sizes.values())}
+    cur.execute("SELECT pg_table_size(%s), pg_indexes_size(%s), pg_total_relation_size(%s)", (table,) * 3)
+    heap, indexes, total = cur.fetchone()
+    return {"table": heap, "indexes": indexes, "total": total}
+
+
+def time_full_scan(table):
+    """seconds to stream every row of the table, like an r.* export"""
+    start = time.perf_counter()
+    rows = 0
+    with getcursor(commit=False, name=f"scan_{table}") as cur:
+        cur.execute(f"SELECT * FROM {table}")
+        for _ in cur:
+            rows += 1
+    return {"rows": rows, "scan_seconds": round(time.perf_counter() - start, 3)}
+
+
+def measure(table):
+    with getcursor(commit=False) as cur:
+        sizes = table_sizes(cur, table)
+        sizes["payloads"] = table_sizes(cur, PAYLOAD_TABLE)["total"]
+    return {**sizes, **time_full_scan(table)}
+
+
+def migrate_table(table, fields, batch_size=MIGRATION_BATCH_SIZE):
+    """rewrites the text json columns of every row to refs, one transaction per batch walking the
+    primary key. rewriting is idempotent, so an interrupted run can just be rerun. returns rows rewritten"""
+    has_text = " OR ".join(f"{field} IS NOT NULL" for field in fields)
+    last_id = ""
+    rewritten = 0
+    while True:
+        with getcursor() as cur:
+            cur.execute(f"SELECT id, {', '.join(fields)} FROM {table} WHERE id > %s AND ({has_text}) "
+                        f"ORDER BY id LIMIT %s", (last_id, batch_size))
+            rows = cur.fetchall()
+            if not rows:
+                return rewritten
+            compacted = compact_rows(cur, [row[1:] for row in rows], fields)
+            update_refs(cur, table, fields, [(*refs, row[0]) for refs, row in zip(compacted, rows)])
+        last_id = rows[-1][0]
+        rewritten += len(rows)
+        logging.info(f"{table}: rewrote {rewritten} rows")
+
+
+def migrate(batch_size=MIGRATION_BATCH_SIZE, drop=True, vacuum=False):
+    """moves existing rows to the compact layout. returns {table: {"before": ..., "after": ..., "rows": n}}
+    drop removes the old text columns once they're rewritten. on postgres the space only comes back
+    after a rewrite of the table, vacuum=True runs VACUUM FULL (an exclusive lock for its duration)"""
+    with getcursor() as cur:
+        ensure_json_columns(cur)
+        sqlite = isinstance(cur, SqliteCursor)
+        legacy = {table: [f for f in fields if f in table_columns(cur, table)] for table, fields in JSON_COLUMNS.items()}
+    report = {}
+    for table, fields in legacy.items():
+        if not fields:
+            logging.info(f"{table}: already compacted")
+            continue
+        before = measure(table)
+        rows = migrate_table(table, fields, batch_size)
+        if drop:
+            with getcursor() as cur:
+                for field in fields:
+                    cur.execute(f"ALTER TABLE {table} DROP COLUMN {field}")
+            if vacuum and not sqlite:
+                with getcursor() as cur:
+                    cur.connection.autocommit = True  # VACUUM can't run in a transaction
+                    try:
+                        cur.execute(f"VACUUM FULL {table}")
+                    finally:
+                        cur.connection.autocommit = False
+        report[table] = {"rows": rows, "before": before}
+    if vacuum and sqlite and report:
+        vsm.sqlite_backend.connection().execute("VACUUM")
+    for table in report:
+        report[table]["after"] = measure(table)
+    return report
+
+
+def print_report(report):
+    for table, result in report.items():
+        before, after = result["before"], result["after"]
+        print(f"{table}: {result['rows']} rows rewritten")
+        for key in ["table", "indexes", "total", "payloads"]:
+            print(f"  {key + ' size':<14} {before[key] / 2 ** 20:>9.1f} MiB -> {after[key] / 2 ** 20:>9.1f} MiB")
+        print(f"  {'full scan':<14} {before['scan_seconds']:>9.2f} s   -> {after['scan_seconds']:>9.2f} s "
+              f"({after['rows']} rows)")
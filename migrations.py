@@ -0,0 +1,219 @@
+import logging
+from vsm import getcursor
+from sqlite_backend import SqliteCursor
+from json_columns import ensure_json_columns, table_columns
+
+
+"""
+versioned schema migrations, the one place the tables and their indexes are defined
+(partitions.py converts and maintains monthly partitions on top of them)
+ - MIGRATIONS is an ordered list of (version, name, function(cur)). migrate() runs the ones missing
+   from schema_migrations, each in its own transaction, and records them. every migration is
+   idempotent (IF NOT EXISTS / column and index checks), so a db created before this module,
+   with tables made by hand, is adopted by running them all
+ - the baseline creates the current layout, so on a fresh db the later migrations have nothing to do,
+   they upgrade dbs that predate them
+ - the sqlite backend migrates itself when vsm connects. on postgres run python cli.py migrate,
+   the monitor and scrape commands refuse to start while migrations are pending (require_current)
+ - HOT_QUERY_INDEXES are designed for the queries run on every scheduler start and scrape, see
+   benchmarks/check_query_plans.py, which fails when one of them plans a sequential scan or a sort
+"""
+
+
+VERSION_TABLE = "schema_migrations"
+
+BASE_TABLES = """
+CREATE TABLE IF NOT EXISTS search_term (
+    id {serial},
+    name TEXT UNIQUE NOT NULL,
+    retired_at {timestamp}
+);
+CREATE TABLE IF NOT EXISTS reddit_submission (
+    id TEXT PRIMARY KEY,
+    url TEXT, domain TEXT, title TEXT, permalink TEXT, created_utc {real},
+    url_overridden_by_dest TEXT, subreddit_id TEXT, subreddit TEXT, upvote_ratio {real},
+    score INTEGER, gilded INTEGER, num_comments INTEGER, num_crossposts INTEGER,
+    pinned {bool}, stickied {bool}, over_18 {bool}, is_created_from_ads_ui {bool},
+    is_self {bool}, is_video {bool}, media_ref BIGINT, gildings_ref BIGINT, all_awardings_ref BIGINT,
+    is_en {bool}
+);
+CREATE TABLE IF NOT EXISTS reddit_comment (
+    id TEXT PRIMARY KEY,
+    parent_id TEXT, link_id TEXT, body TEXT, permalink TEXT, created_utc {real}, subreddit_id TEXT,
+    subreddit_type TEXT, total_awards_received INTEGER, subreddit TEXT, score INTEGER,
+    gilded INTEGER, stickied {bool}, is_submitter {bool}, gildings_ref BIGINT, all_awardings_ref BIGINT,
+    is_en {bool}
+);
+CREATE TABLE IF NOT EXISTS reddit_json_payload (
+    id BIGINT PRIMARY KEY, payload {json} NOT NULL
+);
+CREATE TABLE IF NOT EXISTS search_term_match_reddit_submission (
+    submission_id TEXT, search_term_id INTEGER, created_utc {real},
+    PRIMARY KEY (search_term_id, submission_id)
+);
+CREATE TABLE IF NOT EXISTS search_term_match_reddit_comment (
+    comment_id TEXT, search_term_id INTEGER, PRIMARY KEY (search_term_id, comment_id)
+);
+CREATE TABLE IF NOT EXISTS search_term_match_tweet (
+    tweet_id TEXT, search_term_id INTEGER, PRIMARY KEY (search_term_id, tweet_id)
+);
+CREATE TABLE IF NOT EXISTS search_term_match_podcast_segment (
+    podcast_segment_id TEXT, search_term_id INTEGER, PRIMARY KEY (search_term_id, podcast_segment_id)
+)
+"""
+COLUMN_TYPES = {
+    "sqlite": {"serial": "INTEGER PRIMARY KEY AUTOINCREMENT", "timestamp": "TEXT", "real": "REAL",
+               "bool": "INTEGER", "json": "TEXT"},
+    "postgres": {"serial": "SERIAL PRIMARY KEY", "timestamp": "TIMESTAMPTZ", "real": "DOUBLE PRECISION",
+                 "bool": "BOOLEAN", "json": "JSONB"},
+}
+
+# (table, index name, key columns, included columns). an index is skipped when one already exists
+# whose leading columns are the key columns (e.g. the primary key), whatever its name
+HOT_QUERY_INDEXES = [
+    # term lookups by name: scrape, insert, retire, project syncs
+    ("search_term", "search_term_name_idx", ["name"], ["id", "retired_at"]),
+    # existing ids of a term (scrape pagination stop), ON CONFLICT of the match insert
+    ("search_term_match_reddit_submission", "search_term_match_reddit_submission_pkey_idx",
+     ["search_term_id", "submission_id"], []),
+    # a term's newest matches: the scheduler's per-term LATERAL, the projects' since-watermark sync
+    ("search_term_match_reddit_submission", "search_term_match_reddit_submission_recent_idx",
+     ["search_term_id", "created_utc DESC"], ["submission_id"]),
+    ("search_term_match_reddit_submission", "search_term_match_reddit_submission_submission_id",
+     ["submission_id"], []),
+    ("reddit_submission", "reddit_submission_created_utc", ["created_utc"], []),
+    ("search_term_match_reddit_comment", "search_term_match_reddit_comment_pkey_idx",
+     ["search_term_id", "comment_id"], []),
+]
+
+
+def backend(cur):
+    return "sqlite" if isinstance(cur, SqliteCursor) else "postgres"
+
+
+def create_base_tables(cur):
+    for statement in BASE_TABLES.format(**COLUMN_TYPES[backend(cur)]).split(";"):
+        cur.execute(statement)
+
+
+def add_retired_at(cur):
+    if "retired_at" not in table_columns(cur, "search_term"):
+        cur.execute(f"ALTER TABLE search_term ADD COLUMN retired_at {COLUMN_TYPES[backend(cur)]['timestamp']}")
+
+
+def add_match_created_utc(cur):
+    """the match row carries its submission's created_utc, so a term's newest matches are one index
+    range read instead of a join and sort of all its matches. partitioned match tables have it already"""
+    table = "search_term_match_reddit_submission"
+    if "created_utc" not in table_columns(cur, table):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN created_utc {COLUMN_TYPES[backend(cur)]['real']}")
+    if backend(cur) == "sqlite":
+        cur.execute(f"""
+            UPDATE {table} SET created_utc = (
+                SELECT r.created_utc FROM reddit_submission r WHERE r.id = {table}.submission_id
+            ) WHERE created_utc IS NULL
+        """)
+    else:
+        cur.execute(f"""
+            UPDATE {table} m SET created_utc = r.created_utc
+            FROM reddit_submission r
+            WHERE r.id = m.submission_id AND m.created_utc IS NULL
+        """)
+    logging.info(f"{table}: created_utc filled in for {cur.rowcount} rows")
+
+
+def index_prefixes(cur, table):
+    """the key columns of every index on the table, as tuples"""
+    if backend(cur) == "sqlite":
+        cur.execute(f"PRAGMA index_list({table})")
+        indexes = [row[1] for row in cur.fetchall()]
+        prefixes = set()
+        for index in indexes:
+            cur.execute(f"PRAGMA index_info({index})")
+            prefixes.add(tuple(row[2] for row in sorted(cur.fetchall())))
+        return prefixes
+    cur.execute("""
+        SELECT i.indexrelid, array_agg(a.attname ORDER BY k.position)
+        FROM pg_index i
+        CROSS JOIN LATERAL unnest(i.indkey::int2[]) WITH ORDINALITY AS k (attnum, position)
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+        WHERE i.indrelid = to_regclass(%s) AND k.position <= i.indnkeyatts
+        GROUP BY i.indexrelid
+    """, (table,))
+    return {tuple(row[1]) for row in cur.fetchall()}
+
+
+def create_hot_query_indexes(cur):
+    """on postgres CREATE INDEX blocks writes to the table while it builds, stop the monitor first"""
+    for table, name, columns, include in HOT_QUERY_INDEXES:
+        key = tuple(column.split()[0] for column in columns)
+        if any(prefix[:len(key)] == key for prefix in index_prefixes(cur, table)):
+            continue
+        if backend(cur) == "sqlite":
+            # no INCLUDE, the included columns go at the end of the key
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns + include)})")
+        else:
+            included = f" INCLUDE ({', '.join(include)})" if include else ""
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)}){included}")
+        logging.info(f"created index {name} on {table}")
+    if backend(cur) == "postgres":
+        cur.execute(f"ANALYZE {', '.join(sorted({table for table, _, _, _ in HOT_QUERY_INDEXES}))}")
+    else:
+        cur.execute("ANALYZE")
+
+
+MIGRATIONS = [
+    (1, "base tables", create_base_tables),
+    (2, "search_term.retired_at", add_retired_at),
+    (3, "json payload refs", ensure_json_columns),
+    (4, "created_utc on submission matches", add_match_created_utc),
+    (5, "hot query indexes", create_hot_query_indexes),
+]
+
+
+def ensure_version_table(cur):
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {VERSION_TABLE} "
+                f"(version INTEGER PRIMARY KEY, name TEXT NOT NULL, "
+                f"applied_at {COLUMN_TYPES[backend(cur)]['timestamp']} DEFAULT CURRENT_TIMESTAMP)")
+
+
+def applied_versions(cur):
+    ensure_version_table(cur)
+    cur.execute(f"SELECT version FROM {VERSION_TABLE}")
+    return {row[0] for row in cur.fetchall()}
+
+
+def pending(cur):
+    """[(version, name, function)] not applied yet, in order"""
+    applied = applied_versions(cur)
+    return [migration for migration in MIGRATIONS if migration[0] not in applied]
+
+
+def apply(cur, migration):
+    version, name, function = migration
+    logging.info(f"applying migration {version}: {name}")
+    function(cur)
+    cur.execute(f"INSERT INTO {VERSION_TABLE} (version, name) VALUES (%s, %s)", (version, name))
+
+
+def migrate(cur=None):
+    """applies the pending migrations, returns their names. with a cursor they all run in the caller's
+    transaction, otherwise each one commits on its own"""
+    if cur is not None:
+        todo = pending(cur)
+        for migration in todo:
+            apply(cur, migration)
+        return [name for _, name, _ in todo]
+    with getcursor() as cur:
+        todo = pending(cur)
+    for migration in todo:
+        with getcursor() as cur:
+            apply(cur, migration)
+    return [name for _, name, _ in todo]
+
+
+def require_current(cur):
+    todo = pending(cur)
+    if todo:
+        raise RuntimeError(f"{len(todo)} schema migrations pending "
+                           f"({', '.join(name for _, name, _ in todo)}), run python cli.py migrate")
@@ -1,13 +1,24 @@
 import time
+import asyncio
 import threading
 import heapq
 import logging
+import os
 import math
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 
-from vsm import init_connection, getcursor, get_recent_submissions_for_all_terms, get_recent_submimssions_for_term
-from scrape import scrape_submissions_to_db
+from vsm import init_connection, getcursor, get_recent_submission_arrays, get_recent_submimssions_for_term
+from scrape import scrape_submissions_to_db, make_reddit_api_interface
+from reddit_pool import CredentialPool, listing_requests_this_thread
+from scrape_budget import ScrapeBudget, YIELD_RELOAD_INTERVAL
+from term_lifecycle import get_retired_search_terms
+from migrations import require_current
+import partitions
+import metrics
+import tracing
+from utils import setup_logging
 
 
 """
@@ -15,7 +26,8 @@ gets search terms from vsm module
 finds recent submissions for each search term
 estimates the rate at which submissions appear (submission frequency) for each term
 creates a queue of scrape jobs
-scheduled time for jobs is based on the term's submission frequency
+scheduled time for jobs is based on the term's submission frequency, scaled down by a daily
+listing request budget split by each term's yield and pages per scrape (see scrape_budget.py)
 on scraping, submission frequency is re-calculated and a new job is scheduled
 """
 
@@ -25,14 +37,35 @@ MULTIPLIER = 2  # scrape rate is multiplied by this value to create a buffer
 MIN_SCRAPES_PER_DAY = 1  # per term
 MAX_SCRAPES_PER_DAY = 500  # per term
 SECONDS_PER_DAY = 86400
+METRICS_LOG_INTERVAL = 600  # seconds between per-credential metrics log lines
+RETIRED_TERMS_REFRESH_INTERVAL = 300  # how often retired terms (term_lifecycle.py) are dropped
+DEFAULT_METRICS_PORT = 9108  # METRICS_PORT=0 turns the endpoint off
+
+HEAP_SIZE = metrics.Gauge("scheduler_heap_size", "scrape tasks waiting in the schedule")
+SCHEDULING_LAG = metrics.Histogram("scheduler_lag_seconds", "how late scrapes start after their scheduled time",
+                                   buckets=(1, 5, 10, 30, 60, 300, 600, 1800, 3600, 7200))
+SCRAPES = metrics.Counter("scrapes_total", "finished scrapes", ["term"])
+SCRAPE_FAILURES = metrics.Counter("scrape_failures_total", "failed scrapes", ["exception"])
+SCRAPE_DURATION = metrics.Histogram("scrape_seconds", "time to scrape one term and reschedule it")
+WORKERS_BUSY = metrics.Gauge("scrape_workers_busy", "scrape threads currently running")
 
 
 class ScrapeScheduler:
-    def __init__(self, max_workers=4):
+    def __init__(self, max_workers=4, credential_pool=None, budget=None):
         self.lock = threading.Lock()
         self.task_heap = []
         self.task_set = set()
         self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.credential_pool = credential_pool or CredentialPool.from_env()
+        self.budget = budget or ScrapeBudget.from_env()
+        self.last_metrics_log = time.time()
+        self.last_yield_load = time.time()
+        self.last_retired_refresh = time.time()
+        self.last_partition_maintenance = 0  # first loop makes sure this month's partitions exist
+        self.retired_terms = set()
+        HEAP_SIZE.set_function(lambda: len(self.task_heap))
+        logging.info(
+            f"using {len(self.credential_pool.credentials)} reddit credential(s)")
         self.setup()
 
     def add_task(self, term, scrape_time):
@@ -45,22 +78,32 @@ class ScrapeScheduler:
         logging.info("beginning setup for ScrapeScheduler. This can take a couple minutes as submissions from each query are pulled to calculate submission frequency")
         now = time.time()
         with getcursor() as cur:
-            terms_and_intervals = get_all_terms_and_intervals(cur)
-        logging.info(f"{len(terms_and_intervals)} terms found.")
-        for i, (term, interval) in enumerate(terms_and_intervals):
-            # Spread out the start times within the range of the interval
-            spacing_offset = (interval / len(terms_and_intervals)) * i
-            next_scrape_time = now + spacing_offset
-            printdate = datetime.utcfromtimestamp(
-                next_scrape_time).strftime('%Y-%m-%d %H:%M')
-            logging.info(f"scrape time set for {term}: {printdate}")
-            self.add_task(term, next_scrape_time)
+            require_current(cur)
+            terms_and_demand = get_all_terms_and_demand(cur)
+        logging.info(f"{len(terms_and_demand)} terms found.")
+        self.budget.set_demands(terms_and_demand)
+        self.budget.report()
+        tasks = plan_schedule(self.budget, [term for term, _, _ in terms_and_demand], now)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for scrape_time, term in tasks:
+                printdate = datetime.utcfromtimestamp(scrape_time).strftime('%Y-%m-%d %H:%M')
+                logging.debug(f"scrape time set for {term}: {printdate}")
+        with self.lock:
+            for scrape_time, term in tasks:
+                if term not in self.task_set:
+                    self.task_heap.append((scrape_time, term))
+                    self.task_set.add(term)
+            heapq.heapify(self.task_heap)
+        if tasks:
+            logging.info(f"scheduled {len(tasks)} terms, first scrapes spread over "
+                         f"{(tasks[-1][0] - now) / 3600:.1f}h, in {(time.time() - now) * 1000:.0f}ms")
 
     def scrape_loop(self):
         """keep checking each task to see if time has been reached
         scrape when time is reached and then re-check db for recent results to calc the next
         scrape time and set it and re-add to tasks"""
         while True:
+            self.housekeeping()
             with self.lock:
                 if self.task_heap:
                     next_time, term = heapq.heappop(self.task_heap)
@@ -71,8 +114,11 @@ class ScrapeScheduler:
                     time.sleep(1)
                     continue
 
+            if term in self.retired_terms:
+                continue  # dropped from the schedule, not re-added
             now = time.time()
             if next_time <= now:
+                SCHEDULING_LAG.observe(now - next_time)
                 self.executor.submit(self.scrape_and_reschedule, term)
             else:
                 self.add_task(term, next_time)
@@ -80,58 +126,231 @@ class ScrapeScheduler:
                 logging.info(f"not time yet for {term}, sleeping for {sleep_duration}s")
                 time.sleep(sleep_duration)
 
+    def housekeeping(self):
+        """periodic metrics logging, yield reloads and retired term refreshes, called every loop"""
+        if time.time() - self.last_metrics_log > METRICS_LOG_INTERVAL:
+            self.credential_pool.log_metrics()
+            self.budget.report()
+            self.last_metrics_log = time.time()
+        if time.time() - self.last_yield_load > YIELD_RELOAD_INTERVAL:
+            self.budget.load_yields()
+            self.last_yield_load = time.time()
+        if time.time() - self.last_retired_refresh > RETIRED_TERMS_REFRESH_INTERVAL:
+            self.refresh_retired_terms()
+        if time.time() - self.last_partition_maintenance > partitions.MAINTENANCE_INTERVAL:
+            self.maintain_partitions()
+        tracing.check_profile_flag()
+
+    def maintain_partitions(self):
+        """creates the coming months' partitions when the db is partitioned (partitions.py)"""
+        try:
+            partitions.maintain()
+        except Exception as e:
+            logging.error(f"partition maintenance failed: {e}")
+        finally:
+            self.last_partition_maintenance = time.time()
+
+    def refresh_retired_terms(self):
+        """picks up terms retired since the last check, so they stop being scraped without a restart"""
+        try:
+            with getcursor() as cur:
+                retired = get_retired_search_terms(cur)
+        except Exception as e:
+            logging.error(f"couldn't refresh retired terms: {e}")
+            return
+        finally:
+            self.last_retired_refresh = time.time()
+        for term in retired - self.retired_terms:
+            logging.info(f"{term} was retired, removing it from the schedule")
+            self.budget.remove_term(term)
+        self.retired_terms = retired
+
     def scrape_and_reschedule(self, term):
-        logging.info(f"[{datetime.utcnow()}] Scraping: {term}")
+        credential = self.credential_pool.credential_for(term)
+        logging.info(f"[{datetime.utcnow()}] Scraping: {term} ({credential.name})")
+        start = time.perf_counter()
+        WORKERS_BUSY.inc()
         with getcursor() as cur:
             try:
-                scrape_submissions_to_db(cur, [term])
-                interval = get_interval_for_term(cur, term)
+                reddit = make_reddit_api_interface(credential)
+                pages_before = listing_requests_this_thread()
+                num_scraped = scrape_submissions_to_db(cur, [term], reddit=reddit)
+                self.budget.record_pages(term, listing_requests_this_thread() - pages_before)
+                self.credential_pool.record_success(credential, reddit.auth.limits, num_scraped)
+                self.budget.set_demand(term, *get_demand_for_term(cur, term))
+                interval = self.budget.interval_for(term)
+                SCRAPES.inc(term=term)
             except Exception as e:
                 logging.error(f"scraping failed for term {term}: {e}")
+                SCRAPE_FAILURES.inc(exception=type(e).__name__)
+                self.credential_pool.record_failure(credential, e)
                 interval = 300
             finally:
-                next_scrape = time.time() + interval
-                self.add_task(term, next_scrape)
+                WORKERS_BUSY.dec()
+                SCRAPE_DURATION.observe(time.perf_counter() - start)
+                if term not in self.retired_terms:
+                    next_scrape = time.time() + interval
+                    self.add_task(term, next_scrape)
+
+
+class AsyncScrapeScheduler(ScrapeScheduler):
+    """same schedule and budget as ScrapeScheduler, but every due term is scraped right away as a
+    coroutine on one event loop (async_ingest.py), instead of one at a time on max_workers threads.
+    the shared per-credential rate limiter does the pacing the 5s gap between scrapes did"""
+
+    def __init__(self, max_concurrency=None, credential_pool=None, budget=None):
+        from async_ingest import AsyncIngest, MAX_CONCURRENCY
+        super().__init__(max_workers=1, credential_pool=credential_pool, budget=budget)
+        self.executor.shutdown()
+        self.ingest = AsyncIngest(self.credential_pool, max_concurrency or MAX_CONCURRENCY)
+        self.running = set()
+        self.housekeeping_task = None
 
+    def scrape_loop(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        try:
+            while True:
+                # housekeeping does blocking db work (retired terms, partition maintenance), keep it
+                # off the event loop so in-flight scrapes don't stall behind it
+                if self.housekeeping_task is None or self.housekeeping_task.done():
+                    self.housekeeping_task = asyncio.create_task(self.housekeeping_async())
+                now = time.time()
+                due = []
+                with self.lock:
+                    while self.task_heap and self.task_heap[0][0] <= now:
+                        next_time, term = heapq.heappop(self.task_heap)
+                        self.task_set.remove(term)
+                        due.append((next_time, term))
+                    next_wake = self.task_heap[0][0] if self.task_heap else now + 1
+                for next_time, term in due:
+                    if term in self.retired_terms:
+                        continue
+                    SCHEDULING_LAG.observe(now - next_time)
+                    task = asyncio.create_task(self.scrape_and_reschedule_async(term))
+                    self.running.add(task)
+                    task.add_done_callback(self.running.discard)
+                await asyncio.sleep(min(max(next_wake - time.time(), 0.05), 1))
+        finally:
+            await self.ingest.close()
+
+    async def housekeeping_async(self):
+        try:
+            await self.ingest.db(self.housekeeping)
+        except Exception as e:
+            logging.error(f"housekeeping failed: {e}")
+
+    async def scrape_and_reschedule_async(self, term):
+        credential = self.credential_pool.credential_for(term)
+        client = self.ingest.client(credential)
+        start = time.perf_counter()
+        WORKERS_BUSY.inc()
+        try:
+            num_scraped = await self.ingest.scrape_term(term, client)
+            self.budget.record_pages(term, self.ingest.last_pages.get(term, 1))
+            self.credential_pool.record_success(credential, client.limiter.limits, num_scraped)
+            demand = await self.ingest.db(demand_for_term, term)
+            self.budget.set_demand(term, *demand)
+            interval = self.budget.interval_for(term)
+            SCRAPES.inc(term=term)
+        except Exception as e:
+            logging.error(f"scraping failed for term {term}: {e}")
+            SCRAPE_FAILURES.inc(exception=type(e).__name__)
+            self.credential_pool.record_failure(credential, e)
+            interval = 300
+        finally:
+            WORKERS_BUSY.dec()
+            SCRAPE_DURATION.observe(time.perf_counter() - start)
+        if term not in self.retired_terms:
+            self.add_task(term, time.time() + interval)
 
-def get_interval_for_term(cur, term):
+
+def demand_for_term(term):
+    with getcursor() as cur:
+        return get_demand_for_term(cur, term)
+
+
+def get_demand_for_term(cur, term):
+    """returns (submissions per day, scrapes per day needed to keep up)"""
     submissions = get_recent_submimssions_for_term(cur, term)
-    scrapes_per_day = calculate_scrapes_per_day(submissions)
-    interval = SECONDS_PER_DAY / scrapes_per_day
-    return interval
+    return estimate_submissions_per_day(submissions), calculate_scrapes_per_day(submissions)
 
 
-def get_all_terms_and_intervals(cur):
-    # TODO should optimize this since it takes like 5m. is it the join statement in the query?
-    terms = get_recent_submissions_for_all_terms(cur)
-    search_terms_and_intervals = []
-    for term, submissions in terms.items():
-        scrapes_per_day = calculate_scrapes_per_day(submissions)
-        interval = SECONDS_PER_DAY / scrapes_per_day
-        search_terms_and_intervals.append((term, interval))
-    search_terms_and_intervals.sort(key=lambda x: x[1])
-    return search_terms_and_intervals
+def plan_schedule(budget, terms, now):
+    """[(first scrape time, term)] ordered by time: shortest intervals first, start times spread
+    out within the range of each term's interval"""
+    intervals = budget.intervals_for(terms)
+    order = np.argsort(intervals, kind="stable")
+    scrape_times = now + intervals[order] / max(len(terms), 1) * np.arange(len(terms))
+    return [(scrape_time, terms[i]) for scrape_time, i in zip(scrape_times.tolist(), order.tolist())]
 
 
-def calculate_scrapes_per_day(recent_submissions):
+def get_all_terms_and_demand(cur):
+    """returns [(term, submissions per day, scrapes per day)]"""
+    terms, term_index, created_utc = get_recent_submission_arrays(cur)
+    submissions_per_day, scrapes_per_day = estimate_demand(term_index, created_utc, len(terms))
+    return list(zip(terms, submissions_per_day.tolist(), scrapes_per_day.tolist()))
+
+
+def estimate_demand(term_index, created_utc, n_terms):
+    """estimate_submissions_per_day and calculate_scrapes_per_day for every term at once
+    term_index[i] is the term (0..n_terms-1) of the submission created at created_utc[i]
+    returns (submissions per day, scrapes per day) arrays indexed by term"""
+    submissions_per_day = np.zeros(n_terms)
+    scrapes_per_day = np.full(n_terms, MIN_SCRAPES_PER_DAY, dtype=np.int64)
+    counts = np.bincount(term_index, minlength=n_terms)
+    present = np.flatnonzero(counts)
+    if not len(present):
+        return submissions_per_day, scrapes_per_day
+    # group each term's timestamps together, reduceat then works on one contiguous run per term
+    created = np.asarray(created_utc, dtype=np.float64)[np.argsort(term_index, kind="stable")]
+    starts = (np.cumsum(counts) - counts)[present]
+    time_span = np.maximum(np.maximum.reduceat(created, starts) - np.minimum.reduceat(created, starts), 1)
+    n = counts[present]
+    busy = n >= 2
+    rate = SECONDS_PER_DAY / (time_span[busy] / (n[busy] - 1))
+    submissions_per_day[present[busy]] = rate
+    scrapes_per_day[present[busy]] = np.ceil(np.clip(MULTIPLIER * (rate / 250), MIN_SCRAPES_PER_DAY,
+                                                     MAX_SCRAPES_PER_DAY))
+    return submissions_per_day, scrapes_per_day
+
+
+def estimate_submissions_per_day(recent_submissions):
     """Expects list of tuples: [(submission_id, created_utc)]"""
     if len(recent_submissions) < 2:
-        return MIN_SCRAPES_PER_DAY
-    timestamps = sorted(s[1] for s in recent_submissions)
-    time_span = timestamps[-1] - timestamps[0]
+        return 0.0
+    timestamps = sorted(float(s[1]) for s in recent_submissions)
+    time_span = max(timestamps[-1] - timestamps[0], 1)  # all in the same second -> as busy as it gets
+    avg_interval = time_span / (len(timestamps) - 1)
+    return SECONDS_PER_DAY / avg_interval
 
-    if time_span == 0:
-        return MAX_SCRAPES_PER_DAY
 
-    avg_interval = time_span / (len(timestamps) - 1)
-    submissions_per_day = SECONDS_PER_DAY / avg_interval
+def calculate_scrapes_per_day(recent_submissions):
+    """Expects list of tuples: [(submission_id, created_utc)]"""
+    if len(recent_submissions) < 2:
+        return MIN_SCRAPES_PER_DAY
+    submissions_per_day = estimate_submissions_per_day(recent_submissions)
     scrapes_per_day = min(MAX_SCRAPES_PER_DAY, max(
         MIN_SCRAPES_PER_DAY, MULTIPLIER * (submissions_per_day / 250)))
     scrapes_per_day = math.ceil(scrapes_per_day)
     return scrapes_per_day
 
 
+def main(engine=None, metrics_port=None):
+    """engine "async" scrapes every due term concurrently on one event loop (async_ingest.py),
+    defaults to MONITOR_ENGINE, then threads"""
+    engine = engine or os.getenv("MONITOR_ENGINE", "threads")
+    if metrics_port is None:
+        metrics_port = int(os.getenv("METRICS_PORT", DEFAULT_METRICS_PORT))
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+    tracing.install_profiler()  # kill -USR1 <pid> dumps a 30s profile to logs/
+    scheduler = AsyncScrapeScheduler() if engine == "async" else ScrapeScheduler()
+    scheduler.scrape_loop()
+
+
 if __name__ == "__main__":
+    setup_logging()
     init_connection()  # sets up ssh_tunnel and pg_pool
-    scheduler = ScrapeScheduler()
-    scheduler.scrape_loop()
+    main()
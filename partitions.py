@@ -0,0 +1,390 @@
+import os
+import re
+import json
+import time
+import logging
+import calendar
+from datetime import datetime, timezone
+import vsm
+from vsm import getcursor
+from sqlite_backend import SqliteCursor
+from json_columns import expand_payload_refs
+
+
+"""
+monthly range partitioning of the big reddit tables by created_utc (postgres only)
+ - convert() turns the existing tables into partitioned ones. each table is renamed to
+   <table>_unpartitioned and replaced by a partitioned table with a partition per month from its
+   oldest row to PARTITION_MONTHS_AHEAD months from now, plus a default partition (for rows of
+   months that were archived), then rows are copied over in primary key batches. the match tables
+   get a created_utc column, the created_utc of the row they match, to be partitioned on.
+   stop the monitor while it runs. the old tables are kept, drop them once the counts check out
+ - maintain() creates the coming months' partitions, moving rows that landed in the default
+   partition into them. the monitor runs it daily
+ - archive() writes every partition older than ARCHIVE_AFTER_MONTHS to a zstd parquet file under
+   ARCHIVE_DIR (needs pyarrow), records it in ARCHIVE_DIR/manifest.json, and detaches and drops it
+ - iter_archived_submissions() reads archived months back for analysis readers that ask for them,
+   see projects.iter_submissions_for_terms(include_archive=True)
+once the tables are partitioned vsm.hot_window_sql() keeps the scheduler and scrape queries to the
+last HOT_WINDOW_DAYS, so they only touch the recent partitions
+"""
+
+
+# table -> primary key, which has to include the partition key. in conversion order, the match
+# tables read created_utc from their (already converted) source table
+PARTITIONED = {
+    "reddit_submission": ["id", "created_utc"],
+    "reddit_comment": ["id", "created_utc"],
+    "search_term_match_reddit_submission": ["search_term_id", "submission_id", "created_utc"],
+    "search_term_match_reddit_comment": ["search_term_id", "comment_id", "created_utc"],
+}
+MATCH_SOURCES = {  # match table -> (table it matches, column holding that table's id)
+    "search_term_match_reddit_submission": ("reddit_submission", "submission_id"),
+    "search_term_match_reddit_comment": ("reddit_comment", "comment_id"),
+}
+INDEXES = {  # besides the primary key, created on the partitioned parent so every partition gets them
+    "reddit_submission": ["created_utc"],
+    "reddit_comment": ["created_utc"],
+    "search_term_match_reddit_submission": ["search_term_id, created_utc DESC", "submission_id"],
+    "search_term_match_reddit_comment": ["search_term_id, created_utc DESC", "comment_id"],
+}
+PARTITION_MONTHS_AHEAD = 3
+ARCHIVE_AFTER_MONTHS = 18
+ARCHIVE_DIR = "archive"
+COPY_BATCH_SIZE = 20000
+EXPORT_CHUNK_SIZE = 20000
+MAINTENANCE_INTERVAL = 86400  # seconds between the monitor's maintain() runs
+MONTH_SUFFIX = re.compile(r"_y(\d{4})m(\d{2})$")
+
+# postgres column type -> (arrow type name, cast applied when exporting)
+ARROW_TYPES = {
+    "text": ("string", None),
+    "character varying": ("string", None),
+    "smallint": ("int64", None),
+    "integer": ("int64", None),
+    "bigint": ("int64", None),
+    "real": ("float64", None),
+    "double precision": ("float64", None),
+    "numeric": ("float64", "double precision"),
+    "boolean": ("bool_", None),
+    "jsonb": ("string", "text"),
+    "json": ("string", "text"),
+}
+
+
+def month_start(year, month):
+    return calendar.timegm((year, month, 1, 0, 0, 0))
+
+
+def add_months(year, month, n):
+    index = year * 12 + month - 1 + n
+    return index // 12, index % 12 + 1
+
+
+def month_of(timestamp):
+    date = datetime.fromtimestamp(float(timestamp), timezone.utc)
+    return date.year, date.month
+
+
+def partition_name(table, year, month):
+    return f"{table}_y{year}m{month:02d}"
+
+
+def require_postgres(cur):
+    if isinstance(cur, SqliteCursor):
+        raise RuntimeError("partitioned tables need postgres, the sqlite backend doesn't support them")
+
+
+def current_partitioned(cur):
+    """partitioned tables right now, unlike vsm.partitioned_tables() which caches the first answer"""
+    if isinstance(cur, SqliteCursor):
+        return set()
+    cur.execute("SELECT c.relname FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid")
+    return {row[0] for row in cur.fetchall()}
+
+
+def table_columns(cur, table):
+    """[(column, data type)] in table order"""
+    cur.execute("""
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s ORDER BY ordinal_position
+    """, (table,))
+    return cur.fetchall()
+
+
+def monthly_partitions(cur, table):
+    """{(year, month): partition name} of the table's attached monthly partitions"""
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+    """, (table,))
+    partitions = {}
+    for (name,) in cur.fetchall():
+        match = MONTH_SUFFIX.search(name)
+        if match:
+            partitions[(int(match.group(1)), int(match.group(2)))] = name
+    return partitions
+
+
+# ---- conversion ----
+
+def convert(months_ahead=PARTITION_MONTHS_AHEAD, batch_size=COPY_BATCH_SIZE):
+    """partitions every PARTITIONED table that isn't yet. returns {table: (rows copied, rows left behind)}
+    rows left behind (no created_utc, or a match row without its submission) stay in <table>_unpartitioned"""
+    with getcursor() as cur:
+        require_postgres(cur)
+        done = current_partitioned(cur)
+        cur.execute("SELECT tablename FROM pg_tables WHERE tablename = ANY(%s)", (list(PARTITIONED),))
+        existing = {row[0] for row in cur.fetchall()}
+    results = {}
+    for table in PARTITIONED:
+        if table in done or table not in existing:
+            continue
+        with getcursor() as cur:
+            create_partitioned_table(cur, table, months_ahead)
+        results[table] = copy_rows(table, batch_size)
+        logging.info(f"{table}: {results[table][0]} rows copied, {results[table][1]} left in {table}_unpartitioned")
+    vsm._partitioned_tables = None
+    return results
+
+
+def create_partitioned_table(cur, table, months_ahead):
+    old = f"{table}_unpartitioned"
+    cur.execute(f"ALTER TABLE {table} RENAME TO {old}")
+    # index names are schema wide, move the old ones out of the new table's way
+    cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", (old,))
+    for (index,) in cur.fetchall():
+        cur.execute(f'ALTER INDEX "{index}" RENAME TO "{index[:50]}_unpartitioned"')
+
+    source = MATCH_SOURCES.get(table)
+    if source:
+        cur.execute("""
+            SELECT format_type(a.atttypid, a.atttypmod) FROM pg_attribute a
+            WHERE a.attrelid = %s::regclass AND a.attname = 'created_utc'
+        """, (source[0],))
+        created_type = cur.fetchone()[0]
+        # the submission match table has its own created_utc since migration 4 (migrations.py)
+        has_created = "created_utc" in {name for name, _ in table_columns(cur, old)}
+        extra = "" if has_created else f", created_utc {created_type}"
+        cur.execute(f"CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS{extra}) PARTITION BY RANGE (created_utc)")
+        cur.execute(f"SELECT MIN(created_utc) FROM {source[0]}")
+    else:
+        cur.execute(f"CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS) PARTITION BY RANGE (created_utc)")
+        cur.execute(f"SELECT MIN(created_utc) FROM {old}")
+    oldest = cur.fetchone()[0]
+    cur.execute(f"ALTER TABLE {table} ADD PRIMARY KEY ({', '.join(PARTITIONED[table])})")
+    for columns in INDEXES[table]:
+        cur.execute(f"CREATE INDEX ON {table} ({columns})")
+
+    year, month = month_of(oldest if oldest is not None else time.time())
+    last = add_months(*month_of(time.time()), months_ahead)
+    while (year, month) <= last:
+        next_year, next_month = add_months(year, month, 1)
+        cur.execute(f"CREATE TABLE {partition_name(table, year, month)} PARTITION OF {table} "
+                    f"FOR VALUES FROM ({month_start(year, month)}) TO ({month_start(next_year, next_month)})")
+        year, month = next_year, next_month
+    cur.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+
+
+def copy_rows(table, batch_size=COPY_BATCH_SIZE):
+    """copies <table>_unpartitioned into the partitioned table in primary key order, one transaction
+    per batch. idempotent, an interrupted copy can be rerun. returns (rows copied, rows left behind)"""
+    old = f"{table}_unpartitioned"
+    key = PARTITIONED[table][:-1]
+    key_sql = f"({', '.join(f'o.{column}' for column in key)})"
+    key_params = f"({', '.join('%s' for _ in key)})"
+    source = MATCH_SOURCES.get(table)
+    with getcursor(commit=False) as cur:
+        # match tables take created_utc from their source row, even when they have their own copy
+        columns = [name for name, _ in table_columns(cur, old) if not (source and name == "created_utc")]
+        cur.execute(f"SELECT COUNT(*) FROM {old}")
+        total = cur.fetchone()[0]
+    column_list = ", ".join(columns)
+    select = ", ".join(f"o.{column}" for column in columns)
+    conditions = [f"{key_sql} >= {key_params}", f"{key_sql} <= {key_params}"]
+    if source:
+        column_list += ", created_utc"
+        select += f", r.created_utc FROM {old} o JOIN {source[0]} r ON r.id = o.{source[1]}"
+    else:
+        select += f" FROM {old} o"
+        conditions.append("o.created_utc IS NOT NULL")
+
+    copied = 0
+    last = None
+    while True:
+        with getcursor() as cur:
+            after = f"WHERE {key_sql} > {key_params}" if last else ""
+            cur.execute(f"SELECT {', '.join(f'o.{c}' for c in key)} FROM {old} o {after} "
+                        f"ORDER BY {', '.join(f'o.{c}' for c in key)} LIMIT %s", (*(last or ()), batch_size))
+            keys = cur.fetchall()
+            if not keys:
+                break
+            cur.execute(f"INSERT INTO {table} ({column_list}) SELECT {select} WHERE {' AND '.join(conditions)} "
+                        f"ON CONFLICT DO NOTHING", (*keys[0], *keys[-1]))
+            copied += cur.rowcount
+        last = keys[-1]
+        logging.info(f"{table}: copied {copied} of {total} rows")
+    return copied, total - copied
+
+
+# ---- maintenance ----
+
+def maintain(months_ahead=PARTITION_MONTHS_AHEAD):
+    """creates this month's and the next months_ahead months' partitions where missing, on every
+    partitioned table. returns the partitions created"""
+    created = []
+    with getcursor() as cur:
+        for table in current_partitioned(cur) & set(PARTITIONED):
+            existing = monthly_partitions(cur, table)
+            year, month = month_of(time.time())
+            for _ in range(months_ahead + 1):
+                if (year, month) not in existing:
+                    create_partition(cur, table, year, month)
+                    created.append(partition_name(table, year, month))
+                year, month = add_months(year, month, 1)
+    if created:
+        logging.info(f"created partitions {created}")
+    return created
+
+
+def create_partition(cur, table, year, month):
+    """attaches a new monthly partition, moving the rows of that month out of the default partition
+    first (attaching fails while the default partition holds any)"""
+    name = partition_name(table, year, month)
+    start, end = month_start(year, month), month_start(*add_months(year, month, 1))
+    cur.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS)")
+    cur.execute(f"""
+        WITH moved AS (
+            DELETE FROM {table}_default WHERE created_utc >= %s AND created_utc < %s RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """, (start, end))
+    cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ({start}) TO ({end})")
+
+
+# ---- archival ----
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("archiving partitions needs pyarrow (pip install -r requirements-archive.txt)") from e
+    return pyarrow, pyarrow.parquet
+
+
+def archive_dir(path=None):
+    return path or os.getenv("ARCHIVE_DIR", ARCHIVE_DIR)
+
+
+def load_manifest(path=None):
+    manifest_file = os.path.join(archive_dir(path), "manifest.json")
+    if not os.path.isfile(manifest_file):
+        return []
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, path=None):
+    manifest_file = os.path.join(archive_dir(path), "manifest.json")
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def archive(after_months=ARCHIVE_AFTER_MONTHS, path=None, keep_detached=False, dry_run=False):
+    """exports, detaches and drops (or with keep_detached, only detaches) every monthly partition that
+    ended more than after_months months ago. returns the manifest entries added"""
+    path = archive_dir(path)
+    cutoff = month_start(*add_months(*month_of(time.time()), -after_months))
+    with getcursor(commit=False) as cur:
+        require_postgres(cur)
+        due = [(table, year, month, name)
+               for table in current_partitioned(cur) & set(PARTITIONED)
+               for (year, month), name in sorted(monthly_partitions(cur, table).items())
+               if month_start(*add_months(year, month, 1)) <= cutoff]
+    if dry_run:
+        for table, year, month, name in due:
+            logging.info(f"would archive {name}")
+        return []
+
+    manifest = load_manifest(path)
+    added = []
+    for table, year, month, name in due:
+        file_path = os.path.join(path, table, f"{year}-{month:02d}.parquet")
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with getcursor() as cur:
+            cur.execute(f"LOCK TABLE {name} IN SHARE MODE")  # no writes between the export and the detach
+            rows = export_partition(cur, name, file_path)
+            cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+            if not keep_detached:
+                cur.execute(f"DROP TABLE {name}")
+        entry = {
+            "table": table, "month": f"{year}-{month:02d}", "path": os.path.relpath(file_path, path), "rows": rows,
+            "start": month_start(year, month), "end": month_start(*add_months(year, month, 1)),
+            "archived_at": int(time.time()),
+        }
+        manifest = [e for e in manifest if (e["table"], e["month"]) != (table, entry["month"])] + [entry]
+        save_manifest(manifest, path)
+        added.append(entry)
+        logging.info(f"archived {name}: {rows} rows to {file_path}")
+    return added
+
+
+def export_partition(cur, partition, file_path):
+    """streams the partition into a zstd parquet file on cur's connection/transaction. returns rows written"""
+    pa, pq = import_pyarrow()
+    columns = table_columns(cur, partition)
+    fields, select = [], []
+    for name, data_type in columns:
+        arrow_type, cast = ARROW_TYPES.get(data_type, ("string", "text"))
+        fields.append(pa.field(name, getattr(pa, arrow_type)()))
+        select.append(f"{name}::{cast} AS {name}" if cast else name)
+    schema = pa.schema(fields)
+
+    rows = 0
+    tmp_path = file_path + ".tmp"
+    with cur.connection.cursor(name=f"archive_{partition}") as export, \
+            pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+        export.itersize = EXPORT_CHUNK_SIZE
+        export.execute(f"SELECT {', '.join(select)} FROM {partition}")
+        while True:
+            chunk = export.fetchmany(EXPORT_CHUNK_SIZE)
+            if not chunk:
+                break
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(zip(*chunk), schema)], schema=schema))
+            rows += len(chunk)
+    os.replace(tmp_path, file_path)
+    return rows
+
+
+def iter_archived_submissions(term_names, since_utc=0, path=None):
+    """yields archived submissions matched to the terms, created after since_utc, as dicts with the
+    lowercased term in search_term_name like projects.iter_submissions_for_terms
+    term_names: {search_term id: name}. a match row and its submission share created_utc, so they're
+    in the same month's files. payload refs are expanded to json text like the db reader's"""
+    pa, pq = import_pyarrow()
+    path = archive_dir(path)
+    manifest = load_manifest(path)
+    submission_files = {e["month"]: e for e in manifest if e["table"] == "reddit_submission"}
+    for entry in sorted(manifest, key=lambda e: e["month"]):
+        if entry["table"] != "search_term_match_reddit_submission" or entry["end"] <= since_utc:
+            continue
+        if entry["month"] not in submission_files:
+            continue
+        matches = pq.read_table(os.path.join(path, entry["path"]), columns=["search_term_id", "submission_id"],
+                                filters=[("search_term_id", "in", list(term_names)),
+                                         ("created_utc", ">", since_utc)]).to_pylist()
+        if not matches:
+            continue
+        ids = list({m["submission_id"] for m in matches})
+        submissions = pq.read_table(os.path.join(path, submission_files[entry["month"]]["path"]),
+                                    filters=[("id", "in", ids)]).to_pylist()
+        with getcursor(commit=False) as cur:
+            expand_payload_refs(cur, submissions, "reddit_submission")
+        by_id = {s["id"]: s for s in submissions}
+        for m in matches:
+            submission = by_id.get(m["submission_id"])
+            if submission is not None:
+                yield {"search_term_name": term_names[m["search_term_id"]].lower(), **submission}
@@ -0,0 +1,243 @@
+import os
+import time
+import bisect
+import hashlib
+import logging
+import threading
+import praw
+import prawcore
+import metrics
+
+
+"""
+pool of reddit api credentials so the monitor isn't limited to one oauth client's rate limit
+terms are assigned to credentials with a consistent hash ring, so adding or removing a
+credential only moves the terms that hashed to it
+each credential keeps its own rate limit state (pulled from praw after every scrape)
+throttled credentials are skipped until their window resets, revoked ones are skipped for good
+their terms fall through to the next credential on the ring
+
+credentials are read from .env:
+  REDDIT_ID / REDDIT_SECRET (first credential)
+  REDDIT_ID_2 / REDDIT_SECRET_2, REDDIT_ID_3 / REDDIT_SECRET_3, ... (optional extra credentials)
+REDDIT_OAUTH_URL / REDDIT_URL can point every credential at a local mock oauth/listing server
+"""
+
+
+VNODES_PER_CREDENTIAL = 64  # points on the hash ring per credential
+MIN_REMAINING_REQUESTS = 10  # throttle a credential once its window has fewer requests left
+DEFAULT_THROTTLE_SECONDS = 60  # used when reddit doesn't tell us when the window resets
+
+API_LATENCY = metrics.Histogram("reddit_api_request_seconds", "reddit api request latency", ["status"])
+API_ERRORS = metrics.Counter("reddit_api_request_errors_total", "reddit api requests that raised", ["exception"])
+RATE_LIMIT_REMAINING = metrics.Gauge("reddit_rate_limit_remaining", "requests left in the rate limit window",
+                                     ["credential"])
+_thread_requests = threading.local()
+
+
+class TimingRequestor(prawcore.Requestor):
+    """records latency of every reddit api request, and counts listing requests per thread
+    (see listing_requests_this_thread)"""
+
+    def request(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = super().request(*args, **kwargs)
+        except Exception as e:
+            API_ERRORS.inc(exception=type(e).__name__)
+            raise
+        API_LATENCY.observe(time.perf_counter() - start, status=response.status_code)
+        url = args[1] if len(args) > 1 else kwargs.get("url", "")
+        if "access_token" not in str(url):
+            _thread_requests.count = getattr(_thread_requests, "count", 0) + 1
+        return response
+
+
+def listing_requests_this_thread():
+    """number of non-auth api requests (i.e. listing pages) made by this thread so far"""
+    return getattr(_thread_requests, "count", 0)
+
+
+class RedditCredential:
+    def __init__(self, name, client_id, client_secret, user_agent, oauth_url=None, reddit_url=None):
+        self.name = name
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.user_agent = user_agent
+        self.oauth_url = oauth_url
+        self.reddit_url = reddit_url
+
+        # rate limit state
+        self.remaining = None
+        self.used = None
+        self.reset_timestamp = None
+        self.throttled_until = 0
+        self.revoked = False
+
+        # metrics
+        self.scrapes = 0
+        self.failures = 0
+        self.throttle_count = 0
+        self.submissions = 0
+
+    def make_interface(self):
+        kwargs = {}
+        if self.oauth_url:
+            kwargs["oauth_url"] = self.oauth_url
+        if self.reddit_url:
+            kwargs["reddit_url"] = self.reddit_url
+        return praw.Reddit(
+            client_id=self.client_id,
+            client_secret=self.client_secret,
+            user_agent=self.user_agent,
+            ratelimit_seconds=60,
+            requestor_class=TimingRequestor,
+            **kwargs,
+        )
+
+    def is_available(self, now=None):
+        if self.revoked:
+            return False
+        now = time.time() if now is None else now
+        return now >= self.throttled_until
+
+    def update_limits(self, limits):
+        """copy rate limit info (praw's reddit.auth.limits, or an async client's limits) from a
+        client that was just used with this credential"""
+        self.remaining = limits.get("remaining")
+        self.used = limits.get("used")
+        self.reset_timestamp = limits.get("reset_timestamp")
+        if self.remaining is not None:
+            RATE_LIMIT_REMAINING.set(self.remaining, credential=self.name)
+        if self.remaining is not None and self.remaining < MIN_REMAINING_REQUESTS:
+            self.throttle(self.reset_timestamp)
+
+    def throttle(self, until=None):
+        self.throttled_until = until or time.time() + DEFAULT_THROTTLE_SECONDS
+        self.throttle_count += 1
+        logging.warning(
+            f"reddit credential {self.name} throttled for {self.throttled_until - time.time():.0f}s")
+
+    def revoke(self):
+        self.revoked = True
+        logging.error(
+            f"reddit credential {self.name} was rejected and will no longer be used")
+
+    def metrics(self):
+        return {
+            "credential": self.name,
+            "scrapes": self.scrapes,
+            "failures": self.failures,
+            "throttles": self.throttle_count,
+            "submissions": self.submissions,
+            "remaining": self.remaining,
+            "used": self.used,
+            "available": self.is_available(),
+            "revoked": self.revoked,
+        }
+
+
+class CredentialPool:
+    def __init__(self, credentials):
+        if not credentials:
+            raise ValueError("CredentialPool needs at least one credential")
+        self.lock = threading.Lock()
+        self.credentials = credentials
+        self.ring = []  # sorted (hash, credential index)
+        for i, credential in enumerate(credentials):
+            for v in range(VNODES_PER_CREDENTIAL):
+                self.ring.append((ring_hash(f"{credential.name}#{v}"), i))
+        self.ring.sort()
+        self.ring_keys = [h for h, _ in self.ring]
+
+    @classmethod
+    def from_env(cls):
+        return cls(load_credentials_from_env())
+
+    def credential_for(self, term):
+        """walks the ring clockwise from the term's hash and returns the first usable credential
+        if everything is throttled, returns whichever throttled credential frees up first"""
+        with self.lock:
+            now = time.time()
+            start = bisect.bisect(self.ring_keys, ring_hash(term)) % len(self.ring)
+            seen = set()
+            for offset in range(len(self.ring)):
+                i = self.ring[(start + offset) % len(self.ring)][1]
+                if i in seen:
+                    continue
+                seen.add(i)
+                if self.credentials[i].is_available(now):
+                    return self.credentials[i]
+                if len(seen) == len(self.credentials):
+                    break
+            usable = [c for c in self.credentials if not c.revoked]
+            if not usable:
+                raise RuntimeError("all reddit credentials have been revoked")
+            return min(usable, key=lambda c: c.throttled_until)
+
+    def record_success(self, credential, limits, num_submissions):
+        with self.lock:
+            credential.scrapes += 1
+            credential.submissions += num_submissions
+            credential.update_limits(limits)
+
+    def record_failure(self, credential, exception):
+        """throttles or revokes the credential depending on the exception"""
+        with self.lock:
+            credential.failures += 1
+            if isinstance(exception, prawcore.exceptions.TooManyRequests) or status_code(exception) == 429:
+                credential.throttle()
+            elif is_auth_failure(exception):
+                credential.revoke()
+
+    def metrics(self):
+        with self.lock:
+            return [c.metrics() for c in self.credentials]
+
+    def log_metrics(self):
+        for m in self.metrics():
+            logging.info(
+                f"credential {m['credential']}: {m['scrapes']} scrapes, {m['failures']} failures, "
+                f"{m['throttles']} throttles, {m['submissions']} submissions, "
+                f"{m['remaining']} requests remaining, available={m['available']}, revoked={m['revoked']}")
+
+
+def is_auth_failure(exception):
+    if isinstance(exception, (prawcore.exceptions.OAuthException, prawcore.exceptions.InvalidToken)):
+        return True
+    return status_code(exception) == 401
+
+
+def status_code(exception):
+    """http status of a prawcore ResponseException or httpx HTTPStatusError, None for anything else"""
+    return getattr(getattr(exception, "response", None), "status_code", None)
+
+
+def ring_hash(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+def load_credentials_from_env():
+    try:
+        ids = [os.environ["REDDIT_ID"]]
+        secrets = [os.environ["REDDIT_SECRET"]]
+    except KeyError as k:
+        raise SystemExit(f"Missing env var: {k}. Check your .env file.")
+    n = 2
+    while os.getenv(f"REDDIT_ID_{n}"):
+        ids.append(os.environ[f"REDDIT_ID_{n}"])
+        secrets.append(os.environ[f"REDDIT_SECRET_{n}"])
+        n += 1
+
+    user_agent = os.getenv("REDDIT_UA", "debug-scraper/0.1")
+    credentials = []
+    for i, (client_id, client_secret) in enumerate(zip(ids, secrets), start=1):
+        credentials.append(RedditCredential(
+            name=f"reddit_{i}",
+            client_id=client_id,
+            client_secret=client_secret,
+            user_agent=user_agent,
+            oauth_url=os.getenv("REDDIT_OAUTH_URL"),
+            reddit_url=os.getenv("REDDIT_URL"),
+        ))
+    return credentials
@@ -0,0 +1,122 @@
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+
+
+"""
+persistent cache for cgpt responses, stored in sqlite
+entries are keyed by a hash of (model, system prompt, prompt), so changing the model,
+job description or prompt template misses the cache instead of returning stale labels
+once the stored responses go over max_bytes, the least recently used entries are evicted
+"""
+
+
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+EVICT_TO_FRACTION = 0.9  # evict down to this fraction of max_bytes
+ACCESS_FLUSH_SIZE = 256  # hits are batched before their access times are written
+
+
+def make_cache_key(model, system_prompt, prompt):
+    payload = json.dumps([model, system_prompt, prompt], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS response_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS response_cache_last_access ON response_cache (last_access)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()[0]
+        self.pending_access = {}  # key -> last access time not yet written
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response FROM response_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.pending_access[key] = time.time()
+            if len(self.pending_access) >= ACCESS_FLUSH_SIZE:
+                self.flush_access_times()
+                self.conn.commit()
+            return row[0]
+
+    def flush_access_times(self):
+        self.conn.executemany(
+            "UPDATE response_cache SET last_access = ? WHERE key = ?",
+            [(t, key) for key, t in self.pending_access.items()])
+        self.pending_access.clear()
+
+    def put(self, key, response):
+        size = len(response.encode("utf-8"))
+        with self.lock:
+            old = self.conn.execute(
+                "SELECT size FROM response_cache WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()))
+            self.total_bytes += size - (old[0] if old else 0)
+            self.pending_access.pop(key, None)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+            self.conn.commit()
+
+    def close(self):
+        """writes the batched access times, so a run with few hits still updates the lru order"""
+        with self.lock:
+            self.flush_access_times()
+            self.conn.commit()
+            self.conn.close()
+
+    def evict(self):
+        """drops least recently used entries until under EVICT_TO_FRACTION * max_bytes"""
+        target = self.max_bytes * EVICT_TO_FRACTION
+        self.flush_access_times()
+        rows = self.conn.execute(
+            "SELECT key, size FROM response_cache ORDER BY last_access").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.conn.executemany("DELETE FROM response_cache WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": self.total_bytes,
+        }
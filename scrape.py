@@ -2,34 +2,18 @@ import os
 import time
 import logging
 import json
-from datetime import datetime
 from dotenv import load_dotenv
-import praw
 import prawcore
 from praw.exceptions import RedditAPIException
-from psycopg2.extras import execute_values
+from vsm import execute_values, hot_window_sql, hot_window_start
+from json_columns import compact_rows, insert_columns
+import metrics
+from tracing import span
+from reddit_pool import load_credentials_from_env, listing_requests_this_thread
 
 
 load_dotenv()
 
-# ───────────  Logging setup ───────────
-os.makedirs("logs", exist_ok=True)
-
-log_format = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
-
-# Console handler
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(log_format)
-
-# File handler
-log_path = f"logs/scrape_{datetime.now():%Y%m%d_%H%M%S}.log"
-file_handler = logging.FileHandler(log_path, encoding="utf-8")
-file_handler.setFormatter(log_format)
-
-# Root logger setup
-logging.basicConfig(level=logging.INFO, handlers=[
-                    console_handler, file_handler])
-
 
 COMMENT_FIELDS = [
     "id", "parent_id", "link_id", "body", "permalink", "created_utc", "subreddit_id",
@@ -37,6 +21,13 @@ COMMENT_FIELDS = [
     "is_submitter", "gildings", "all_awardings", "is_en"
 ]
 
+SCRAPE_ROWS = metrics.Histogram("scrape_rows", "new submissions per scrape",
+                                buckets=(0, 1, 5, 10, 25, 50, 100, 250, 500, 1000))
+SCRAPE_PAGES = metrics.Histogram("scrape_pages", "listing pages requested per scrape",
+                                 buckets=(1, 2, 3, 5, 10, 20, 50))
+BACKOFF_RETRIES = metrics.Counter("reddit_backoff_retries_total", "retried reddit api calls", ["reason"])
+BACKOFF_SLEEP = metrics.Counter("reddit_backoff_sleep_seconds_total", "time spent sleeping before retries")
+
 SUBMISSION_FIELDS = [
     "id", "url", "domain", "title", "permalink", "created_utc", "url_overridden_by_dest",
     "subreddit_id", "subreddit", "upvote_ratio", "score", "gilded", "num_comments",
@@ -45,14 +36,18 @@ SUBMISSION_FIELDS = [
 ]
 
 
-def scrape_submissions_to_db(cur, queries):
-    reddit = make_reddit_api_interface()
+def scrape_submissions_to_db(cur, queries, reddit=None):
+    """returns the number of new submissions scraped across all queries"""
+    if reddit is None:
+        reddit = make_reddit_api_interface()
+    total_scraped = 0
     for query in queries:
         # Ensure the query exists as a valid search term
-        cur.execute(
-            "SELECT id FROM search_term WHERE name = %s", (query,)
-        )
-        result = cur.fetchone()
+        with span("scrape.lookup_term", term=query):
+            cur.execute(
+                "SELECT id FROM search_term WHERE name = %s", (query,)
+            )
+            result = cur.fetchone()
         if not result:
             raise ValueError(
                 f"The query '{query}' "
@@ -61,28 +56,46 @@ def scrape_submissions_to_db(cur, queries):
         search_term_id = result[0]
 
         # Find existing submissions for that search term
-        cur.execute("""
-            SELECT r.id
-            FROM reddit_submission r
-            JOIN search_term_match_reddit_submission m ON r.id = m.submission_id
-            WHERE m.search_term_id = %s
-        """, (search_term_id,))
-        existing_submission_ids = [row[0] for row in cur.fetchall()]
+        with span("scrape.existing_ids", term=query) as s:
+            existing_submission_ids = get_existing_submission_ids(cur, search_term_id)
+            s["rows"] = len(existing_submission_ids)
 
         if not existing_submission_ids:
             logging.info(
                 f"No existing submissions found for '{query}'")
 
         # Scrape new submissions
-        submissions_to_insert = list(get_submissions_until_duplicate(
-            reddit, query, existing_submission_ids))
+        with span("scrape.paginate", term=query) as s:
+            pages_before = listing_requests_this_thread()
+            submissions_to_insert = list(get_submissions_until_duplicate(
+                reddit, query, existing_submission_ids,
+                stop_before_utc=hot_window_start(cur) if existing_submission_ids else None))
+            s["pages"] = listing_requests_this_thread() - pages_before
+            s["rows"] = len(submissions_to_insert)
+        SCRAPE_PAGES.observe(s["pages"])
+        SCRAPE_ROWS.observe(len(submissions_to_insert))
         logging.info(
             f"{len(submissions_to_insert)} "
             "submissions found, inserting into db..."
         )
-        insert_submissions(cur, query, submissions_to_insert)
+        with span("scrape.insert", term=query, rows=len(submissions_to_insert)):
+            insert_submissions(cur, query, submissions_to_insert)
+        total_scraped += len(submissions_to_insert)
 
         logging.info(f"Scraping for query '{query}' complete.")
+    return total_scraped
+
+
+def get_existing_submission_ids(cur, search_term_id):
+    """ids of the submissions matched to the term, read from the match table's primary key alone
+    partitioned db: only the recent partitions, pagination stops at the same cutoff"""
+    hot = hot_window_sql(cur, m="search_term_match_reddit_submission")
+    cur.execute(f"""
+        SELECT m.submission_id
+        FROM search_term_match_reddit_submission m
+        WHERE m.search_term_id = %s{hot}
+    """, (search_term_id,))
+    return [row[0] for row in cur.fetchall()]
 
 
 def scrape_comments_to_db(cur, submission_id):
@@ -92,9 +105,14 @@ def scrape_comments_to_db(cur, submission_id):
 
 def scrape_comments(cur, submission_id):
     reddit = make_reddit_api_interface()
-    submission = reddit.submission(id=submission_id)
-    submission.comments.replace_more(limit=None)
-    comments = submission.comments.list()
+    with span("comments.fetch", submission_id=submission_id) as s:
+        submission = reddit.submission(id=submission_id)
+        pages_before = listing_requests_this_thread()
+        submission.comments.replace_more(limit=None)
+        s["pages"] = listing_requests_this_thread() - pages_before
+    with span("comments.flatten", submission_id=submission_id) as s:
+        comments = submission.comments.list()
+        s["rows"] = len(comments)
     if not comments:
         logging.info(f"No comments found for submission_id {submission_id}")
         return
@@ -109,14 +127,17 @@ def insert_comments(cur, comments):
         return
 
     # Prepare comment data for insertion
-    comment_rows = [clean_comment_for_insert(
-        comment) for comment in comments]
+    with span("insert.clean", rows=len(comments)):
+        comment_rows = [clean_comment_for_insert(
+            comment) for comment in comments]
+        comment_rows = compact_rows(cur, comment_rows, COMMENT_FIELDS)
     insert_query = f"""
-        INSERT INTO reddit_comment ({','.join(COMMENT_FIELDS)})
+        INSERT INTO reddit_comment ({','.join(insert_columns(COMMENT_FIELDS))})
         VALUES %s
         ON CONFLICT DO NOTHING
     """
-    execute_values(cur, insert_query, comment_rows)
+    with span("insert.execute_values", table="reddit_comment", rows=len(comment_rows)):
+        execute_values(cur, insert_query, comment_rows)
 
     logging.info(f"Inserted {len(comment_rows)} comments")
 
@@ -132,27 +153,34 @@ def insert_submissions(cur, query, submissions):
         raise ValueError(
             f"The query '{query}' does not exist in the DB as a search term.")
 
-    submission_rows = [clean_submission_for_insert(s) for s in submissions]
+    with span("insert.clean", rows=len(submissions)):
+        submission_rows = [clean_submission_for_insert(s) for s in submissions]
+        submission_rows = compact_rows(cur, submission_rows, SUBMISSION_FIELDS)
     insert_query = f"""
-        INSERT INTO reddit_submission ({','.join(SUBMISSION_FIELDS)})
+        INSERT INTO reddit_submission ({','.join(insert_columns(SUBMISSION_FIELDS))})
         VALUES %s
         ON CONFLICT DO NOTHING
     """
-    execute_values(cur, insert_query, submission_rows)
+    with span("insert.execute_values", table="reddit_submission", rows=len(submission_rows)):
+        execute_values(cur, insert_query, submission_rows)
     logging.info(
         f"Inserted {len(submission_rows)} "
         f"submissions and match rows for query: '{query}'"
     )
 
-    # Insert into match table
+    # Insert into match table, which carries created_utc for the per-term recency index
+    # (and as its partition key when partitioned)
     search_term_id = search_term_row[0]
-    match_rows = [(s.id, search_term_id) for s in submissions]
+    id_index = SUBMISSION_FIELDS.index("id")
+    created_index = SUBMISSION_FIELDS.index("created_utc")
+    match_rows = [(row[id_index], search_term_id, row[created_index]) for row in submission_rows]
     match_query = """
-        INSERT INTO search_term_match_reddit_submission (submission_id, search_term_id)
+        INSERT INTO search_term_match_reddit_submission (submission_id, search_term_id, created_utc)
         VALUES %s
         ON CONFLICT DO NOTHING
     """
-    execute_values(cur, match_query, match_rows)
+    with span("insert.execute_values", table="search_term_match_reddit_submission", rows=len(match_rows)):
+        execute_values(cur, match_query, match_rows)
     logging.info(f"Inserted {len(match_rows)} match rows for query: '{query}'")
 
 
@@ -165,17 +193,19 @@ def clean_comment_for_insert(comment):
 
 
 def clean_reddit_obj_for_insert(reddit_obj, fields):
+    """reddit_obj is a praw object or the raw api json of one (async_ingest.py)"""
+    # read praw's attributes directly, getattr on a field the api response didn't have (e.g. is_en)
+    # makes praw refetch the whole object, one extra request per row
+    data = reddit_obj if isinstance(reddit_obj, dict) else vars(reddit_obj)
     cleaned = []
     for field in fields:
-        val = getattr(reddit_obj, field, None)
+        val = data.get(field)
 
         # Fix: convert subreddit object to string
+        # dicts / lists (media, gildings, all_awardings) are kept as is for json_columns.compact_rows
         if field == "subreddit" and hasattr(val, "display_name"):
             val = val.display_name
 
-        elif isinstance(val, (dict, list)):
-            val = json.dumps(val)
-
         cleaned.append(val)
     return tuple(cleaned)
 
@@ -184,27 +214,42 @@ def scrape_to_file(queries):
     reddit = make_reddit_api_interface()
     os.makedirs("results", exist_ok=True)
     for query in queries:
-        out_file = f"results/submission_{query}.jsonl"
-        scrape_and_save_submissions_to_file(reddit, query, out_file)
+        out_dir = f"results/submission_{query}"
+        scrape_and_save_submissions_to_file(reddit, query, out_dir)
 
 
-def scrape_and_save_submissions_to_file(reddit, query, out_file):
+def scrape_and_save_submissions_to_file(reddit, query, out_dir, chunk_size=100):
+    """appends new submissions for query to a SegmentStore in out_dir
+    a results file from before the store existed (out_dir + ".jsonl") is imported into it first"""
+    from segment_store import SegmentStore  # numpy, only needed for file scrapes
     logging.info(f"Preparing to scrape query: '{query}'")
+    store = SegmentStore(out_dir)
+    legacy_file = out_dir + ".jsonl"
+    if not len(store) and os.path.isfile(legacy_file):
+        imported = store.import_jsonl(legacy_file, SUBMISSION_FIELDS)
+        logging.info(f"Imported {imported} submissions from {legacy_file}")
+    logging.info(f"Found existing store with {len(store)} submissions.")
+
+    records = []
+    for submission in get_submissions_until_duplicate(reddit, query, store):
+        records.append(submission_to_record(submission))
+        if len(records) >= chunk_size:
+            store.append(records)
+            records = []
+    store.append(records)
+    logging.info(f"Scraping for query {query} complete.")
 
-    existing_submission_ids = []
-    if os.path.isfile(out_file):
-        existing_submissions = read_submissions_from_file(out_file)
-        existing_submission_ids = [s["id"] for s in existing_submissions]
-        logging.info(
-            f"Found existing file with {len(existing_submission_ids)} submissions."
-        )
 
-    with open(out_file, "a+", encoding="utf-8") as f:
-        for submission in get_submissions_until_duplicate(
-                reddit, query, existing_submission_ids):
-            json.dump(vars(submission), f, default=str)
-            f.write("\n")
-    logging.info(f"Scraping for query {query} complete.")
+def submission_to_record(submission):
+    """the SUBMISSION_FIELDS of a praw submission as a json-ready dict, without praw internals"""
+    record = {}
+    data = vars(submission)  # see clean_reddit_obj_for_insert, getattr would refetch for is_en
+    for field in SUBMISSION_FIELDS:
+        val = data.get(field)
+        if field == "subreddit" and hasattr(val, "display_name"):
+            val = val.display_name
+        record[field] = val
+    return record
 
 
 def read_submissions_from_file(json_file):
@@ -219,17 +264,13 @@ def read_submissions_from_file(json_file):
     return submissions
 
 
-def make_reddit_api_interface():
-    try:
-        logging.info("Initializing Reddit API interface")
-        return praw.Reddit(
-            client_id=os.environ["REDDIT_ID"],
-            client_secret=os.environ["REDDIT_SECRET"],
-            user_agent=os.getenv("REDDIT_UA", "debug-scraper/0.1"),
-            ratelimit_seconds=60,
-        )
-    except KeyError as k:
-        raise SystemExit(f"Missing env var: {k}. Check your .env file.")
+def make_reddit_api_interface(credential=None):
+    """credential is an optional reddit_pool.RedditCredential
+    defaults to the REDDIT_ID/REDDIT_SECRET credential from .env"""
+    if credential is None:
+        credential = load_credentials_from_env()[0]
+    logging.info(f"Initializing Reddit API interface ({credential.name})")
+    return credential.make_interface()
 
 
 def backoff_api_call(api_call_func, *args, max_sleep=300, **kwargs):
@@ -253,11 +294,15 @@ def backoff_api_call(api_call_func, *args, max_sleep=300, **kwargs):
                     wait_seconds = wait_minutes * 60
                     logging.info(
                         f"Waiting {wait_seconds} seconds before retrying...")
+                    BACKOFF_RETRIES.inc(reason="ratelimit")
+                    BACKOFF_SLEEP.inc(wait_seconds)
                     time.sleep(wait_seconds)
                     continue
             raise
         except prawcore.exceptions.RequestException as e:
             logging.warning(f"Request exception: {e}. Retrying...")
+            BACKOFF_RETRIES.inc(reason="request_exception")
+            BACKOFF_SLEEP.inc(5 + delay)
             time.sleep(5)
         except Exception as e:
             logging.error(f"Unexpected exception: {e}")
@@ -269,11 +314,13 @@ def backoff_api_call(api_call_func, *args, max_sleep=300, **kwargs):
 def get_submissions_until_duplicate(
     reddit,
     query_str,
-    existing_submission_ids=None
+    existing_submission_ids=None,
+    stop_before_utc=None
 ):
     """
     Stops when a previously seen submission ID is encountered.
-    Each new submission is written to file immediately.
+    existing_submission_ids can be anything that supports `in` (list, set, SegmentStore)
+    stop_before_utc also stops at the first submission created before it
     """
     logging.info(f"Starting submission scrape for query: '{query_str}'")
 
@@ -288,6 +335,9 @@ def get_submissions_until_duplicate(
                 f"Stopping: submission ID {submission.id} already exists."
                 )
             break
+        elif stop_before_utc is not None and submission.created_utc < stop_before_utc:
+            logging.info(f"Stopping: submission ID {submission.id} is older than the hot window.")
+            break
         else:
             yield submission
             logging.debug(f"yielded submission ID: {submission.id}")
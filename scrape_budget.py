@@ -0,0 +1,157 @@
+import os
+import csv
+import math
+import logging
+import threading
+import numpy as np
+
+
+"""
+splits a global daily budget of listing requests (SCRAPE_DAILY_BUDGET) between search terms by expected
+relevant submissions per request
+ - demand: scrapes/day a term needs to keep up with how often it posts (see monitor.calculate_scrapes_per_day)
+ - cost: listing pages a scrape of the term takes, a moving average of what its scrapes actually used
+   (record_pages). a backfilling term pages far back, so it's charged for every page, not one scrape
+ - yield: the term's label precision (relevant / matched submissions), read from a csv with
+   search_term and precision columns, e.g. the one prune_bad_terms.term_report() writes
+ - expected relevant per request = precision * submissions/day / (demand * cost)
+every term gets MIN_SCRAPES_PER_DAY, then the rest of the budget goes to terms in order of expected
+relevant per request, each up to its demand. terms whose precision is below LOW_YIELD_PRECISION are
+demoted to the minimum. terms with no yield data yet get the average precision of the known terms
+without a budget (SCRAPE_DAILY_BUDGET unset) every term gets its demand, except demoted ones
+"""
+
+
+MIN_SCRAPES_PER_DAY = 1
+LOW_YIELD_PRECISION = 0.01  # same cutoff identify_low_pos_terms uses
+YIELD_RELOAD_INTERVAL = 3600
+PAGES_SMOOTHING = 0.3  # weight of the latest scrape in a term's pages per scrape
+
+
+class ScrapeBudget:
+    def __init__(self, daily_requests=None, yield_file=None):
+        self.daily_requests = daily_requests
+        self.yield_file = yield_file
+        self.lock = threading.Lock()
+        self.demand = {}  # term -> (submissions per day, scrapes per day)
+        self.pages = {}  # term -> listing pages per scrape, 1 until it's been scraped
+        self.precision = {}  # lowercased term -> precision
+        self.default_precision = 1.0  # for terms without yield data
+        self.allocation = {}
+        self.over_budget = False  # the MIN_SCRAPES_PER_DAY floor alone exceeds the budget
+        self.load_yields()
+
+    @classmethod
+    def from_env(cls):
+        budget = os.getenv("SCRAPE_DAILY_BUDGET")
+        return cls(daily_requests=int(budget) if budget else None,
+                   yield_file=os.getenv("TERM_YIELD_FILE"))
+
+    def load_yields(self):
+        if not self.yield_file or not os.path.isfile(self.yield_file):
+            return
+        with open(self.yield_file, newline="", encoding="utf-8") as f:
+            precision = {row["search_term"].lower(): float(row["precision"]) for row in csv.DictReader(f)}
+        with self.lock:
+            self.precision = precision
+            self.default_precision = sum(precision.values()) / len(precision) if precision else 1.0
+            self.allocate()
+        logging.info(f"loaded yield for {len(precision)} terms from {self.yield_file}")
+
+    def set_demand(self, term, submissions_per_day, scrapes_per_day):
+        with self.lock:
+            self.demand[term] = (submissions_per_day, scrapes_per_day)
+            self.allocate()
+
+    def set_demands(self, terms_and_demand):
+        """set_demand for [(term, submissions per day, scrapes per day)], allocating once"""
+        with self.lock:
+            for term, submissions_per_day, scrapes_per_day in terms_and_demand:
+                self.demand[term] = (submissions_per_day, scrapes_per_day)
+            self.allocate()
+
+    def record_pages(self, term, pages):
+        """charges the term the listing pages its last scrape used. the next set_demand reallocates"""
+        with self.lock:
+            previous = self.pages.get(term)
+            pages = max(pages, 1)
+            self.pages[term] = pages if previous is None else previous + PAGES_SMOOTHING * (pages - previous)
+
+    def remove_term(self, term):
+        with self.lock:
+            self.demand.pop(term, None)
+            self.pages.pop(term, None)
+            self.allocate()
+
+    def term_precision(self, term):
+        # average of the known terms, 1.0 when nothing is labeled yet (plain frequency scheduling)
+        return self.precision.get(term.lower(), self.default_precision)
+
+    def expected_relevant_per_request(self, term):
+        submissions_per_day, scrapes_per_day = self.demand[term]
+        return self.term_precision(term) * submissions_per_day / (scrapes_per_day * self.pages.get(term, 1))
+
+    def is_demoted(self, term):
+        return self.term_precision(term) < LOW_YIELD_PRECISION
+
+    def allocate(self):
+        """recomputes scrapes/day for every term. call with self.lock held
+        vectorized, set_demand reallocates all terms after every scrape"""
+        terms = list(self.demand)
+        submissions_per_day = np.fromiter((self.demand[t][0] for t in terms), dtype=np.float64, count=len(terms))
+        demand = np.fromiter((self.demand[t][1] for t in terms), dtype=np.int64, count=len(terms))
+        precision = np.fromiter((self.term_precision(t) for t in terms), dtype=np.float64, count=len(terms))
+        pages = np.fromiter((self.pages.get(t, 1) for t in terms), dtype=np.float64, count=len(terms))
+        candidates = np.flatnonzero(precision >= LOW_YIELD_PRECISION)
+        allocation = np.full(len(terms), MIN_SCRAPES_PER_DAY, dtype=np.int64)
+        if self.daily_requests is None:
+            allocation[candidates] = np.maximum(MIN_SCRAPES_PER_DAY, demand[candidates])
+        else:
+            remaining = self.daily_requests - MIN_SCRAPES_PER_DAY * pages.sum()
+            if remaining < 0 and not self.over_budget:
+                logging.warning(f"SCRAPE_DAILY_BUDGET {self.daily_requests} is below the {MIN_SCRAPES_PER_DAY} "
+                                f"scrape/day floor of {len(terms)} terms ({pages.sum():.0f} requests), scraping "
+                                f"{-remaining:.0f} more requests per day than budgeted. raise the budget or prune terms")
+            self.over_budget = remaining < 0
+            expected = precision * submissions_per_day / (demand * pages)
+            # best expected relevant per request first, ties in insertion order
+            order = candidates[np.argsort(-expected[candidates], kind="stable")]
+            # extra scrapes are paid for in requests, each costs the term's pages per scrape
+            extras = np.maximum(demand[order] - MIN_SCRAPES_PER_DAY, 0) * pages[order]
+            already_given = np.cumsum(extras) - extras
+            given = np.clip(remaining - already_given, 0, extras)
+            allocation[order] += np.floor(given / pages[order] + 1e-9).astype(np.int64)
+        self.allocation = dict(zip(terms, allocation.tolist()))
+
+    def interval_for(self, term):
+        """seconds until the term's next scrape"""
+        with self.lock:
+            return 86400 / max(self.allocation.get(term, MIN_SCRAPES_PER_DAY), MIN_SCRAPES_PER_DAY)
+
+    def intervals_for(self, terms):
+        """interval_for of every term as an array"""
+        with self.lock:
+            scrapes = np.fromiter((self.allocation.get(t, MIN_SCRAPES_PER_DAY) for t in terms),
+                                  dtype=np.float64, count=len(terms))
+        return 86400 / np.maximum(scrapes, MIN_SCRAPES_PER_DAY)
+
+    def report(self, limit=20):
+        """logs budget share and yield for the terms with the biggest share, plus the demoted terms"""
+        with self.lock:
+            requests = {term: scrapes * self.pages.get(term, 1) for term, scrapes in self.allocation.items()}
+            total = sum(requests.values()) or 1
+            rows = []
+            for term, scrapes in self.allocation.items():
+                submissions_per_day, demand = self.demand[term]
+                rows.append((term, scrapes, demand, self.pages.get(term, 1), requests[term] / total,
+                             self.term_precision(term), self.expected_relevant_per_request(term),
+                             self.is_demoted(term)))
+        rows.sort(key=lambda r: r[1] * r[3], reverse=True)
+        budget = "unlimited" if self.daily_requests is None else self.daily_requests
+        logging.info(f"scrape budget: {math.ceil(total)} of {budget} requests/day over {len(rows)} terms, "
+                     f"{sum(r[7] for r in rows)} demoted")
+        for term, scrapes, demand, pages, share, precision, per_request, demoted in rows[:limit]:
+            logging.info(f"  {term}: {scrapes}/{demand} scrapes/day x {pages:.1f} pages ({share:.1%} of budget), "
+                         f"precision {precision:.3f}, {per_request:.2f} relevant/request"
+                         + (" [demoted]" if demoted else ""))
+        return rows
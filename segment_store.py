@@ -0,0 +1,280 @@
+import os
+import json
+import gzip
+import zlib
+import logging
+import numpy as np
+from utils import EnhancedJSONEncoder
+
+
+"""
+file-backed store for scrape_to_file results, one directory per query
+ - records are appended to jsonl segments (segment_00000.jsonl[.gz], ...) capped at max_segment_bytes.
+   with compress=True each append is written as its own gzip member, which gzip readers
+   read back as one stream
+ - ids.idx is an open-addressing hash table of submission ids on disk, memory-mapped, so checking
+   whether an id was already scraped is O(1) and opening the store doesn't read any segment.
+   reddit ids are base36, so the key is the id itself as an integer (+1, 0 marks an empty slot)
+ - the index header records the segment and byte offset its ids cover. an append fsyncs the records,
+   indexes their ids, then moves that offset past them, so anything after it is a write that didn't
+   finish. opening the store indexes the complete records after it and truncates a torn last record
+   or gzip member. a missing index (or one from before the header) is rebuilt from all segments
+ - readers stop at the committed offset, so they never see a half-written append
+"""
+
+
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+INITIAL_INDEX_SLOTS = 1 << 14
+MAX_LOAD_FACTOR = 0.5
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15  # fibonacci hashing
+# header: number of ids, INDEX_MAGIC, committed segment number, committed byte offset in that segment
+HEADER_SLOTS = 4
+INDEX_MAGIC = 0x5345474944583031  # "SEGIDX01", far above any base36 id key
+READ_CHUNK_BYTES = 1024 * 1024
+
+
+def id_key(submission_id):
+    return int(submission_id, 36) + 1
+
+
+def segment_number(name):
+    return int(name[len("segment_"):].split(".")[0])
+
+
+def iter_complete_chunks(path, start=0):
+    """yields (data, end offset) for every complete record chunk in a segment after byte offset start:
+    gzip members of a compressed segment, lines of a plain one. stops at the first torn or corrupt one"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        if not path.endswith(".gz"):
+            for line in iter(f.readline, b""):
+                if not line.endswith(b"\n"):
+                    return
+                yield line, f.tell()
+            return
+        member_start, fed, out = start, 0, []
+        decompressor = zlib.decompressobj(wbits=31)
+        pending = b""
+        while True:
+            chunk = pending or f.read(READ_CHUNK_BYTES)
+            if not chunk:
+                return
+            try:
+                out.append(decompressor.decompress(chunk))
+            except zlib.error:
+                return
+            if not decompressor.eof:
+                fed, pending = fed + len(chunk), b""
+                continue
+            pending = decompressor.unused_data
+            member_start += fed + len(chunk) - len(pending)
+            yield b"".join(out), member_start
+            fed, out = 0, []
+            decompressor = zlib.decompressobj(wbits=31)
+
+
+class IdIndex:
+    """memory-mapped uint64 hash table. the first HEADER_SLOTS slots are the header, the rest is the table"""
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isfile(path):
+            empty = np.zeros(INITIAL_INDEX_SLOTS + HEADER_SLOTS, dtype=np.uint64)
+            empty[1] = INDEX_MAGIC
+            empty.tofile(path)
+        self.table = np.memmap(path, dtype=np.uint64, mode="r+")
+
+    @staticmethod
+    def is_current(path):
+        """False for an index written before the header existed"""
+        header = np.fromfile(path, dtype=np.uint64, count=2)
+        return len(header) == 2 and int(header[1]) == INDEX_MAGIC
+
+    @property
+    def capacity(self):
+        return len(self.table) - HEADER_SLOTS
+
+    def __len__(self):
+        return int(self.table[0])
+
+    @property
+    def committed(self):
+        """(segment number, byte offset) up to which the segments are indexed"""
+        return int(self.table[2]), int(self.table[3])
+
+    def commit(self, segment, offset):
+        self.flush()  # the ids before the offset that covers them
+        self.table[2] = segment
+        self.table[3] = offset
+        self.flush()
+
+    def find_slot(self, key):
+        """slot holding key, or the empty slot where it would go"""
+        mask = self.capacity - 1
+        slot = ((key * HASH_MULTIPLIER) & 0xFFFFFFFFFFFFFFFF) >> (64 - mask.bit_length())
+        while True:
+            value = int(self.table[slot + HEADER_SLOTS])
+            if value == 0 or value == key:
+                return slot + HEADER_SLOTS
+            slot = (slot + 1) & mask
+
+    def __contains__(self, submission_id):
+        key = id_key(submission_id)
+        return int(self.table[self.find_slot(key)]) == key
+
+    def add(self, submission_id):
+        key = id_key(submission_id)
+        slot = self.find_slot(key)
+        if int(self.table[slot]) == key:
+            return
+        self.table[slot] = key
+        self.table[0] += 1
+        if len(self) > self.capacity * MAX_LOAD_FACTOR:
+            self.grow()
+
+    def grow(self):
+        keys = self.table[HEADER_SLOTS:][self.table[HEADER_SLOTS:] != 0].copy()
+        header = self.table[:HEADER_SLOTS].copy()
+        del self.table
+        tmp_path = self.path + ".tmp"
+        table = np.zeros(self.next_capacity(len(keys)) + HEADER_SLOTS, dtype=np.uint64)
+        table[:HEADER_SLOTS] = header
+        table.tofile(tmp_path)
+        os.replace(tmp_path, self.path)
+        self.table = np.memmap(self.path, dtype=np.uint64, mode="r+")
+        for key in keys:
+            slot = self.find_slot(int(key))
+            self.table[slot] = key
+        self.table[0] = len(keys)
+
+    @staticmethod
+    def next_capacity(count):
+        capacity = INITIAL_INDEX_SLOTS
+        while count > capacity * MAX_LOAD_FACTOR / 2:
+            capacity *= 2
+        return capacity
+
+    def flush(self):
+        self.table.flush()
+
+
+class SegmentStore:
+    def __init__(self, directory, max_segment_bytes=DEFAULT_SEGMENT_BYTES, compress=True):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.compress = compress
+        index_path = os.path.join(directory, "ids.idx")
+        if os.path.isfile(index_path) and not IdIndex.is_current(index_path):
+            os.remove(index_path)  # older layout without a committed offset, rebuilt by recover()
+        self.index = IdIndex(index_path)
+        self.recover()
+
+    def __contains__(self, submission_id):
+        return submission_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def segments(self):
+        return sorted(f for f in os.listdir(self.directory) if f.startswith("segment_"))
+
+    def active_segment(self):
+        """path of the segment to append to, starting a new one once the last is full"""
+        segments = self.segments()
+        if segments:
+            path = os.path.join(self.directory, segments[-1])
+            if os.path.getsize(path) < self.max_segment_bytes:
+                return path
+        suffix = ".jsonl.gz" if self.compress else ".jsonl"
+        return os.path.join(self.directory, f"segment_{len(segments):05d}{suffix}")
+
+    def append(self, records):
+        """appends dicts with an "id" key, skipping ids already in the store
+        returns the number of records written"""
+        lines = []
+        new_ids = set()
+        for record in records:
+            if record["id"] in new_ids or record["id"] in self.index:
+                continue
+            lines.append(json.dumps(record, ensure_ascii=False, cls=EnhancedJSONEncoder))
+            new_ids.add(record["id"])
+        if not lines:
+            return 0
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        path = self.active_segment()
+        with open(path, "ab") as f:
+            f.write(gzip.compress(data) if path.endswith(".gz") else data)
+            f.flush()
+            os.fsync(f.fileno())
+            end = f.tell()
+        # only index ids once their records are on disk, and only commit once they're indexed
+        for submission_id in new_ids:
+            self.index.add(submission_id)
+        self.index.commit(segment_number(os.path.basename(path)), end)
+        return len(lines)
+
+    def iter_records(self, columns=None):
+        """streams every committed record, one segment at a time. columns keeps only those keys"""
+        committed_segment, committed_offset = self.index.committed
+        for segment in self.segments():
+            number = segment_number(segment)
+            if number > committed_segment:
+                break
+            for data, end in iter_complete_chunks(os.path.join(self.directory, segment)):
+                if number == committed_segment and end > committed_offset:
+                    break
+                yield from parse_records(data, columns)
+
+    def recover(self):
+        """indexes the complete records after the committed offset (an append that crashed before
+        committing, or every segment for a new index) and truncates a torn tail"""
+        committed_segment, committed_offset = self.index.committed
+        for segment in self.segments():
+            number = segment_number(segment)
+            if number < committed_segment:
+                continue
+            path = os.path.join(self.directory, segment)
+            start = committed_offset if number == committed_segment else 0
+            size = os.path.getsize(path)
+            if size == start:
+                continue
+            logging.info(f"indexing {size - start} uncommitted bytes of {path}")
+            end = start
+            for data, end in iter_complete_chunks(path, start):
+                for record in parse_records(data, ["id"]):
+                    self.index.add(record["id"])
+            if end < size:
+                logging.warning(f"truncating {size - end} bytes of a torn write at the end of {path}")
+                with open(path, "r+b") as f:
+                    f.truncate(end)
+                    os.fsync(f.fileno())
+            self.index.commit(number, end)
+
+    def import_jsonl(self, path, fields=None, chunk_size=10_000):
+        """one-off import of an old single-file results jsonl, trimming records to fields"""
+        total = 0
+        with open(path, encoding="utf-8") as f:
+            records = []
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records.append({k: record.get(k) for k in fields} if fields else record)
+                if len(records) >= chunk_size:
+                    total += self.append(records)
+                    records = []
+        return total + self.append(records)
+
+
+def parse_records(data, columns=None):
+    for line in data.splitlines():
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            logging.warning("Skipping malformed JSON line")
+            continue
+        if columns is not None:
+            record = {c: record.get(c) for c in columns}
+        yield record
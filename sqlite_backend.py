@@ -0,0 +1,118 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+
+
+"""
+embedded sqlite storage backend for vsm.py, for single-node deployments, tests and benchmarks
+set VSM_BACKEND=sqlite (and optionally VSM_SQLITE_PATH) and vsm.getcursor() hands out cursors on a
+local sqlite file instead of the remote postgres pool
+ - same tables as the postgres db (search_term, reddit_submission, reddit_comment, match tables),
+   created by migrations.py when vsm connects
+ - WAL mode with synchronous=NORMAL, one connection per thread, and each getcursor() block is one
+   transaction, so a scrape's submission + match inserts are committed together
+ - SqliteCursor accepts the postgres style sql used across the repo: %s placeholders and
+   "= ANY(%s)" with a list parameter. anything postgres-only (LATERAL joins, ALTER ... IF NOT EXISTS)
+   needs a sqlite variant in the calling code, see vsm.py
+"""
+
+
+DEFAULT_PATH = "data/vsm.sqlite3"
+BUSY_TIMEOUT = 30  # seconds to wait on another writer before giving up
+
+PLACEHOLDER = re.compile(r"=\s*ANY\(%s\)|%s", re.IGNORECASE)
+
+
+def translate(sql, params=()):
+    """turns postgres style sql/params into sqlite's: %s -> ?, = ANY(%s) -> IN (json list)"""
+    params = list(params or ())
+    new_params = []
+    index = 0
+
+    def replace(match):
+        nonlocal index
+        value = params[index]
+        index += 1
+        if match.group(0) == "%s":
+            new_params.append(value)
+            return "?"
+        new_params.append(json.dumps(list(value)))
+        return "IN (SELECT value FROM json_each(?))"
+
+    return PLACEHOLDER.sub(replace, sql), new_params
+
+
+def to_sqlite_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+class SqliteCursor:
+    """wraps a sqlite3 cursor so callers written against psycopg2 work unchanged"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        self.cursor.execute(*translate(sql, params))
+        return self
+
+    def executemany(self, sql, rows):
+        self.cursor.executemany(sql.replace("%s", "?"), ([to_sqlite_value(v) for v in row] for row in rows))
+        return self
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+
+class SqliteBackend:
+    def __init__(self, path=None):
+        self.path = path or os.getenv("VSM_SQLITE_PATH", DEFAULT_PATH)
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.local = threading.local()
+
+    def connection(self):
+        """one connection per thread, sqlite connections can't be shared between threads"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def cursor(self):
+        return SqliteCursor(self.connection().cursor())
+
+    def commit(self):
+        self.connection().commit()
+
+    def rollback(self):
+        self.connection().rollback()
+
+    def close(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
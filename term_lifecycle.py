@@ -0,0 +1,91 @@
+import logging
+
+
+"""
+bulk search term retirement / deletion
+every operation takes a whole list of term names and runs as a handful of set-based statements
+(name = ANY(%s)) on the caller's cursor, so it's one transaction and a few round trips no matter
+how many terms are pruned
+ - retire_search_terms() is the soft delete: sets search_term.retired_at, the terms and their
+   matches stay in the db but the monitor stops scheduling them on its next term refresh
+   (restore_search_terms() undoes it, restored terms are picked up when the monitor restarts)
+ - delete_search_terms() removes the terms and all their matches for good
+both take dry_run=True to only count the rows they would touch (the caller should roll back /
+use getcursor(commit=False) for dry runs)
+"""
+
+
+MATCH_TABLES = [
+    "search_term_match_tweet",
+    "search_term_match_reddit_comment",
+    "search_term_match_reddit_submission",
+    "search_term_match_podcast_segment",
+]
+
+
+def get_term_ids(cur, names):
+    """returns {name: id} for the names that exist"""
+    cur.execute("SELECT name, id FROM search_term WHERE name = ANY(%s)", (list(names),))
+    return dict(cur.fetchall())
+
+
+def count_matches(cur, term_ids):
+    """returns {match table: rows matching the term ids}"""
+    counts = {}
+    for table in MATCH_TABLES:
+        cur.execute(f"SELECT COUNT(*) FROM {table} WHERE search_term_id = ANY(%s)", (term_ids,))
+        counts[table] = cur.fetchone()[0]
+    return counts
+
+
+def retire_search_terms(cur, names, dry_run=False):
+    """soft deletes the terms. returns the number of terms retired (or that would be)"""
+    names = list(names)
+    if dry_run:
+        cur.execute("SELECT COUNT(*) FROM search_term WHERE name = ANY(%s) AND retired_at IS NULL", (names,))
+        count = cur.fetchone()[0]
+    else:
+        cur.execute("UPDATE search_term SET retired_at = CURRENT_TIMESTAMP WHERE name = ANY(%s) AND retired_at IS NULL",
+                    (names,))
+        count = cur.rowcount
+    logging.info(f"{'would retire' if dry_run else 'retired'} {count} of {len(names)} search terms")
+    return count
+
+
+def restore_search_terms(cur, names):
+    """undoes retire_search_terms. returns the number of terms restored"""
+    cur.execute("UPDATE search_term SET retired_at = NULL WHERE name = ANY(%s) AND retired_at IS NOT NULL",
+                (list(names),))
+    return cur.rowcount
+
+
+def delete_search_terms(cur, names, dry_run=False):
+    """deletes the terms and all their matches
+    returns {table: rows deleted (or that would be)}"""
+    term_ids = get_term_ids(cur, names)
+    missing = set(names) - set(term_ids)
+    if missing:
+        logging.info(f"no search term found for {len(missing)} names: {sorted(missing)}")
+    ids = list(term_ids.values())
+    if not ids:
+        return {}
+
+    if dry_run:
+        counts = count_matches(cur, ids)
+        counts["search_term"] = len(ids)
+    else:
+        counts = {}
+        for table in MATCH_TABLES:
+            cur.execute(f"DELETE FROM {table} WHERE search_term_id = ANY(%s)", (ids,))
+            counts[table] = cur.rowcount
+        cur.execute("DELETE FROM search_term WHERE id = ANY(%s)", (ids,))
+        counts["search_term"] = cur.rowcount
+    for table, count in counts.items():
+        logging.info(f"{table}: {count} rows {'would be deleted' if dry_run else 'deleted'}")
+    return counts
+
+
+def get_retired_search_terms(cur):
+    """lowercased names of retired terms"""
+    cur.execute("SELECT name FROM search_term WHERE retired_at IS NOT NULL")
+    return {row[0].lower() for row in cur.fetchall()}
@@ -1,6 +1,7 @@
 from vsm import getcursor, init_connection, cleanup
 from cgpt import single_prompt_response
 from scrape import get_submissions_until_duplicate, make_reddit_api_interface
+from utils import setup_logging
 
 
 def test_db():
@@ -43,6 +44,7 @@ def test_reddit():
         
         
 if __name__ == "__main__":
+    setup_logging()
     init_connection()  # establish db/ssh connections
     test_db()
     cleanup()  # cleanup since the next test might change tunnel params
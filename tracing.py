@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import threading
+import itertools
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+
+
+"""
+lightweight tracing spans and an on-demand sampling profiler
+
+spans: `with span("scrape.paginate", term=query) as s: ...; s["rows"] = n` writes one json line per
+span to TRACE_FILE (unset -> spans are a no-op) with its duration, thread, parent span and any
+fields/counts set on it. spans nest per thread and per asyncio task (the stack is a context variable,
+so coroutines running at the same time don't become each other's parents)
+
+profiler: install_profiler() registers a SIGUSR1 handler. `kill -USR1 <pid>` (or creating
+PROFILE_FLAG_FILE, checked by the monitor loop) samples every thread's stack for PROFILE_SECONDS and
+writes them in collapsed "frame;frame;frame count" format, which flamegraph.pl / speedscope read
+"""
+
+
+PROFILE_SECONDS = 30
+PROFILE_INTERVAL = 0.005
+PROFILE_DIR = "logs"
+PROFILE_FLAG_FILE = "logs/profile.flag"
+
+_trace_lock = threading.Lock()
+_trace_file = None
+_stack = contextvars.ContextVar("span_stack", default=())
+_span_ids = itertools.count(1)
+
+
+def trace_file():
+    global _trace_file
+    if _trace_file is None:
+        path = os.getenv("TRACE_FILE")
+        if not path:
+            return None
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        _trace_file = open(path, "a", encoding="utf-8", buffering=1)
+    return _trace_file
+
+
+@contextmanager
+def span(name, **fields):
+    """times the block and writes it as a json event. the yielded dict can be filled with counts"""
+    f = trace_file()
+    if f is None:
+        yield fields
+        return
+    stack = _stack.get()
+    span_id = next(_span_ids)
+    parent = stack[-1] if stack else None
+    _stack.set(stack + (span_id,))
+    start = time.time()
+    start_perf = time.perf_counter()
+    error = None
+    try:
+        yield fields
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        # drop this span's own id, not the top one, in case a span opened in this context is still open
+        _stack.set(tuple(i for i in _stack.get() if i != span_id))
+        event = {
+            "name": name,
+            "span_id": span_id,
+            "parent_id": parent,
+            "thread": threading.current_thread().name,
+            "start": start,
+            "duration_ms": round((time.perf_counter() - start_perf) * 1000, 3),
+            **fields,
+        }
+        if error:
+            event["error"] = error
+        line = json.dumps(event, default=str)
+        with _trace_lock:
+            f.write(line + "\n")
+
+
+class SamplingProfiler(threading.Thread):
+    """samples the stacks of all other threads every interval seconds for duration seconds"""
+
+    def __init__(self, duration=PROFILE_SECONDS, interval=PROFILE_INTERVAL, out_dir=PROFILE_DIR):
+        super().__init__(name="sampling-profiler", daemon=True)
+        self.duration = duration
+        self.interval = interval
+        self.out_dir = out_dir
+        self.stacks = Counter()
+
+    def run(self):
+        me = threading.get_ident()
+        names = {}
+        end = time.time() + self.duration
+        while time.time() < end:
+            names.update({t.ident: t.name for t in threading.enumerate()})
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                self.stacks[collapse(frame, names.get(ident, str(ident)))] += 1
+            time.sleep(self.interval)
+        path = self.dump()
+        logging.info(f"profile with {sum(self.stacks.values())} samples written to {path}")
+
+    def dump(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, f"profile_{time.strftime('%Y%m%d_%H%M%S')}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+def collapse(frame, thread_name):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join([thread_name] + frames[::-1])
+
+
+_profiler = None
+
+
+def start_profile(duration=PROFILE_SECONDS):
+    """starts a sampling profile unless one is already running. returns False if one was"""
+    global _profiler
+    if _profiler is not None and _profiler.is_alive():
+        return False
+    logging.info(f"starting {duration}s sampling profile")
+    _profiler = SamplingProfiler(duration)
+    _profiler.start()
+    return True
+
+
+def install_profiler(signum=getattr(signal, "SIGUSR1", None)):
+    """profile the running process on `kill -USR1 <pid>`. must be called from the main thread"""
+    if signum is None:
+        return  # no SIGUSR1 on windows, use PROFILE_FLAG_FILE instead
+    signal.signal(signum, lambda *_: start_profile())
+
+
+def check_profile_flag(path=PROFILE_FLAG_FILE):
+    """starts a profile if the flag file exists (and removes it), for when signals aren't an option"""
+    if os.path.exists(path):
+        os.remove(path)
+        start_profile()
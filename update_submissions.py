@@ -2,6 +2,8 @@ import logging
 import prawcore  # for handling not-found/deleted errors
 from scrape import make_reddit_api_interface
 from vsm import getcursor, init_connection
+from tracing import span
+from utils import setup_logging
 
 
 def test():
@@ -66,17 +68,18 @@ def update_selected_submission_stats(submission_ids):
     reddit = make_reddit_api_interface()
 
     # Fetch titles for those IDs to print/log meaningful messages
-    with getcursor() as cur:
+    with span("stats.select", ids=len(submission_ids)) as s, getcursor() as cur:
         cur.execute(
             "SELECT id, title FROM reddit_submission WHERE id = ANY(%s)",
             (submission_ids,)
         )
         submissions = cur.fetchall()
+        s["rows"] = len(submissions)
 
     updated = 0
     failed = 0
 
-    with getcursor() as cur:
+    with span("stats.refresh", rows=len(submissions)) as s, getcursor() as cur:
         for sub_id, title in submissions:
             try:
                 submission = reddit.submission(id=sub_id)
@@ -101,10 +104,13 @@ def update_selected_submission_stats(submission_ids):
             except Exception as e:
                 logging.error(f"Unexpected error for {sub_id}: {e}")
                 failed += 1
+        s["updated"] = updated
+        s["failed"] = failed
 
     print(f"Updated: {updated}, Failed: {failed}")
 
 
 if __name__ == "__main__":
+    setup_logging()
     init_connection()  # sets up ssh_tunnel and pg_pool
     update_submission_stats()
\ No newline at end of file
@@ -1,9 +1,29 @@
+import os
 import json
 import decimal
 import uuid
+import logging
 import datetime
 
 
+
+def setup_logging(prefix="scrape", level=logging.INFO):
+    """logs to the console and to logs/<prefix>_<timestamp>.log. entry points call this once,
+    importing modules never does. returns the log file path"""
+    root = logging.getLogger()
+    if getattr(root, "log_path", None):
+        return root.log_path
+    os.makedirs("logs", exist_ok=True)
+    log_format = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(log_format)
+    log_path = f"logs/{prefix}_{datetime.datetime.now():%Y%m%d_%H%M%S}.log"
+    file_handler = logging.FileHandler(log_path, encoding="utf-8")
+    file_handler.setFormatter(log_format)
+    logging.basicConfig(level=level, handlers=[console_handler, file_handler])
+    root.log_path = log_path
+    return log_path
+
 def dump_submissions(submissions, file):
     with open(file, "w", encoding="utf-8") as f:
         json.dump(submissions, f, indent=2,
@@ -11,11 +31,52 @@ def dump_submissions(submissions, file):
 
 
 def load_submissions(file):
+    """loads a whole submissions file into memory as {search term: [submissions]}
+    prefer iter_submissions for .jsonl files, which doesn't need a full load"""
+    if file.endswith(".jsonl"):
+        submissions = {}
+        for row in iter_submissions(file):
+            submissions.setdefault(row.pop("search_term_name"), []).append(row)
+        return submissions
     with open(file, "r", encoding="utf-8") as f:
         submissions = json.load(f)
         return submissions
 
 
+def dump_submissions_jsonl(rows, file, chunk_size=1000):
+    """streams an iterable of dicts to a jsonl file chunk_size lines at a time, so memory use
+    doesn't grow with the number of rows. the file is replaced atomically when done
+    returns the number of rows written"""
+    tmp_file = file + ".tmp"
+    count = 0
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        chunk = []
+        for row in rows:
+            chunk.append(json.dumps(row, ensure_ascii=False, cls=EnhancedJSONEncoder))
+            if len(chunk) >= chunk_size:
+                f.write("\n".join(chunk) + "\n")
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            f.write("\n".join(chunk) + "\n")
+            count += len(chunk)
+    os.replace(tmp_file, file)
+    return count
+
+
+def iter_submissions(file, predicate=None, columns=None):
+    """yields rows from a jsonl submissions file one at a time
+    predicate filters rows, columns keeps only those keys"""
+    with open(file, "r", encoding="utf-8") as f:
+        for line in f:
+            row = json.loads(line)
+            if predicate is not None and not predicate(row):
+                continue
+            if columns is not None:
+                row = {c: row.get(c) for c in columns}
+            yield row
+
+
 class EnhancedJSONEncoder(json.JSONEncoder):
     # allows reddit data to be dumped to json
     # used to deal with some types from DB that aren't JSON-serializable by default
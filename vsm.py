@@ -1,57 +1,96 @@
-from sshtunnel import SSHTunnelForwarder
-from psycopg2.pool import ThreadedConnectionPool
-from collections import defaultdict
 import os
+import time
 import atexit
+from collections import defaultdict
+from itertools import combinations
 from contextlib import contextmanager
 from dotenv import load_dotenv
 
+from sqlite_backend import SqliteBackend, SqliteCursor
+import metrics
+
 load_dotenv()
 
-USE_SSH_TUNNEL = os.environ.get("USE_SSH_TUNNEL") == "1"
+# "postgres" (remote db, default) or "sqlite" (embedded local file, see sqlite_backend.py)
+# read from VSM_BACKEND by init_connection, so importing vsm doesn't fix it
+BACKEND = None
+
+
+def azure_credentials():
+    """postgres connection settings, read when the pool is created so importing vsm needs no PG* vars"""
+    return {
+        "host": os.environ["PGHOST"],
+        "user": os.environ["PGUSER"],
+        "password": os.environ["PGPASSWORD"],
+        "port": int(os.environ["PGPORT"]),
+        "database": os.environ["PGDATABASE"],
+    }
 
-AZURE_CREDENTIALS = {
-    "host": os.environ["PGHOST"],
-    "user": os.environ["PGUSER"],
-    "password": os.environ["PGPASSWORD"],
-    "port": int(os.environ["PGPORT"]),
-    "database": os.environ["PGDATABASE"],
-}
 
-SSH_TUNNEL_CREDENTIALS = {
-    'ssh_host': os.environ['SSH_HOST'],
-    'ssh_username': os.environ['SSH_USERNAME'],
-    'ssh_pkey': os.environ['SSH_PKEY']
-}
+def ssh_tunnel_credentials():
+    """only read when a tunnel is opened"""
+    return {
+        'ssh_host': os.environ['SSH_HOST'],
+        'ssh_username': os.environ['SSH_USERNAME'],
+        'ssh_pkey': os.environ['SSH_PKEY']
+    }
+
+
+POOL_MAX_CONNECTIONS = 10
+DEFAULT_HOT_WINDOW_DAYS = 120  # partitioned mode: how far back the scheduler and scrape queries read
+MAX_SUPER_TERM_WORDS = 12  # terms with more distinct words are compared pairwise in remove_super_terms
+
+DB_INSERT_LATENCY = metrics.Histogram("db_insert_seconds", "multi-row insert latency", ["table"])
+DB_CONNECTIONS_IN_USE = metrics.Gauge("db_pool_connections_in_use", "connections checked out of the pool")
+DB_POOL_SIZE = metrics.Gauge("db_pool_max_connections", "size of the connection pool")
+DB_ERRORS = metrics.Counter("db_errors_total", "getcursor blocks that raised", ["exception"])
 
 tunnel = None
 pg_pool = None
+sqlite_backend = None
+_partitioned_tables = None
 
 def init_connection(force_tunnel=False):
-    global tunnel, pg_pool
+    global tunnel, pg_pool, sqlite_backend, BACKEND
 
-    if USE_SSH_TUNNEL or force_tunnel:
+    BACKEND = os.environ.get("VSM_BACKEND", "postgres")
+    if BACKEND == "sqlite":
+        sqlite_backend = SqliteBackend()
+        print(f"Using embedded sqlite db at {sqlite_backend.path}")
+        import migrations  # imports vsm itself
+        with getcursor() as cur:
+            migrations.migrate(cur)
+        return
+
+    # psycopg2 and sshtunnel (paramiko) are slow imports, only pay for them when connecting to postgres
+    from psycopg2.pool import ThreadedConnectionPool
+    credentials = azure_credentials()
+    if os.environ.get("USE_SSH_TUNNEL") == "1" or force_tunnel:
+        from sshtunnel import SSHTunnelForwarder
         tunnel = SSHTunnelForwarder(
-            remote_bind_address=(AZURE_CREDENTIALS['host'], int(AZURE_CREDENTIALS['port'])),
+            remote_bind_address=(credentials['host'], int(credentials['port'])),
             local_bind_address=('localhost', 5432),
-            **SSH_TUNNEL_CREDENTIALS
+            **ssh_tunnel_credentials()
         )
         tunnel.start()
         print(f"SSH tunnel established at localhost:{tunnel.local_bind_port}")
-        
-        # update azure credentials with tunnel info
-        AZURE_CREDENTIALS['host'] = 'localhost'
-        AZURE_CREDENTIALS['port'] = tunnel.local_bind_port
 
+        # connect through the tunnel
+        credentials['host'] = 'localhost'
+        credentials['port'] = tunnel.local_bind_port
+
+    DB_POOL_SIZE.set(POOL_MAX_CONNECTIONS)
     pg_pool = ThreadedConnectionPool(
         minconn=1,
-        maxconn=10,
-        **AZURE_CREDENTIALS
+        maxconn=POOL_MAX_CONNECTIONS,
+        **credentials
     )
 
 @atexit.register
 def cleanup():
-    global tunnel, pg_pool
+    global tunnel, pg_pool, sqlite_backend
+    if sqlite_backend:
+        sqlite_backend.close()
     if pg_pool:
         print("Closing PostgreSQL connection pool...")
         pg_pool.closeall()
@@ -61,38 +100,124 @@ def cleanup():
 
 
 @contextmanager
-def getcursor(commit=True):
+def getcursor(commit=True, name=None, itersize=2000):
+    """name opens a server-side cursor, which streams rows in itersize chunks
+    instead of loading the whole result into memory (sqlite cursors always stream)"""
+    if sqlite_backend is not None:
+        try:
+            yield sqlite_backend.cursor()
+            if commit:
+                sqlite_backend.commit()
+            else:
+                sqlite_backend.rollback()
+        except Exception as e:
+            DB_ERRORS.inc(exception=type(e).__name__)
+            sqlite_backend.rollback()
+            raise e
+        return
+
     conn = pg_pool.getconn()
+    DB_CONNECTIONS_IN_USE.inc()
     try:
-        with conn.cursor() as cur:
+        with conn.cursor(name=name) as cur:
+            if name:
+                cur.itersize = itersize
             yield cur
         if commit:
             conn.commit()
     except Exception as e:
+        DB_ERRORS.inc(exception=type(e).__name__)
         conn.rollback()
         raise e
     finally:
         pg_pool.putconn(conn)
+        DB_CONNECTIONS_IN_USE.dec()
+
+
+def execute_values(cur, query, rows):
+    """multi-row insert for either backend. query has a single "VALUES %s" like psycopg2's execute_values"""
+    table = query.split("INTO", 1)[-1].split()[0] if "INTO" in query else "unknown"
+    with DB_INSERT_LATENCY.time(table=table):
+        if isinstance(cur, SqliteCursor):
+            if rows:
+                placeholders = "(" + ", ".join("%s" for _ in rows[0]) + ")"
+                cur.executemany(query.replace("VALUES %s", f"VALUES {placeholders}"), rows)
+            return
+        from psycopg2 import extras
+        extras.execute_values(cur, query, rows)
+
+
+def partitioned_tables(cur):
+    """names of the range partitioned tables (partitions.py), looked up once per process"""
+    global _partitioned_tables
+    if _partitioned_tables is None:
+        if isinstance(cur, SqliteCursor):
+            _partitioned_tables = frozenset()  # postgres only
+        else:
+            cur.execute("SELECT c.relname FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid")
+            _partitioned_tables = frozenset(row[0] for row in cur.fetchall())
+    return _partitioned_tables
+
+
+def hot_window_start(cur):
+    """created_utc the hot queries read back to when reddit_submission is partitioned, None otherwise"""
+    if "reddit_submission" not in partitioned_tables(cur):
+        return None
+    return int(time.time()) - int(os.getenv("HOT_WINDOW_DAYS", DEFAULT_HOT_WINDOW_DAYS)) * 86400
+
+
+def hot_window_sql(cur, **tables):
+    """" AND <alias>.created_utc >= <start>" for every alias=table that is partitioned, so a query
+    only touches recent partitions. "" when the db isn't partitioned"""
+    start = hot_window_start(cur)
+    if start is None:
+        return ""
+    partitioned = partitioned_tables(cur)
+    return "".join(f" AND {alias}.created_utc >= {start}" for alias, table in tables.items() if table in partitioned)
 
 
 def get_recent_submissions_for_all_terms(cur, limit=50):
     # Step 1: Run the query and collect data
-    cur.execute(f"""
-        SELECT
-            s.name AS search_term_name,
-            r.created_utc,
-            r.id AS submission_id
-        FROM
-            search_term s
-        LEFT JOIN LATERAL (
-            SELECT r.id, r.created_utc
-            FROM search_term_match_reddit_submission m
-            JOIN reddit_submission r ON m.submission_id = r.id
-            WHERE m.search_term_id = s.id
-            ORDER BY r.created_utc DESC
-            LIMIT {limit}
-        ) r ON true
-    """)
+    if sqlite_backend is not None:
+        # no LATERAL in sqlite, rank each term's matches in index order instead. CROSS JOIN keeps the
+        # ranked rows outermost (term lookups by primary key), terms without matches come from the UNION
+        cur.execute(f"""
+            SELECT s.name AS search_term_name, r.created_utc, r.submission_id
+            FROM (
+                SELECT m.search_term_id, m.submission_id, m.created_utc,
+                       ROW_NUMBER() OVER (PARTITION BY m.search_term_id ORDER BY m.created_utc DESC) AS rank
+                FROM search_term_match_reddit_submission m
+                WHERE m.created_utc IS NOT NULL
+            ) r
+            CROSS JOIN search_term s ON s.id = r.search_term_id
+            WHERE r.rank <= {int(limit)} AND s.retired_at IS NULL
+            UNION ALL
+            SELECT s.name, NULL, NULL
+            FROM search_term s
+            WHERE s.retired_at IS NULL AND NOT EXISTS (
+                SELECT 1 FROM search_term_match_reddit_submission m
+                WHERE m.search_term_id = s.id AND m.created_utc IS NOT NULL
+            )
+        """)
+    else:
+        # the match rows carry created_utc, so this is one index range read per term (migrations.py)
+        hot = hot_window_sql(cur, m="search_term_match_reddit_submission")
+        cur.execute(f"""
+            SELECT
+                s.name AS search_term_name,
+                r.created_utc,
+                r.submission_id
+            FROM
+                search_term s
+            LEFT JOIN LATERAL (
+                SELECT m.submission_id, m.created_utc
+                FROM search_term_match_reddit_submission m
+                WHERE m.search_term_id = s.id AND m.created_utc IS NOT NULL{hot}
+                ORDER BY m.created_utc DESC
+                LIMIT {limit}
+            ) r ON true
+            WHERE s.retired_at IS NULL
+        """)
 
     raw = cur.fetchall()
     data = defaultdict(list)
@@ -103,33 +228,109 @@ def get_recent_submissions_for_all_terms(cur, limit=50):
             data.setdefault(name.lower(), [])
 
     # Step 2: Remove super-terms
-    terms = sorted(data.keys())
+    good_terms = remove_super_terms(data.keys())
+
+    # Step 3: Filter data to keep only good (non-super) terms
+    filtered_data = {term: data[term] for term in good_terms}
+    return filtered_data
+
+
+def get_recent_submission_arrays(cur, limit=50):
+    """the same data as get_recent_submissions_for_all_terms, as numpy arrays for vectorized planning
+    returns (terms, term_index, created_utc): sorted lowercased terms without super-terms, and for
+    each of their `limit` newest submissions the index of its term and its created_utc"""
+    import numpy as np
+    cur.execute("SELECT id, name FROM search_term WHERE retired_at IS NULL")
+    term_rows = cur.fetchall()
+    terms = sorted(remove_super_terms(name.lower() for _, name in term_rows))
+    position = {term: i for i, term in enumerate(terms)}
+    term_ids = np.array([row[0] for row in term_rows], dtype=np.int64)
+    id_to_index = np.array([position.get(name.lower(), -1) for _, name in term_rows], dtype=np.int64)
+    order = np.argsort(term_ids)
+    term_ids, id_to_index = term_ids[order], id_to_index[order]
+
+    if sqlite_backend is not None:
+        cur.execute(f"""
+            SELECT search_term_id, created_utc FROM (
+                SELECT m.search_term_id, m.created_utc,
+                       ROW_NUMBER() OVER (PARTITION BY m.search_term_id ORDER BY m.created_utc DESC) AS rank
+                FROM search_term_match_reddit_submission m
+                WHERE m.created_utc IS NOT NULL
+            ) WHERE rank <= {int(limit)}
+        """)
+    else:
+        hot = hot_window_sql(cur, m="search_term_match_reddit_submission")
+        cur.execute(f"""
+            SELECT s.id, r.created_utc
+            FROM search_term s
+            JOIN LATERAL (
+                SELECT m.created_utc
+                FROM search_term_match_reddit_submission m
+                WHERE m.search_term_id = s.id AND m.created_utc IS NOT NULL{hot}
+                ORDER BY m.created_utc DESC
+                LIMIT {int(limit)}
+            ) r ON true
+            WHERE s.retired_at IS NULL
+        """)
+    rows = cur.fetchall()
+    row_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    created_utc = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+
+    # term id -> index into terms, -1 for retired terms and super-terms
+    slot = np.clip(np.searchsorted(term_ids, row_ids), 0, max(len(term_ids) - 1, 0))
+    term_index = np.full(len(rows), -1, dtype=np.int64)
+    if len(term_ids):
+        found = term_ids[slot] == row_ids
+        term_index[found] = id_to_index[slot[found]]
+    keep = term_index >= 0
+    return terms, term_index[keep], created_utc[keep]
+
+
+def remove_super_terms(terms):
+    """the terms that aren't a super-term of another term ("rfk vaccine panel" is a super-term of "rfk panel")
+    looks each term's word subsets up in a set instead of comparing every pair of terms"""
+    terms = set(terms)
+    word_counts = defaultdict(list)  # set of words -> word counts of the terms made of exactly those words
+    for term in terms:
+        words = term.split()
+        word_counts[frozenset(words)].append(len(words))
 
-    def is_super_term(a, b):
-        """Returns True if `b` is a super-term of `a`."""
-        a_words = a.split()
-        b_words = b.split()
-        if len(b_words) <= len(a_words):
-            return False
-        return all(word in b_words for word in a_words)
     good_terms = set()
     for term in terms:
-        if not any(is_super_term(comparison, term) for comparison in terms if comparison != term):
+        words = term.split()
+        distinct = list(set(words))
+        if len(distinct) > MAX_SUPER_TERM_WORDS:
+            # too many subsets to enumerate, compare with every other term
+            super_term = any(is_super_term(other, term) for other in terms if other != term)
+        else:
+            super_term = any(
+                count < len(words)
+                for size in range(1, len(distinct) + 1)
+                for subset in combinations(distinct, size)
+                for count in word_counts.get(frozenset(subset), ())
+            )
+        if not super_term:
             good_terms.add(term)
+    return good_terms
 
-    # Step 3: Filter data to keep only good (non-super) terms
-    filtered_data = {term: data[term] for term in good_terms}
-    return filtered_data
+
+def is_super_term(a, b):
+    """Returns True if `b` is a super-term of `a`."""
+    a_words = a.split()
+    b_words = b.split()
+    if len(b_words) <= len(a_words):
+        return False
+    return all(word in b_words for word in a_words)
 
 
 def get_recent_submimssions_for_term(cur, search_term_name, limit=50):
-    cur.execute("""
-        SELECT r.id, r.created_utc
+    hot = hot_window_sql(cur, m="search_term_match_reddit_submission")
+    cur.execute(f"""
+        SELECT m.submission_id, m.created_utc
         FROM search_term s
         JOIN search_term_match_reddit_submission m ON s.id = m.search_term_id
-        JOIN reddit_submission r ON m.submission_id = r.id
-        WHERE s.name = %s
-        ORDER BY r.created_utc DESC
+        WHERE s.name = %s AND m.created_utc IS NOT NULL{hot}
+        ORDER BY m.created_utc DESC
         LIMIT %s
     """, (search_term_name, limit))
     return cur.fetchall()
@@ -169,7 +370,7 @@ def get_search_term_list_without_superterms(conn):
 
 
 def get_full_search_term_list(cur):
-    cur.execute("""SELECT name FROM search_term""")
+    cur.execute("""SELECT name FROM search_term WHERE retired_at IS NULL""")
     r = cur.fetchall()
     search_term_list = [r[0] for r in r]
     # TODO: Should i just remove apostrophes from the data in the first place?